@@ -5,8 +5,6 @@ Created on Sat Feb 21 13:06:28 2026
 @author: Wolfgang Reuter
 
 TODO: Refactor properly
-TODO: Add button for manual changes of parameters 
-TDOO: Add brightness change
 
 Usage: 
     1) cd to directory 
@@ -14,14 +12,22 @@ Usage:
 """
 
 import streamlit as st
-from PIL import Image, ImageDraw
-from utils import rotate
+from PIL import ImageDraw
 import io
-import numpy as np
-from skimage.transform import ProjectiveTransform, warp
+import json
+import time
 
 from utils import resize_image, add_watermark_to_image, how_to_use_text, \
-    transform_image
+    transform_image, export_key_from_state, recipe_from_state, build_pyramid, \
+    pyramid_level, pyramid_level_for_size, encode_image, export_options_from_state, \
+    tone_from_state, EXPORT_FORMATS, LOSSLESS_FORMATS
+from cache import digest_bytes, export_cache, preview_cache, snapshot_cache
+import history
+import profiling
+from session_store import SessionStore
+from jobs import export_jobs, JobHandle, QueueFull, QUEUED, DONE, FAILED, FINISHED_STATES
+from auto_correct import estimate_skew, detect_quad, warp_offsets_for_quad, \
+    SKEW_MAX_SIZE, QUAD_MAX_SIZE
 
 st.set_page_config(page_title="Image Rotator + Warp + Rectangle", layout="wide")
 st.title("Image Correction")
@@ -32,6 +38,15 @@ st.title("Image Correction")
 
 MAX_SIZE = 1000
 RECT_BORDER_WIDTH = 4
+# Width the preview is displayed at at 100% zoom (at most the preview's 
+# own width)
+DISPLAY_WIDTH = 1000
+# Preview zoom steps in percent; below 100 a smaller pyramid level is 
+# rendered
+PREVIEW_ZOOMS = (25, 50, 75, 100)
+# Parameters must stay unchanged this long before the preview is rendered 
+# at full size
+RENDER_DEBOUNCE_SECONDS = 0.15
 
 # ---------------------
 # Session State Defaults
@@ -40,18 +55,18 @@ RECT_BORDER_WIDTH = 4
 defaults = {
     "show_help": True,
     "image": None,
-    "orig_image": None,
     "resized": False,
     "scale_factor": 1.0,
     "show_resize_toast": False,
     "cut_image": None,
+    "cut_key": None,
     "show_rectangle": False,
     "rect_left_width_margin": 10,
     "rect_right_width_margin": 10,
     "rect_top_height_margin": 10,
     "rect_bottom_height_margin": 10,
     "rect_increment": 5,
-    "degrees": 0,
+    "degrees": 0.0,
     "warp_tl_x_offset": 0.0,
     "warp_tl_y_offset": 0.0,
     "warp_tr_x_offset": 0.0,
@@ -65,86 +80,32 @@ defaults = {
     "watermark_text": "© ", 
     "watermark_text_orig": "",
     "cut_to_rect": False,
+    "upload_id": None,
+    "image_digest": None,
+    "pyramid": None,
+    "last_render_params": None,
+    "render_changed_at": 0.0,
+    "export_format": "PNG",
+    "export_quality": 90,
+    "export_compress_level": 6,
+    "export_drop_opaque_alpha": True,
+    "original_image_key": None,
+    "debug_panel": False,
+    "session_store": None,
+    "upload_path": None,
+    "export_job": None,
+    "tone_brightness": 0.0,
+    "tone_contrast": 1.0,
+    "tone_gamma": 1.0,
+    "tone_levels_r": (0, 255),
+    "tone_levels_g": (0, 255),
+    "tone_levels_b": (0, 255),
+    "export_error": None,
+    "history": [],
+    "history_index": 0,
+    "preview_zoom": 100,
 }
 
-# =============================================================================
-# Functions 
-# =============================================================================
-
-def prepare_orig_image():
-    # Make a copy of the original full-res image
-    orig_img = st.session_state.orig_image.copy()
-
-    # ---------------------
-    # Apply rotation
-    # ---------------------
-    if st.session_state.degrees != 0:
-        orig_img = rotate(orig_img, st.session_state.degrees).convert("RGBA")
-
-    # ---------------------
-    # Apply trapezoidal warp
-    # ---------------------
-    img_array = np.array(orig_img)
-    h, w = img_array.shape[:2]
-    scale_w = w / st.session_state.image.width
-    scale_h = h / st.session_state.image.height
-
-    src = np.array([[0, 0], [w, 0], [w, h], [0, h]])
-    dst = np.array([
-        [
-            st.session_state.warp_tl_x_offset * st.session_state.image.width * scale_w,
-            st.session_state.warp_tl_y_offset * st.session_state.image.height * scale_h,
-        ],
-        [
-            w + st.session_state.warp_tr_x_offset * st.session_state.image.width * scale_w,
-            st.session_state.warp_tr_y_offset * st.session_state.image.height * scale_h,
-        ],
-        [
-            w + st.session_state.warp_br_x_offset * st.session_state.image.width * scale_w,
-            h + st.session_state.warp_br_y_offset * st.session_state.image.height * scale_h,
-        ],
-        [
-            st.session_state.warp_bl_x_offset * st.session_state.image.width * scale_w,
-            h + st.session_state.warp_bl_y_offset * st.session_state.image.height * scale_h,
-        ],
-    ])
-
-    transform = ProjectiveTransform()
-    transform.estimate(dst, src)
-    warped = warp(img_array, transform, output_shape=(h, w))
-    orig_img = Image.fromarray((warped * 255).astype(np.uint8))
-
-    # ---------------------
-    # Cut to rectangle if requested
-    # ---------------------
-    if st.session_state.cut_to_rect:
-        left = st.session_state.rect_left_width_margin * scale_w
-        top = st.session_state.rect_top_height_margin * scale_h
-        right = orig_img.width - st.session_state.rect_right_width_margin * scale_w
-        bottom = orig_img.height - st.session_state.rect_bottom_height_margin * scale_h
-
-        left = max(0, left)
-        top = max(0, top)
-        right = min(orig_img.width, right)
-        bottom = min(orig_img.height, bottom)
-
-        if right > left and bottom > top:
-            orig_img = orig_img.crop((left, top, right, bottom))
-
-    # ---------------------
-    # Apply watermark if enabled
-    # ---------------------
-    
-    if st.session_state.watermark_enabled:
-        orig_img = add_watermark_to_image(orig_img, st.session_state.watermark_text)
-    
-    img_bytes = io.BytesIO()
-    orig_img.save(img_bytes, format="PNG")
-    img_bytes.seek(0)
-    st.session_state.original_image_bytes = img_bytes
-
-    st.success("Original image (altered) is ready for download!")
-    
 # =============================================================================
 # Set up defaults - and help message 
 # =============================================================================
@@ -153,6 +114,12 @@ for key, value in defaults.items():
     if key not in st.session_state:
         st.session_state[key] = value 
 
+# Opt-in stage timings and cache statistics (see profiling.py); recording 
+# is only enabled for the runs of a session with the panel open
+st.sidebar.checkbox("Debug panel", key="debug_panel")
+debug_records = [] if st.session_state.debug_panel else None
+profiling.set_collector(debug_records)
+
 if st.session_state.show_help: 
     with st.expander("How to use the app", expanded=False):
         st.write(how_to_use_text)
@@ -162,18 +129,62 @@ if st.session_state.show_help:
         st.session_state.show_help = False
         st.rerun()
 
+# ---------------------
+# Export Job Status
+# ---------------------
+
+@st.fragment(run_every=1.0)
+def export_job_status():
+    """
+    Shows the queue position or progress of the session's export job, 
+    polling once a second without rerunning the whole script; reruns it 
+    once the job has finished.
+    """
+    job = st.session_state.export_job
+    status = export_jobs.status(job.id)
+    if status is None or status["state"] in FINISHED_STATES:
+        if status is None:
+            st.session_state.export_error = "the job expired"
+        elif status["state"] == DONE:
+            st.session_state.original_image_key = job.key
+        elif status["state"] == FAILED:
+            st.session_state.export_error = status["error"]
+        st.session_state.export_job = None
+        st.rerun(scope="app")
+
+    if status["state"] == QUEUED:
+        st.info(f"Waiting for other exports to finish (position {status['position']} in the queue)...")
+    else:
+        st.progress(status["progress"], text=f"Preparing image for download... {status['progress']:.0%}")
+    if st.button("Cancel"):
+        job.cancel()
+        st.session_state.export_job = None
+        st.rerun(scope="app")
+
 # ---------------------
 # Upload Image
 # ---------------------
 
-uploaded_file = st.file_uploader("Upload Image", type=["png", "jpg", "jpeg"])
+uploaded_file = st.file_uploader("Upload Image", type=["png", "jpg", "jpeg", "tif", "tiff"])
+
+# Decoded once per upload at reduced scale for the preview; exports decode 
+# the full resolution in their worker process (see jobs.py)
+if uploaded_file is not None and st.session_state.upload_id != uploaded_file.file_id:
+    image_bytes = uploaded_file.getvalue()
+    st.session_state.upload_id = uploaded_file.file_id
+    # Hash the upload once; the digest keys all cached renders of it
+    st.session_state.image_digest = digest_bytes(image_bytes)
+
+    resized_img, resized, scale_factor = resize_image(
+        image_bytes, MAX_SIZE, st.session_state.image_digest
+    )
 
-if uploaded_file is not None:
-    image = Image.open(uploaded_file).convert("RGBA")
-    resized_img, resized, scale_factor = resize_image(uploaded_file.getvalue(), MAX_SIZE)
+    # Session images live in memory-mapped files (see session_store.py)
+    if st.session_state.session_store is None:
+        st.session_state.session_store = SessionStore()
+    store = st.session_state.session_store
 
-    st.session_state.image = resized_img if resized else image
-    st.session_state.orig_image = image
+    st.session_state.image = store.map_image("preview", resized_img)
     st.session_state.resized = resized
     st.session_state.scale_factor = scale_factor
     
@@ -182,8 +193,17 @@ if uploaded_file is not None:
     if resized:
         image_width, image_height = st.session_state.image.size
         st.session_state.rect_increment = int(max(image_width, image_height) * 0.005)
-    # Optionally store the raw bytes if needed for download
-    st.session_state.image_bytes = uploaded_file.getvalue()
+    # The raw upload is kept on disk for the full-resolution decode
+    st.session_state.upload_path = store.save_bytes("upload", image_bytes)
+    st.session_state.pyramid = [st.session_state.image] + [
+        store.map_image(f"pyramid_{index}", level)
+        for index, level in enumerate(build_pyramid(st.session_state.image)[1:], 1)
+    ]
+    # Undo starts over with a new image
+    history.reset(st.session_state)
+elif st.session_state.session_store is not None:
+    # Keeps an idle session from being swept by another process
+    st.session_state.session_store.touch()
 
 if st.session_state.show_resize_toast:
     st.info("Image was resized to improve performance. If you wish, all your alterations can at the end be applied to the original image, which you can then download. ", icon="ℹ️")
@@ -228,6 +248,18 @@ if st.session_state.image:
         with size_col8:
             if st.button("_ ▲"): st.session_state.rect_bottom_height_margin += st.session_state.rect_increment
 
+        # Direct entry of the values the buttons step (the buttons run 
+        # first, so they may still change the widgets' keys)
+        margin_col1, margin_col2, margin_col3, margin_col4 = st.columns(4)
+        with margin_col1:
+            st.number_input("Left (px)", step=1, key="rect_left_width_margin")
+        with margin_col2:
+            st.number_input("Right (px)", step=1, key="rect_right_width_margin")
+        with margin_col3:
+            st.number_input("Top (px)", step=1, key="rect_top_height_margin")
+        with margin_col4:
+            st.number_input("Bottom (px)", step=1, key="rect_bottom_height_margin")
+
         st.subheader("Rotation Controls")
         rot_col1, rot_col2, rot_col3, rot_col4 = st.columns(4)
         with rot_col1:
@@ -243,6 +275,41 @@ if st.session_state.image:
             if st.button("↺ -0.25°"):
                 st.session_state.degrees += 0.25
 
+        # Estimated from a small pyramid level, replaces the current angle
+        if st.session_state.pyramid is None:
+            st.session_state.pyramid = build_pyramid(st.session_state.image)
+        if st.button("Auto-straighten"):
+            skew_level = pyramid_level_for_size(st.session_state.pyramid, SKEW_MAX_SIZE)
+            st.session_state.degrees = round(estimate_skew(skew_level), 2)
+        st.number_input("Rotation (°)", step=0.25, format="%.2f", key="degrees")
+
+        # Sets all eight warp offsets so that the detected document (or 
+        # painting, screen) fills the image
+        if st.button("Auto-detect Corners"):
+            quad_level = pyramid_level_for_size(st.session_state.pyramid, QUAD_MAX_SIZE)
+            corners, confidence = detect_quad(quad_level)
+            if corners is None:
+                st.warning(f"No document outline found (confidence {confidence:.2f}).")
+            else:
+                # Level to preview pixel coordinates
+                scale = st.session_state.image.width / quad_level.width
+                corners = (corners + 0.5) * scale - 0.5
+                warp_offsets = warp_offsets_for_quad(
+                    st.session_state.image.size, corners, st.session_state.degrees
+                )
+                for key, value in warp_offsets.items():
+                    st.session_state[f"warp_{key}_offset"] = value
+                st.success(f"Document outline found (confidence {confidence:.2f}).")
+
+        def warp_inputs(corner, label):
+            x_col, y_col = st.columns(2)
+            with x_col:
+                st.number_input(f"{label} X", step=0.01, format="%.3f", 
+                                key=f"warp_{corner}_x_offset")
+            with y_col:
+                st.number_input(f"{label} Y", step=0.01, format="%.3f", 
+                                key=f"warp_{corner}_y_offset")
+
         st.subheader("Warp Controls Top Left")
         
         warp_tl_col1, warp_tl_col2, warp_tl_col3, warp_tl_col4 = st.columns(4)
@@ -263,7 +330,7 @@ if st.session_state.image:
             if st.button("Top-Left ▼"):
                 st.session_state.warp_tl_y_offset += 0.01
                 
-        st.caption(f"X: {st.session_state.warp_tl_x_offset:.2f} | Y: {st.session_state.warp_tl_y_offset:.2f}")
+        warp_inputs("tl", "Top-Left")
         
         st.subheader("Warp Controls Top Right")
         
@@ -285,7 +352,7 @@ if st.session_state.image:
             if st.button("Top-Right ▼"):
                 st.session_state.warp_tr_y_offset += 0.01
                 
-        st.caption(f"X: {st.session_state.warp_tr_x_offset:.2f} | Y: {st.session_state.warp_tr_y_offset:.2f}")
+        warp_inputs("tr", "Top-Right")
 
         st.subheader("Warp Controls Bottom Left")
         
@@ -307,7 +374,7 @@ if st.session_state.image:
             if st.button("Bottom-Left ▼"):
                 st.session_state.warp_bl_y_offset += 0.01
                 
-        st.caption(f"X: {st.session_state.warp_bl_x_offset:.2f} | Y: {st.session_state.warp_bl_y_offset:.2f}")
+        warp_inputs("bl", "Bottom-Left")
 
         
         st.subheader("Warp Controls Bottom Right")
@@ -330,7 +397,23 @@ if st.session_state.image:
             if st.button("Bottom-Right ▼"):
                 st.session_state.warp_br_y_offset += 0.01
                 
-        st.caption(f"X: {st.session_state.warp_br_x_offset:.2f} | Y: {st.session_state.warp_br_y_offset:.2f}")
+        warp_inputs("br", "Bottom-Right")
+
+        st.subheader("Tone Controls")
+        st.slider("Brightness", -1.0, 1.0, step=0.01, key="tone_brightness")
+        st.slider("Contrast", 0.0, 3.0, step=0.05, key="tone_contrast")
+        st.slider("Gamma", 0.2, 5.0, step=0.05, key="tone_gamma")
+        with st.expander("Levels (black and white point per channel)"):
+            st.slider("Red", 0, 255, key="tone_levels_r")
+            st.slider("Green", 0, 255, key="tone_levels_g")
+            st.slider("Blue", 0, 255, key="tone_levels_b")
+        # Widget values can only be set before the widgets are created, 
+        # i.e. in a callback
+        def reset_tone():
+            for key in ("tone_brightness", "tone_contrast", "tone_gamma", 
+                        "tone_levels_r", "tone_levels_g", "tone_levels_b"):
+                st.session_state[key] = defaults[key]
+        st.button("Reset Tone", on_click=reset_tone)
 
     # ---------------------
     # Watermark Controls
@@ -341,8 +424,7 @@ if st.session_state.image:
         st.session_state.watermark_enabled = not st.session_state.watermark_enabled
         st.session_state.show_watermark_input = st.session_state.watermark_enabled
         if not st.session_state.watermark_enabled:
-            # Reset to clean image
-            st.session_state.image = st.session_state.image.copy()
+            # The watermark is applied per render, the image stays clean
             st.session_state.watermark_text_orig = ""
             st.rerun()
     
@@ -375,36 +457,116 @@ if st.session_state.image:
         "br_x": st.session_state.warp_br_x_offset,
         "br_y": st.session_state.warp_br_y_offset,
     }
+    # Applied by the lookup table of the warp pass
+    tone = tone_from_state(st.session_state)
+    # Read once: render_preview() also runs for the deferred download, 
+    # outside the script run, where the session state is not available
+    degrees = st.session_state.degrees
+    image_digest = st.session_state.image_digest
+    watermark_enabled = st.session_state.watermark_enabled
+    watermark_text = st.session_state.watermark_text
     
-    # Start from the watermarked image
-    warped_image = transform_image(
-        st.session_state.image,
-        st.session_state.degrees,
-        warp_offsets
-    )
-    
-    if st.session_state.watermark_enabled: 
-        warped_image = add_watermark_to_image(
-            warped_image,
-            st.session_state.watermark_text
+    if st.session_state.pyramid is None:
+        st.session_state.pyramid = build_pyramid(st.session_state.image)
+    pyramid = st.session_state.pyramid
+
+    def render_preview(image):
+        rendered = transform_image(
+            image,
+            degrees,
+            warp_offsets,
+            image_key=(image_digest, image.size),
+            tone=tone
         )
+        if watermark_enabled: 
+            rendered = add_watermark_to_image(rendered, watermark_text)
+        return rendered
+
+    # The changes made by the controls above go into the undo history
+    history.record(st.session_state)
+
+    with image_col:
+        # Callbacks: the restored values must be set before the widgets 
+        # of the next run are created
+        undo_col, redo_col = st.columns(2)
+        with undo_col:
+            st.button("↶ Undo", on_click=history.undo, args=(st.session_state,),
+                      disabled=not history.can_undo(st.session_state))
+        with redo_col:
+            st.button("↷ Redo", on_click=history.redo, args=(st.session_state,),
+                      disabled=not history.can_redo(st.session_state))
+        st.select_slider("Zoom", PREVIEW_ZOOMS, key="preview_zoom",
+                         format_func=lambda zoom: f"{zoom}%")
+        image_slot = st.empty()
+
+    # ---------------------
+    # Render at the pyramid level matching the display width. After a 
+    # parameter change the coarsest level is shown instead, until the 
+    # parameters have stayed unchanged for RENDER_DEBOUNCE_SECONDS: a burst 
+    # of changes (e.g. stepping a number input) is rendered at full size 
+    # only in its last state. The wait is a fragment rerunning on a timer, 
+    # so the script thread is not blocked.
+    # ---------------------
+    display_width = (min(st.session_state.image.width, DISPLAY_WIDTH) 
+                     * st.session_state.preview_zoom // 100)
+    level = pyramid_level(pyramid, display_width)
+
+    render_params = (
+        degrees, 
+        tuple(warp_offsets.values()), 
+        json.dumps(tone, sort_keys=True),
+        watermark_enabled, 
+        watermark_text,
+    )
+    if render_params != st.session_state.last_render_params:
+        st.session_state.last_render_params = render_params
+        st.session_state.render_changed_at = time.monotonic()
+    settling = (time.monotonic() - st.session_state.render_changed_at < RENDER_DEBOUNCE_SECONDS
+                and ("snapshot", image_digest, render_params, level) not in snapshot_cache)
+    if settling:
+        level = len(pyramid) - 1
+
+        @st.fragment(run_every=RENDER_DEBOUNCE_SECONDS)
+        def render_when_settled():
+            # A newer change has moved render_changed_at: wait on
+            if time.monotonic() - st.session_state.render_changed_at >= RENDER_DEBOUNCE_SECONDS:
+                st.rerun()
+
+        render_when_settled()
+    level_scale = pyramid[level].width / pyramid[0].width
+    snapshot_key = ("snapshot", image_digest, render_params, level)
+
+    # Encoded once per parameter state (see history.py): a state seen 
+    # before, e.g. after undo or redo, is shown without rendering it again
+    snapshot = snapshot_cache.get_or_compute(
+        snapshot_key, lambda: history.encode_snapshot(render_preview(pyramid[level]))
+    )
+    warped_image = None
     
     # Draw rectangle (optional)
     if st.session_state.show_rectangle:
+        warped_image = history.decode_snapshot(snapshot)
+        if warped_image.mode in ("L", "LA"):
+            # Gray previews stay gray until something is drawn in colour
+            warped_image = warped_image.convert("RGBA" if warped_image.mode == "LA" else "RGB")
         draw = ImageDraw.Draw(warped_image)
         draw.rectangle(
             [
-                st.session_state.rect_left_width_margin,
-                st.session_state.rect_top_height_margin,
-                warped_image.width - st.session_state.rect_right_width_margin,
-                warped_image.height - st.session_state.rect_bottom_height_margin
+                st.session_state.rect_left_width_margin * level_scale,
+                st.session_state.rect_top_height_margin * level_scale,
+                warped_image.width - st.session_state.rect_right_width_margin * level_scale,
+                warped_image.height - st.session_state.rect_bottom_height_margin * level_scale
             ],
             outline="red",
             width=RECT_BORDER_WIDTH
         )
     
-    # Crop to rectangle if requested
+    # Crop to rectangle if requested (in full preview resolution)
     if st.button("Cut to Rectangle"):
+        if level != 0:
+            warped_image = render_preview(pyramid[0])
+        elif warped_image is None:
+            warped_image = history.decode_snapshot(snapshot)
         left = st.session_state.rect_left_width_margin + RECT_BORDER_WIDTH
         top = st.session_state.rect_top_height_margin + RECT_BORDER_WIDTH
         right = warped_image.width - st.session_state.rect_right_width_margin - RECT_BORDER_WIDTH
@@ -417,50 +579,154 @@ if st.session_state.image:
     
         if right > left and bottom > top:
             warped_image = warped_image.crop((left, top, right, bottom))
-            st.session_state.cut_image = warped_image.copy()
+            st.session_state.cut_image = (
+                st.session_state.session_store.map_image("cut", warped_image)
+                if st.session_state.session_store is not None else warped_image
+            )
+            # Identifies the cut image's content, for the download cache
+            st.session_state.cut_key = (render_params, (left, top, right, bottom))
             st.session_state.cut_to_rect = True
+            # Set after this run's state was recorded: a step of its own
+            history.record(st.session_state)
     
     # ---------------------
     # Display image
     # ---------------------
     
-    with image_col:
-        st.image(warped_image, width=image_width)
-        
-    if st.session_state.cut_image != None: 
-        download_image = st.session_state.cut_image.copy()
-    else: 
-        download_image = warped_image.copy()
+    # PNG: Streamlit would encode images without alpha as JPEG
+    image_slot.image(snapshot if warped_image is None else warped_image, width=display_width,
+                     output_format="PNG")
     
-    img_bytes = io.BytesIO()
-    download_image.save(img_bytes, format="PNG")
-    img_bytes.seek(0)
+    # ---------------------
+    # Export Options
+    # ---------------------
+    
+    with st.expander("Export Options"):
+        st.selectbox("Format", list(EXPORT_FORMATS), key="export_format")
+        if st.session_state.export_format in LOSSLESS_FORMATS:
+            st.slider("Compression level", 0, 9, key="export_compress_level")
+        else:
+            st.slider("Quality", 1, 100, key="export_quality")
+        st.checkbox("Drop alpha channel if fully opaque", key="export_drop_opaque_alpha")
+
+    export_options = export_options_from_state(st.session_state)
+    extension, mime = EXPORT_FORMATS[export_options["format"]]
+
+    # Rendered and encoded only when the button is clicked, not on every 
+    # rerun: at full preview resolution and without the rectangle overlay. 
+    # The bytes are cached per parameter state, so repeated downloads of 
+    # an unchanged state do not encode again.
+    # Undo may have taken the cut back (and redo restored it)
+    cut_image = st.session_state.cut_image if st.session_state.cut_to_rect else None
+    download_key = (
+        "download", 
+        image_digest, 
+        render_params if cut_image is None else st.session_state.cut_key,
+        tuple(sorted(export_options.items())),
+    )
+
+    def encode_download():
+        def encode():
+            download_image = render_preview(pyramid[0]) if cut_image is None else cut_image
+            img_bytes = io.BytesIO()
+            encode_image(download_image, img_bytes, export_options)
+            return img_bytes.getvalue()
+        return preview_cache.get_or_compute(download_key, encode)
     
     st.download_button(
         label="Download Image",
-        data=img_bytes,
-        file_name="processed_image.png",
-        mime="image/png"
+        data=encode_download,
+        file_name="processed_image" + extension,
+        mime=mime
+    )
+    
+    # Correction parameters, to apply the same alterations with batch.py
+    st.download_button(
+        label="Download Recipe",
+        data=json.dumps(recipe_from_state(st.session_state), indent=2, ensure_ascii=False),
+        file_name="recipe.json",
+        mime="application/json"
     )
     
     # ---------------------
     # Download Original Image (Altered)
     # ---------------------
     
-    # Button to trigger heavy processing
+    # Exports run as background jobs on a process pool shared by all 
+    # sessions (see jobs.py); the session only holds a handle to its job
     if st.session_state.resized:
+        export_key, export_recipe, export_options = export_key_from_state(
+            st.session_state, export_options
+        )
+        job = st.session_state.export_job
+        # The parameters changed since the job was queued: it is of no use
+        if job is not None and job.key != export_key:
+            job.cancel()
+            job = st.session_state.export_job = None
+
         if st.button("Prepare Original Image (Altered)"):
-            with st.spinner("Preparing image for download..."):
-            
-                prepare_orig_image()
-    
-            # ---------------------
-            # Show download button only if processed
-            # ---------------------
-            if "original_image_bytes" in st.session_state:
-                st.download_button(
-                    label="Download Original Image (Altered)",
-                    data=st.session_state.original_image_bytes,
-                    file_name="original_image_altered.png",
-                    mime="image/png"
-                )
+            if export_cache.touch(export_key):
+                st.session_state.original_image_key = export_key
+            elif job is None:
+                try:
+                    job = st.session_state.export_job = JobHandle(export_jobs, export_jobs.submit(
+                        export_key, st.session_state.upload_path, export_recipe, export_options
+                    ))
+                except QueueFull:
+                    st.warning("The server is busy with other exports. Please try again in a minute.")
+
+        if st.session_state.export_error is not None:
+            st.error(f"Preparing the image failed ({st.session_state.export_error}).")
+            st.session_state.export_error = None
+
+        if job is not None:
+            export_job_status()
+
+        # ---------------------
+        # Show download button only if processed
+        # ---------------------
+        if st.session_state.original_image_key == export_key:
+            st.success("Original image (altered) is ready for download!")
+            # The export is encoded to the disk cache; it is only read 
+            # into memory when the download is requested
+            st.download_button(
+                label="Download Original Image (Altered)",
+                data=lambda: export_cache.get(export_key),
+                file_name="original_image_altered" + extension,
+                mime=mime
+            )
+
+# =============================================================================
+# Debug panel
+# =============================================================================
+
+if debug_records is not None:
+    with st.sidebar:
+        st.subheader("Stages (this run)")
+        stages = [record for record in debug_records if "stage" in record]
+        if stages:
+            st.dataframe([
+                {
+                    "stage": "· " * record["depth"] + record["stage"],
+                    "ms": round(record["seconds"] * 1000, 1),
+                    "input": record["input"],
+                    "output": record.get("output"),
+                    "allocated (MiB)": round(record["allocated"] / 1024**2, 1),
+                }
+                for record in stages
+            ], hide_index=True)
+        else:
+            st.caption("No pipeline stage ran.")
+
+        st.subheader("Cache lookups (this run)")
+        lookups = [record for record in debug_records if "cache" in record]
+        for record in lookups:
+            st.caption(f"{record['cache']}: {'hit' if record['hit'] else 'miss'}")
+        if not lookups:
+            st.caption("None.")
+
+        st.subheader("Preview cache")
+        st.json(preview_cache.stats())
+
+        st.subheader("Snapshot cache")
+        st.json(snapshot_cache.stats())
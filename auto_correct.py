@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""
+Automatic estimation of correction parameters from (downsampled) images,
+usable from the app as well as from batch code.
+"""
+
+import numpy as np
+from scipy import ndimage
+from skimage.transform import ProjectiveTransform
+
+from utils import rotation_matrix
+
+# Longer side of the image the estimators work on
+SKEW_MAX_SIZE = 512
+# Largest skew (degrees) the estimator reports; orientations are folded 
+# to ±45°, larger estimates are treated as unreliable
+SKEW_MAX_ANGLE = 30.0
+# Histogram resolution and smoothing (standard deviation) in degrees
+SKEW_BIN_DEGREES = 0.1
+SKEW_SMOOTHING_DEGREES = 1.0
+# Minimum share of the edge energy that must agree with the estimate (a 
+# uniform orientation distribution gives about 4%)
+SKEW_MIN_SUPPORT = 0.15
+
+# Longer side of the image the quad detector works on
+QUAD_MAX_SIZE = 400
+# Foreground area (fraction of the image) a quad may cover
+QUAD_MIN_AREA = 0.05
+QUAD_MAX_AREA = 0.98
+# Distance (fraction of the side length) of boundary pixels used to fit a side
+QUAD_SIDE_TOLERANCE = 0.05
+# Foreground structures narrower than this (fraction of the longer side) 
+# are removed before the quad is fitted
+QUAD_OPENING = 0.04
+# Minimum grey level range, and overlap of quad and foreground, for a result
+QUAD_MIN_CONTRAST = 16
+QUAD_MIN_CONFIDENCE = 0.8
+
+# ---------------------
+# Helpers
+# ---------------------
+
+def _gray(image, max_size):
+    """
+    Converts a PIL image to a float32 luminance array whose longer side is
+    at most max_size (integer reduction, cheap and alias-free).
+    """
+    factor = -(-max(image.size) // max_size)
+    if factor > 1:
+        image = image.reduce(factor)
+    return np.asarray(image.convert("L"), dtype=np.float32)
+
+
+def _gradients(gray):
+    """
+    Gradients of a 2D array: a [1, 2, 1] blur followed by the Scharr 
+    operator, for orientations that stay accurate on aliased (jagged) 
+    edges. The outermost 2 pixels are dropped.
+    """
+    gray = gray[:-2] + 2 * gray[1:-1] + gray[2:]
+    gray = gray[:, :-2] + 2 * gray[:, 1:-1] + gray[:, 2:]
+    smooth_x = 3 * gray[:-2] + 10 * gray[1:-1] + 3 * gray[2:]
+    smooth_y = 3 * gray[:, :-2] + 10 * gray[:, 1:-1] + 3 * gray[:, 2:]
+    gx = smooth_x[:, 2:] - smooth_x[:, :-2]
+    gy = smooth_y[2:] - smooth_y[:-2]
+    return gx, gy
+
+
+# ---------------------
+# Skew
+# ---------------------
+
+def estimate_skew(image, max_size=SKEW_MAX_SIZE):
+    """
+    Estimates the rotation that levels an image, from the orientation of
+    its strongest edges.
+
+    Gradient orientations are folded to a period of 90°, so horizontal and
+    vertical edges (horizon, walls, text lines, page borders) vote for the
+    same skew. The votes are weighted by gradient energy; the peak of
+    the smoothed histogram is refined by averaging the votes around it.
+
+    Parameters:
+    - image (PIL.Image): Image (or pyramid level) to analyze; it is reduced
+      to at most max_size pixels on the longer side
+    - max_size (int): Working resolution
+
+    Returns:
+    - float: Angle in degrees in the convention of
+      st.session_state.degrees (counter-clockwise positive), i.e. the
+      value to rotate the image by; 0.0 if the image has no dominant edge 
+      orientation
+    """
+    gx, gy = _gradients(_gray(image, max_size))
+    magnitude = np.hypot(gx, gy)
+    if magnitude.size == 0:
+        return 0.0
+
+    # The weaker half (flat areas, noise) does not vote; the rest votes 
+    # with squared magnitude, as in a structure tensor
+    threshold = np.percentile(magnitude, 50)
+    strong = magnitude > max(threshold, 1e-3)
+    if not strong.any():
+        return 0.0
+
+    # In image coordinates (y down) the gradient of an edge that is skewed
+    # by a counter-clockwise rotation a points at -a (mod 90°), so its
+    # folded angle is already the correction to apply
+    angles = np.degrees(np.arctan2(gy[strong], gx[strong]))
+    angles = (angles + 45.0) % 90.0 - 45.0
+
+    weights = magnitude[strong] ** 2
+    bins = int(round(90.0 / SKEW_BIN_DEGREES))
+    histogram = np.bincount(
+        ((angles + 45.0) / SKEW_BIN_DEGREES).astype(np.int64) % bins,
+        weights=weights, minlength=bins
+    )
+    # Circular Gaussian smoothing (the histogram wraps at ±45°)
+    radius = int(round(3 * SKEW_SMOOTHING_DEGREES / SKEW_BIN_DEGREES))
+    taps = np.arange(-radius, radius + 1) * SKEW_BIN_DEGREES
+    kernel = np.exp(-0.5 * (taps / SKEW_SMOOTHING_DEGREES) ** 2)
+    padded = np.concatenate([histogram[-radius:], histogram, histogram[:radius]])
+    histogram = np.convolve(padded, kernel, mode="valid")
+    peak = (np.argmax(histogram) + 0.5) * SKEW_BIN_DEGREES - 45.0
+
+    # Refine: weighted mean of the votes around the peak
+    deviation = (angles - peak + 45.0) % 90.0 - 45.0
+    near = np.abs(deviation) <= 2 * SKEW_SMOOTHING_DEGREES
+    support = weights[near].sum() / weights.sum()
+    if support < SKEW_MIN_SUPPORT:
+        return 0.0
+    angle = peak + np.average(deviation[near], weights=weights[near])
+    angle = (angle + 45.0) % 90.0 - 45.0
+    if abs(angle) > SKEW_MAX_ANGLE:
+        return 0.0
+    return float(angle)
+
+
+# ---------------------
+# Document quadrilateral
+# ---------------------
+
+def _otsu_threshold(gray):
+    """
+    Threshold that maximizes the between-class variance of a uint8-range 
+    float array.
+    """
+    histogram = np.bincount(np.clip(gray, 0, 255).astype(np.uint8).ravel(), minlength=256)
+    levels = np.arange(256)
+    weight = np.cumsum(histogram)
+    total = weight[-1]
+    mean = np.cumsum(histogram * levels)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (mean[-1] * weight / total - mean) ** 2 / (weight * (total - weight))
+    between = np.nan_to_num(between[:-1])
+    return int(np.argmax(between))
+
+
+def _opening(mask, size):
+    """
+    Morphological opening with a size x size square: removes foreground 
+    parts (clutter, thin lines) narrower than size and keeps straight 
+    edges in place.
+    """
+    window = np.lib.stride_tricks.sliding_window_view
+    radius = size // 2
+
+    def erode(mask):
+        padded = np.pad(mask, ((radius, radius), (0, 0)), constant_values=True)
+        mask = window(padded, size, axis=0).all(axis=-1)
+        padded = np.pad(mask, ((0, 0), (radius, radius)), constant_values=True)
+        return window(padded, size, axis=1).all(axis=-1)
+
+    def dilate(mask):
+        padded = np.pad(mask, ((radius, radius), (0, 0)), constant_values=False)
+        mask = window(padded, size, axis=0).any(axis=-1)
+        padded = np.pad(mask, ((0, 0), (radius, radius)), constant_values=False)
+        return window(padded, size, axis=1).any(axis=-1)
+
+    return dilate(erode(mask))
+
+
+def _fit_line(points):
+    """
+    Total least squares line through points.
+
+    Returns:
+    - tuple: (point on the line, unit direction)
+    """
+    center = points.mean(axis=0)
+    _, _, vt = np.linalg.svd(points - center, full_matrices=False)
+    return center, vt[0]
+
+
+def _intersect(line_a, line_b):
+    (pa, da), (pb, db) = line_a, line_b
+    matrix = np.array([da, -db]).T
+    if abs(np.linalg.det(matrix)) < 1e-9:
+        return None
+    t = np.linalg.solve(matrix, pb - pa)[0]
+    return pa + t * da
+
+
+def _inside_quad(quad, shape):
+    """
+    Boolean mask of the pixels (index coordinates) inside a convex quad.
+    """
+    ys, xs = np.mgrid[0:shape[0], 0:shape[1]]
+    inside = np.ones(shape, dtype=bool)
+    for start, end in zip(quad, np.roll(quad, -1, axis=0)):
+        edge = end - start
+        inside &= (edge[0] * (ys - start[1]) - edge[1] * (xs - start[0])) >= 0
+    return inside
+
+
+def _is_convex(quad):
+    edges = np.roll(quad, -1, axis=0) - quad
+    cross = edges[:, 0] * np.roll(edges, -1, axis=0)[:, 1] - edges[:, 1] * np.roll(edges, -1, axis=0)[:, 0]
+    return bool((cross > 0).all() or (cross < 0).all())
+
+
+def detect_quad(image, max_size=QUAD_MAX_SIZE, min_confidence=QUAD_MIN_CONFIDENCE):
+    """
+    Finds the dominant quadrilateral (document, painting, screen) in an 
+    image.
+
+    The image is split into foreground and background with Otsu's 
+    threshold; the background is the class that covers most of the image 
+    border. Holes in the foreground (text, pictures) are filled, so that a 
+    page of dense text lines is one solid region, and a morphological 
+    opening removes small clutter. Initial corners are the extreme points 
+    of the foreground along the diagonals; lines fitted to the boundary pixels of each side 
+    then give the final corners. The confidence is the overlap 
+    (intersection over union) of the foreground and the quad.
+
+    Parameters:
+    - image (PIL.Image): Image (or pyramid level) to analyze; it is reduced 
+      to at most max_size pixels on the longer side
+    - max_size (int): Working resolution
+    - min_confidence (float): Quads with a lower confidence are discarded
+
+    Returns:
+    - np.ndarray: Corners (tl, tr, br, bl) as (x, y) pixel coordinates of 
+      image, shape (4, 2), or None if no quad was found
+    - float: Confidence between 0 and 1 (0.0 if no quad could be fitted)
+    """
+    gray = _gray(image, max_size)
+    scale = image.width / gray.shape[1]
+    # [1, 2, 1] blur against noise and texture
+    blurred = np.pad(gray, 1, mode="edge")
+    blurred = (blurred[:-2] + 2 * blurred[1:-1] + blurred[2:]) / 4
+    blurred = (blurred[:, :-2] + 2 * blurred[:, 1:-1] + blurred[:, 2:]) / 4
+
+    if np.ptp(blurred) < QUAD_MIN_CONTRAST:
+        return None, 0.0
+    mask = blurred > _otsu_threshold(blurred)
+    border = np.concatenate([mask[0], mask[-1], mask[:, 0], mask[:, -1]])
+    if border.mean() > 0.5:
+        mask = ~mask
+    # Without this, the opening erodes the page strips between text lines
+    mask = ndimage.binary_fill_holes(mask)
+    mask = _opening(mask, 2 * int(QUAD_OPENING * max(mask.shape) / 2) + 1)
+
+    area = mask.mean()
+    if not QUAD_MIN_AREA <= area <= QUAD_MAX_AREA:
+        return None, 0.0
+
+    # Initial corners: extreme foreground points along the diagonals
+    ys, xs = np.nonzero(mask)
+    points = np.column_stack([xs, ys]).astype(float)
+    diagonal, anti_diagonal = xs + ys, xs - ys
+    quad = points[[
+        np.argmin(diagonal), np.argmax(anti_diagonal),
+        np.argmax(diagonal), np.argmin(anti_diagonal),
+    ]]
+
+    # Boundary pixels (the image border does not count as boundary)
+    padded = np.pad(mask, 1, mode="edge")
+    interior = padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+    by, bx = np.nonzero(mask & ~interior)
+    boundary = np.column_stack([bx, by]).astype(float)
+
+    # Assign boundary pixels to the nearest side, fit a line per side 
+    # (ignoring the outer parts, where corners may be rounded or clipped)
+    lines = []
+    for start, end in zip(quad, np.roll(quad, -1, axis=0)):
+        edge = end - start
+        length = np.hypot(*edge)
+        if length < 2:
+            return None, 0.0
+        direction = edge / length
+        relative = boundary - start
+        along = relative @ direction / length
+        across = np.abs(relative @ np.array([-direction[1], direction[0]]))
+        near = (across <= QUAD_SIDE_TOLERANCE * length) & (along > 0.1) & (along < 0.9)
+        if near.sum() >= 10:
+            center, fitted = _fit_line(boundary[near])
+            # One refit without outliers (text or clutter touching the side)
+            distance = np.abs((boundary[near] - center) @ np.array([-fitted[1], fitted[0]]))
+            inliers = boundary[near][distance <= max(1.5, np.median(distance) * 3)]
+            if len(inliers) >= 10:
+                center, fitted = _fit_line(inliers)
+            lines.append((center, fitted))
+        else:
+            lines.append((start, direction))
+
+    # Boundary pixels lie half a pixel inside the edge: move the lines out
+    centroid = quad.mean(axis=0)
+    for index, (center, direction) in enumerate(lines):
+        normal = np.array([-direction[1], direction[0]])
+        if (center - centroid) @ normal < 0:
+            normal = -normal
+        lines[index] = (center + 0.5 * normal, direction)
+
+    corners = []
+    for index in range(4):
+        corner = _intersect(lines[index - 1], lines[index])
+        if corner is None:
+            return None, 0.0
+        corners.append(corner)
+    quad = np.array(corners)
+
+    if not _is_convex(quad):
+        return None, 0.0
+    inside = _inside_quad(quad, mask.shape)
+    union = (inside | mask).sum()
+    confidence = float((inside & mask).sum() / union) if union else 0.0
+
+    if confidence < min_confidence:
+        return None, confidence
+
+    # Working pixel coordinates to pixel coordinates of image
+    quad = (quad + 0.5) * scale - 0.5
+    return quad, confidence
+
+
+def warp_offsets_for_quad(size, corners, degrees=0):
+    """
+    Warp offsets that map a quadrilateral onto the whole output, in the 
+    convention of utils.perspective_matrix().
+
+    Parameters:
+    - size (tuple): (width, height) of the (unrotated) image the corners 
+      refer to
+    - corners (np.ndarray): Corners (tl, tr, br, bl) as (x, y) pixel 
+      coordinates, e.g. from detect_quad()
+    - degrees (float): Rotation applied before the warp; the corners are 
+      mapped into the rotated canvas
+
+    Returns:
+    - dict: tl_x, tl_y, tr_x, ... as fractions of the canvas size
+    """
+    rotation, (w, h) = rotation_matrix(size, degrees)
+    # Rotated canvas coordinates of the corners
+    points = np.column_stack([corners, np.ones(4)]) @ np.linalg.inv(rotation).T
+    points = points[:, :2] / points[:, 2:]
+
+    # The warp's inverse map P takes output point dst_i to frame corner i. 
+    # For the output frame to show the document, P must take frame corner 
+    # i to document corner i, i.e. P = G with G mapping the frame onto the 
+    # document, hence dst_i = G^-1(frame_i)
+    frame = np.array([[0, 0], [w, 0], [w, h], [0, h]], dtype=float)
+    transform = ProjectiveTransform()
+    transform.estimate(frame, points)
+    dst = transform.inverse(frame)
+
+    offsets = (dst - frame) / (w, h)
+    return {
+        f"{corner}_{axis}": float(offsets[index, axis_index])
+        for index, corner in enumerate(("tl", "tr", "br", "bl"))
+        for axis_index, axis in enumerate(("x", "y"))
+    }
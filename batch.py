@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Applies a correction recipe (as exported with "Download Recipe" in the app)
+to every image in a directory, using a pool of worker processes.
+
+Usage:
+    python batch.py recipe.json input_dir output_dir [--workers 8] [--force]
+                    [--format PNG|JPEG|WEBP|TIFF] [--quality 90] [--compress-level 6]
+                    [--keep-alpha] [--auto-straighten]
+
+Outputs are written as <output_dir>/<name>.<ext> in the chosen format (PNG
+by default), each with a hidden sidecar file .<name>.<ext>.key holding a
+hash of the recipe, export options and flags it was made with. Files whose
+output is newer than the input and was made with the same settings are
+skipped unless --force is given. With --auto-straighten, the rotation of
+the recipe is replaced by one estimated per image.
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from PIL import Image
+
+import utils
+from auto_correct import SKEW_MAX_SIZE, estimate_skew
+from session_store import SessionStore
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff")
+
+
+def output_path_for(input_path, output_dir, image_format="PNG"):
+    name = os.path.splitext(os.path.basename(input_path))[0]
+    return os.path.join(output_dir, name + utils.EXPORT_FORMATS[image_format][0])
+
+
+def settings_key(recipe, options, auto_straighten=False):
+    """
+    Hash of everything that determines an output besides the input: 
+    normalized recipe and export options, flags and the export pipeline 
+    version (see cache.EXPORT_CACHE_VERSION).
+    """
+    return utils.export_cache.key(None, {
+        "recipe": recipe, "export": options, "auto_straighten": auto_straighten,
+    })
+
+
+def key_path_for(output_path):
+    directory, name = os.path.split(output_path)
+    return os.path.join(directory, f".{name}.key")
+
+
+def is_up_to_date(input_path, output_path, key):
+    """
+    Whether output_path is newer than input_path and was made with the 
+    settings of key, see settings_key().
+    """
+    if not os.path.exists(output_path):
+        return False
+    try:
+        with open(key_path_for(output_path), encoding="utf-8") as f:
+            if f.read().strip() != key:
+                return False
+    except FileNotFoundError:
+        return False
+    return os.path.getmtime(output_path) >= os.path.getmtime(input_path)
+
+
+def process_file(input_path, output_path, recipe, options=None, auto_straighten=False,
+                 key=None):
+    """
+    Corrects one image. Runs in a worker process.
+
+    Parameters:
+    - key (str): Settings key written next to the output, see 
+      settings_key()
+
+    Returns:
+    - float: Processing time in seconds
+    """
+    start = time.perf_counter()
+    tmp_path = output_path + ".part"
+    # Large scans are memory-mapped rather than held in memory
+    store = SessionStore()
+    try:
+        image = utils.open_image(input_path, store)
+        if auto_straighten:
+            skew_image = image
+            if not isinstance(image, Image.Image) or utils.pixel_format(image)[1] != np.uint8:
+                # Arrays and 16-bit data are analyzed at preview size, in 8 bits
+                skew_image = utils.decode_preview(input_path, SKEW_MAX_SIZE)[0]
+            recipe = dict(recipe, degrees=round(estimate_skew(skew_image), 2))
+        utils.export_image(image, recipe, tmp_path, options=options)
+        os.replace(tmp_path, output_path)
+        if key is not None:
+            with open(key_path_for(output_path), "w", encoding="utf-8") as f:
+                f.write(key + "\n")
+    finally:
+        store.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return time.perf_counter() - start
+
+
+def run_batch(recipe_path, input_dir, output_dir, workers=None, force=False,
+              options=None, auto_straighten=False):
+    """
+    Applies a recipe to all images in input_dir.
+
+    Parameters:
+    - recipe_path (str): Path of the recipe JSON file
+    - input_dir (str): Directory with the images to correct
+    - output_dir (str): Directory for the corrected images
+    - workers (int): Number of worker processes, one per CPU by default
+    - force (bool): Also process images whose output is up to date (newer 
+      than the input and made with the same settings)
+    - options (dict): Export options, see utils.normalize_export_options()
+    - auto_straighten (bool): Estimate the rotation per image instead of 
+      using the one in the recipe
+
+    Returns:
+    - list: (file name, status, seconds) per input file, status being
+      "done", "skipped" or "failed: <error>"
+    """
+    recipe = utils.load_recipe(recipe_path)
+    options = utils.normalize_export_options(options)
+    key = settings_key(recipe, options, auto_straighten)
+    os.makedirs(output_dir, exist_ok=True)
+
+    inputs = sorted(
+        os.path.join(input_dir, name) for name in os.listdir(input_dir)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+    results = []
+    todo = []
+    for input_path in inputs:
+        output_path = output_path_for(input_path, output_dir, options["format"])
+        if not force and is_up_to_date(input_path, output_path, key):
+            results.append((os.path.basename(input_path), "skipped", 0.0))
+        else:
+            todo.append((input_path, output_path))
+
+    workers = workers or os.cpu_count() or 1
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    with ProcessPoolExecutor(workers, initializer=utils.init_warp_worker,
+                             initargs=(threads,)) as pool:
+        futures = {
+            pool.submit(process_file, input_path, output_path, recipe, options,
+                        auto_straighten, key): input_path
+            for input_path, output_path in todo
+        }
+        for future in as_completed(futures):
+            name = os.path.basename(futures[future])
+            try:
+                seconds = future.result()
+            except Exception as e:
+                results.append((name, f"failed: {e}", 0.0))
+            else:
+                results.append((name, "done", seconds))
+            print(f"{name}: {results[-1][1]} ({results[-1][2]:.2f}s)", flush=True)
+
+    return results
+
+
+def print_summary(results, wall_time):
+    done = [seconds for _, status, seconds in results if status == "done"]
+    skipped = sum(1 for _, status, _ in results if status == "skipped")
+    failed = [(name, status) for name, status, _ in results if status.startswith("failed")]
+
+    print()
+    print(f"{len(done)} processed, {skipped} skipped, {len(failed)} failed "
+          f"in {wall_time:.2f}s")
+    if done:
+        print(f"per file: mean {sum(done) / len(done):.2f}s, "
+              f"min {min(done):.2f}s, max {max(done):.2f}s")
+    for name, status in failed:
+        print(f"  {name}: {status}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Apply a correction recipe to a directory of images."
+    )
+    parser.add_argument("recipe", help="recipe JSON exported from the app")
+    parser.add_argument("input_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("--force", action="store_true",
+                        help="reprocess images whose output is up to date")
+    parser.add_argument("--format", type=str.upper, default="PNG",
+                        choices=list(utils.EXPORT_FORMATS),
+                        help="output format (default: PNG)")
+    parser.add_argument("--quality", type=int, default=90,
+                        help="JPEG/WebP quality, 1-100 (default: 90)")
+    parser.add_argument("--compress-level", type=int, default=6,
+                        help="PNG compression level, 0-9 (default: 6)")
+    parser.add_argument("--keep-alpha", action="store_true",
+                        help="keep the alpha channel even if it is fully opaque")
+    parser.add_argument("--auto-straighten", action="store_true",
+                        help="estimate the rotation per image instead of "
+                             "using the recipe's")
+    args = parser.parse_args(argv)
+
+    options = {
+        "format": args.format,
+        "quality": args.quality,
+        "compress_level": args.compress_level,
+        "drop_opaque_alpha": not args.keep_alpha,
+    }
+    start = time.perf_counter()
+    results = run_batch(args.recipe, args.input_dir, args.output_dir,
+                        workers=args.workers, force=args.force, options=options,
+                        auto_straighten=args.auto_straighten)
+    print_summary(results, time.perf_counter() - start)
+    return 1 if any(status.startswith("failed") for _, status, _ in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
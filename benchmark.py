@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the image pipeline stages on synthetic images, headless (no
+Streamlit server), recording wall time and peak memory per stage.
+
+Usage:
+    python benchmark.py [--sizes 1,12,24,50] [--modes RGB,RGBA]
+                        [--stages resize_image,transform_image,...]
+                        [--repeat 3] [--output results.json]
+                        [--baseline baseline.json] [--tolerance 0.2]
+
+Every (size, mode, stage) case runs in a fresh worker process, so that the
+peak RSS of one case does not hide the next. Per case the JSON results
+hold:
+    seconds           best wall time over the repeats
+    tracemalloc_peak  peak of Python-level allocations (NumPy included;
+                      Pillow's image memory is not traced)
+    rss_peak          peak resident set size of the worker process
+    rss_delta         rss_peak minus the RSS before the stage ran (input
+                      image already created), i.e. what the stage adds;
+                      exact on Linux, where the peak can be reset, an
+                      underestimate elsewhere (peak working set on
+                      Windows; 0 where it cannot be measured)
+
+With --baseline, cases whose time or rss_delta exceed the baseline by more
+than the tolerance are reported and the exit code is 1.
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+STAGES = (
+    "resize_image",
+    "transform_image",
+    "add_watermark_to_image",
+    "png_encode",
+    "prepare_orig_image",
+)
+DEFAULT_SIZES = (1, 12, 24, 50)
+DEFAULT_MODES = ("RGB", "RGBA")
+
+# Parameters used by the transform stages
+DEGREES = 3.0
+WARP_OFFSETS = {
+    "tl_x": 0.02, "tl_y": 0.01, "tr_x": -0.01, "tr_y": 0.02,
+    "bl_x": 0.01, "bl_y": -0.02, "br_x": -0.02, "br_y": -0.01,
+}
+WATERMARK_TEXT = "© Benchmark"
+
+
+# ---------------------
+# Inputs
+# ---------------------
+
+def synthetic_image(megapixels, mode, seed=0):
+    """
+    Photo-like test image (smooth gradients, texture and noise, so that
+    encoders neither excel nor choke) with a 4:3 aspect ratio.
+
+    Parameters:
+    - megapixels (float): Approximate size
+    - mode (str): "RGB" or "RGBA" (with a soft alpha vignette)
+    - seed (int): Noise seed
+
+    Returns:
+    - PIL.Image
+    """
+    width = int(round((megapixels * 1e6 * 4 / 3) ** 0.5))
+    height = int(round(width * 3 / 4))
+    rng = np.random.default_rng(seed)
+
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    pixels = np.empty((height, width, len(mode)), dtype=np.uint8)
+    # In bands of rows, so that creating the input hardly raises peak memory
+    for row in range(0, height, 256):
+        y = np.linspace(0, 1, height, dtype=np.float32)[row:row + 256, None]
+        for channel, phase in zip(range(3), (0.0, 2.1, 4.2)):
+            band = 96 + 64 * x + 48 * y + 24 * np.sin(40 * x + 25 * y + phase)
+            band += rng.normal(0, 6, band.shape).astype(np.float32)
+            pixels[row:row + 256, :, channel] = np.clip(band, 0, 255)
+        if mode == "RGBA":
+            distance = (x - 0.5) ** 2 + (y - 0.5) ** 2
+            pixels[row:row + 256, :, 3] = np.clip(255 * (1.4 - 2 * distance), 0, 255)
+    return Image.fromarray(pixels, mode)
+
+
+def encode_input(image):
+    """
+    Upload bytes for an image: JPEG for RGB, PNG for RGBA.
+    """
+    data = io.BytesIO()
+    if image.mode == "RGB":
+        image.save(data, format="JPEG", quality=90)
+    else:
+        image.save(data, format="PNG", compress_level=1)
+    return data.getvalue()
+
+
+# ---------------------
+# Stages
+# ---------------------
+
+def _stage_runner(stage, megapixels, mode):
+    """
+    Prepares the inputs of a stage (not measured) and returns a callable
+    that runs the stage once.
+    """
+    import utils
+    from cache import ExportCache, digest_bytes
+    from session_store import SessionStore
+
+    image = synthetic_image(megapixels, mode)
+
+    if stage == "resize_image":
+        image_bytes = encode_input(image)
+        return lambda: utils.resize_image(image_bytes, 1000)
+
+    if stage == "transform_image":
+        preview, _, _ = utils.resize_if_needed(image, 1000)
+        return lambda: utils.transform_image(preview, DEGREES, WARP_OFFSETS)
+
+    if stage == "add_watermark_to_image":
+        return lambda: utils.add_watermark_to_image(image, WATERMARK_TEXT)
+
+    if stage == "png_encode":
+        return lambda: utils.encode_image(image, io.BytesIO(), {"format": "PNG"})
+
+    if stage == "prepare_orig_image":
+        import streamlit as st
+
+        image_bytes = encode_input(image)
+        del image
+        store = SessionStore()
+        state = {
+            "session_store": store,
+            "upload_path": store.save_bytes("upload", image_bytes),
+            "image_digest": digest_bytes(image_bytes),
+            "degrees": DEGREES,
+            "cut_to_rect": True,
+            "watermark_enabled": True,
+            "watermark_text": WATERMARK_TEXT,
+            "rect_left_width_margin": 20,
+            "rect_right_width_margin": 20,
+            "rect_top_height_margin": 20,
+            "rect_bottom_height_margin": 20,
+        }
+        state.update({f"warp_{key}_offset": value for key, value in WARP_OFFSETS.items()})
+        state.update({f"tone_{name}": utils.DEFAULT_TONE[name] 
+                      for name in ("brightness", "contrast", "gamma")})
+        state.update({f"tone_levels_{channel}": tuple(utils.DEFAULT_TONE["levels"][channel]) 
+                      for channel in utils.LEVEL_CHANNELS})
+        state["image"] = utils.resize_image(image_bytes, 1000)[0]
+
+        def run():
+            # Cold start every time: no decoded image, empty export cache
+            for key, value in state.items():
+                st.session_state[key] = value
+            with tempfile.TemporaryDirectory() as directory:
+                utils.export_cache = ExportCache(directory)
+                utils.prepare_orig_image()
+        return run
+
+    raise ValueError(f"Unknown stage: {stage}")
+
+
+def _reset_peak_rss():
+    """
+    Resets the peak RSS of this process to the current RSS (Linux only).
+
+    Returns:
+    - bool: Whether the reset worked
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if sys.platform == "win32":
+        return _windows_peak_rss()
+    try:
+        # Unix only
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _windows_peak_rss():
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+            (name, ctypes.c_size_t) for name in (
+                "PeakWorkingSetSize", "WorkingSetSize", "QuotaPeakPagedPoolUsage",
+                "QuotaPagedPoolUsage", "QuotaPeakNonPagedPoolUsage", 
+                "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage",
+            )
+        ]
+
+    counters = ProcessMemoryCounters(cb=ctypes.sizeof(ProcessMemoryCounters))
+    kernel32 = ctypes.windll.kernel32
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    if not ctypes.windll.psapi.GetProcessMemoryInfo(
+        kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb
+    ):
+        return 0
+    return counters.PeakWorkingSetSize
+
+
+def run_case(stage, megapixels, mode, repeat):
+    """
+    Runs one stage repeat times. Called in a fresh worker process.
+
+    Returns:
+    - dict: Measurements of the case
+    """
+    import logging
+    # Bare-mode Streamlit warns on every session_state access
+    logging.disable(logging.WARNING)
+
+    run = _stage_runner(stage, megapixels, mode)
+    _reset_peak_rss()
+    rss_before = _peak_rss()
+
+    times = []
+    tracemalloc.start()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rss_peak = _peak_rss()
+    return {
+        "stage": stage,
+        "megapixels": megapixels,
+        "mode": mode,
+        "seconds": min(times),
+        "tracemalloc_peak": traced_peak,
+        "rss_peak": rss_peak,
+        "rss_delta": rss_peak - rss_before,
+    }
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, modes=DEFAULT_MODES, stages=STAGES, repeat=3):
+    """
+    Runs all (size, mode, stage) cases, each in its own process.
+
+    Returns:
+    - dict: {"meta": {...}, "results": [...]} as written to JSON
+    """
+    import utils
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for megapixels in sizes:
+        for mode in modes:
+            for stage in stages:
+                with ProcessPoolExecutor(1, mp_context=context) as pool:
+                    result = pool.submit(run_case, stage, megapixels, mode, repeat).result()
+                results.append(result)
+                print(format_result(result), flush=True)
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pillow": Image.__version__,
+            "cpu_count": os.cpu_count(),
+            "warp_threads": utils.WARP_THREADS,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+# ---------------------
+# Reporting
+# ---------------------
+
+def _mib(value):
+    return value / 1024**2
+
+
+def format_result(result):
+    return (f"{result['megapixels']:>4}MP {result['mode']:<4} {result['stage']:<24}"
+            f"{result['seconds']:8.3f}s  rss +{_mib(result['rss_delta']):7.1f} MiB"
+            f"  (peak {_mib(result['rss_peak']):7.1f})"
+            f"  traced {_mib(result['tracemalloc_peak']):7.1f} MiB")
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compares results with a baseline run.
+
+    Parameters:
+    - results (dict): Output of run_benchmarks()
+    - baseline (dict): Earlier output of run_benchmarks()
+    - tolerance (float): Allowed relative increase of time and rss_delta
+
+    Returns:
+    - list: Descriptions of the regressions
+    """
+    def case(result):
+        return (result["stage"], result["megapixels"], result["mode"])
+
+    previous = {case(result): result for result in baseline["results"]}
+    regressions = []
+    print()
+    print(f"{'case':<40}{'time':>10}{'rss delta':>12}")
+    for result in results["results"]:
+        old = previous.get(case(result))
+        if old is None:
+            continue
+        name = "{1}MP {2} {0}".format(*case(result))
+        time_ratio = result["seconds"] / max(old["seconds"], 1e-9)
+        rss_ratio = (result["rss_delta"] + 1) / (old["rss_delta"] + 1)
+        print(f"{name:<40}{time_ratio:>9.2f}x{rss_ratio:>11.2f}x")
+        # Timer noise on very short stages is no regression either
+        if time_ratio > 1 + tolerance and result["seconds"] - old["seconds"] > 0.01:
+            regressions.append(f"{name}: time {old['seconds']:.3f}s -> {result['seconds']:.3f}s")
+        # Nor are small absolute changes (allocator noise)
+        if rss_ratio > 1 + tolerance and result["rss_delta"] - old["rss_delta"] > 16 * 1024**2:
+            regressions.append(
+                f"{name}: rss delta {_mib(old['rss_delta']):.1f} -> "
+                f"{_mib(result['rss_delta']):.1f} MiB"
+            )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the image pipeline.")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="comma-separated image sizes in megapixels")
+    parser.add_argument("--modes", default=",".join(DEFAULT_MODES),
+                        help="comma-separated image modes (RGB, RGBA)")
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help="comma-separated stages, any of: " + ", ".join(STAGES))
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per case; the best time is reported")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative regression (default: 0.2)")
+    args = parser.parse_args(argv)
+
+    stages = args.stages.split(",")
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    results = run_benchmarks(
+        sizes=[float(size) if "." in size else int(size) for size in args.sizes.split(",")],
+        modes=args.modes.split(","),
+        stages=stages,
+        repeat=args.repeat,
+    )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print()
+            print(f"{len(regressions)} regression(s):")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
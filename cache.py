@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+Caches for the app: in-memory caches for preview renders and preview
+downloads and for encoded preview snapshots of the undo history (per
+process), and an on-disk cache for full-resolution exports, shared by all
+sessions and processes that point at the same directory.
+
+Preview entries are keyed by the upload digest (computed once per upload)
+plus the render parameters, so that no image has to be hashed on a rerun.
+The total size of the cached images is bounded; least recently used 
+entries are evicted first.
+
+Entries are content-addressed: the key is a hash of the source image bytes
+and the normalized recipe, so the same upload with the same corrections
+maps to the same file no matter which session asks for it. The total size
+is bounded; the least recently used entries (by file mtime, which is
+refreshed on every hit) are evicted first.
+
+Configuration (environment variables):
+    IMAGE_CORRECTION_CACHE_DIR        cache directory
+    IMAGE_CORRECTION_CACHE_MAX_BYTES  size limit in bytes (default 2 GiB)
+    IMAGE_CORRECTION_PREVIEW_MAX_BYTES  preview cache size limit in bytes
+                                        (default 256 MiB)
+    IMAGE_CORRECTION_SNAPSHOT_MAX_BYTES  snapshot cache size limit in bytes
+                                         (default 64 MiB)
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import profiling
+
+# Bump when the export pipeline changes its output for the same recipe
+EXPORT_CACHE_VERSION = 4
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "image_correction_exports")
+DEFAULT_MAX_BYTES = 2 * 1024**3
+DEFAULT_PREVIEW_MAX_BYTES = 256 * 1024**2
+DEFAULT_SNAPSHOT_MAX_BYTES = 64 * 1024**2
+
+
+def digest_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def value_nbytes(value):
+    """
+    Approximate memory footprint of a cached value: pixel data for images 
+    and arrays, the length of byte strings (also inside tuples and lists), 
+    nothing for other objects.
+    """
+    if isinstance(value, (tuple, list)):
+        return sum(value_nbytes(item) for item in value)
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    if hasattr(value, "getbands"):
+        return value.width * value.height * len(value.getbands())
+    return 0
+
+
+class PreviewCache:
+    """
+    Thread-safe, byte-bounded LRU cache for preview renders.
+
+    Values are returned as stored; callers must not modify them in place 
+    (copy before drawing on a cached image).
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = int(max_bytes or os.environ.get(
+            "IMAGE_CORRECTION_PREVIEW_MAX_BYTES", DEFAULT_PREVIEW_MAX_BYTES
+        ))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        # A peek: neither counted as a lookup nor refreshing the entry
+        with self._lock:
+            return key in self._entries
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached value for key, calling compute() on a miss.
+
+        Parameters:
+        - key (tuple): Hashable key, (stage name, ...), e.g. (stage, upload 
+          digest, parameters)
+        - compute (callable): Produces the value; runs outside the lock, so 
+          concurrent misses for the same key may compute it twice
+
+        Returns:
+        - The cached or computed value
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        profiling.event(f"preview:{key[0]}", entry is not None)
+        if entry is not None:
+            return entry[0]
+
+        value = compute()
+        size = value_nbytes(value)
+        if size > self.max_bytes:
+            return value
+
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_size
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """
+        Returns:
+        - dict: entries, bytes, max_bytes, hits, misses and evictions
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class ExportCache:
+    """
+    Size-bounded, LRU-evicted directory of encoded exports.
+
+    Writes go to a temporary file that is atomically renamed into place, so
+    concurrent readers never see partial files, and two processes producing
+    the same entry simply overwrite each other with identical content.
+    """
+
+    SUFFIX = ".bin"
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory or os.environ.get(
+            "IMAGE_CORRECTION_CACHE_DIR", DEFAULT_CACHE_DIR
+        )
+        self.max_bytes = int(max_bytes or os.environ.get(
+            "IMAGE_CORRECTION_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES
+        ))
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, image_digest, params):
+        """
+        Cache key for a source image and its (normalized) parameters.
+
+        Parameters:
+        - image_digest (str): Hash of the source image bytes
+        - params (dict): JSON-serializable parameters, e.g. a normalized
+          recipe
+
+        Returns:
+        - str: Hex digest
+        """
+        payload = json.dumps(
+            [EXPORT_CACHE_VERSION, image_digest, params],
+            sort_keys=True, ensure_ascii=False
+        )
+        return digest_bytes(payload.encode("utf-8"))
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def get(self, key):
+        """
+        Returns the cached bytes for key, or None on a miss.
+        """
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        self.touch(key)
+        return data
+
+    def open(self, key):
+        """
+        Opens the cached entry for key for reading (so that it can be 
+        streamed; an open file stays readable if the entry is evicted).
+
+        Returns:
+        - file object: Binary file, or None on a miss
+        """
+        try:
+            f = open(self.path(key), "rb")
+        except FileNotFoundError:
+            return None
+        self.touch(key)
+        return f
+
+    def touch(self, key):
+        """
+        Marks an entry as recently used.
+
+        Returns:
+        - bool: Whether the entry exists
+        """
+        try:
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    @contextlib.contextmanager
+    def writer(self, key):
+        """
+        Context manager yielding a binary file to write an entry to. The
+        entry only becomes visible if the block completes without error.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        os.close(fd)
+        try:
+            # Opened by path, so that the file object has a name (tifffile 
+            # needs one)
+            with open(tmp_path, "wb") as f:
+                yield f
+            os.replace(tmp_path, self.path(key))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+
+    def put(self, key, data):
+        with self.writer(key) as f:
+            f.write(data)
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits max_bytes.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(self.SUFFIX):
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            # Another process may have evicted it already
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            total -= size
+
+
+preview_cache = PreviewCache()
+snapshot_cache = PreviewCache(
+    os.environ.get("IMAGE_CORRECTION_SNAPSHOT_MAX_BYTES", DEFAULT_SNAPSHOT_MAX_BYTES)
+)
+export_cache = ExportCache()
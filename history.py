@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Undo/redo history of the correction parameters of a session, and encoded
+snapshots of the previews rendered for them.
+
+The history is a list of parameter states (rotation, warp offsets,
+rectangle margins and cut, tone, watermark) in the session state, a few hundred bytes
+each. A state is recorded once per script run, after the controls have
+changed it; undo and redo write a recorded state back (as button
+callbacks, before the widgets are created).
+
+Rendered previews are kept as PNG snapshots (compress level 1, about half
+the size of the pixels) in snapshot_cache (see cache.py), keyed by the
+render parameters. Stepping back and forth through the history shows the
+stored frame without rendering it again. Streamlit sends PNG bytes as they
+are (with output_format="PNG"), so a snapshot is also cheaper to display
+than a PIL image, which Streamlit encodes again on every run.
+"""
+
+import io
+
+from PIL import Image
+
+# Longest undo history per session
+MAX_HISTORY = 100
+# zlib level of the snapshots: fast, the snapshots are short-lived
+SNAPSHOT_COMPRESS_LEVEL = 1
+
+HISTORY_KEYS = (
+    "degrees",
+    "warp_tl_x_offset", "warp_tl_y_offset", "warp_tr_x_offset", "warp_tr_y_offset",
+    "warp_bl_x_offset", "warp_bl_y_offset", "warp_br_x_offset", "warp_br_y_offset",
+    "rect_left_width_margin", "rect_right_width_margin",
+    "rect_top_height_margin", "rect_bottom_height_margin", "cut_to_rect",
+    "tone_brightness", "tone_contrast", "tone_gamma",
+    "tone_levels_r", "tone_levels_g", "tone_levels_b",
+    "watermark_enabled", "watermark_text",
+)
+
+
+# ---------------------
+# History
+# ---------------------
+
+def history_entry(state):
+    """
+    Returns:
+    - dict: The parameters of state that the history covers
+    """
+    return {key: state[key] for key in HISTORY_KEYS}
+
+
+def reset(state):
+    state.history = [history_entry(state)]
+    state.history_index = 0
+
+
+def record(state, max_history=MAX_HISTORY):
+    """
+    Appends the current parameters to the history if they changed since
+    the last recorded (or restored) state. States that were undone are
+    dropped, as in any editor.
+
+    Parameters:
+    - state (st.session_state): Session state with history and
+      history_index
+    - max_history (int): Oldest states beyond this length are dropped
+
+    Returns:
+    - bool: Whether a state was recorded
+    """
+    if not state.history:
+        reset(state)
+        return True
+    entry = history_entry(state)
+    if entry == state.history[state.history_index]:
+        return False
+    history = state.history[:state.history_index + 1] + [entry]
+    state.history = history[-max_history:]
+    state.history_index = len(state.history) - 1
+    return True
+
+
+def can_undo(state):
+    return state.history_index > 0
+
+
+def can_redo(state):
+    return state.history_index < len(state.history) - 1
+
+
+def _restore(state, index):
+    state.history_index = index
+    for key, value in state.history[index].items():
+        state[key] = value
+
+
+def undo(state):
+    """
+    Restores the previous parameters (a button callback).
+    """
+    if can_undo(state):
+        _restore(state, state.history_index - 1)
+
+
+def redo(state):
+    """
+    Restores the parameters that were undone last (a button callback).
+    """
+    if can_redo(state):
+        _restore(state, state.history_index + 1)
+
+
+# ---------------------
+# Snapshots
+# ---------------------
+
+def encode_snapshot(image):
+    """
+    Encodes a rendered preview for the snapshot cache.
+
+    Returns:
+    - bytes: PNG data
+    """
+    data = io.BytesIO()
+    image.save(data, format="PNG", compress_level=SNAPSHOT_COMPRESS_LEVEL)
+    return data.getvalue()
+
+
+def decode_snapshot(data):
+    """
+    Returns:
+    - PIL.Image: The preview of a snapshot (a new image, safe to draw on)
+    """
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
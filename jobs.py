@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""
+Background export jobs: full-resolution exports run on a process pool
+shared by all sessions of the server, instead of in the session's script
+thread.
+
+At most `workers` exports run at once; further jobs wait in a FIFO queue
+of bounded length, and submitting to a full queue fails with QueueFull
+(the app asks the user to retry), so that under load exports queue up
+rather than all slowing down together. Jobs for the same export cache key
+are shared: a second session asking for the same export subscribes to the
+running job.
+
+Workers read the upload from the job's own link (or copy) of the file, so
+that a job shared with other sessions survives its first submitter
+replacing or removing the upload (see session_store.py), and encode
+straight into the export cache (see cache.py). They report progress and
+pick up cancellation through small files in a per-job directory, which
+needs no shared state between the processes. Cancellation is checked
+after every band of tiles in a tiled export and between the steps of an
+in-memory one.
+
+Configuration (environment variables):
+    IMAGE_CORRECTION_EXPORT_WORKERS  concurrent exports (default: half the
+                                     CPUs)
+    IMAGE_CORRECTION_EXPORT_QUEUE    maximum number of waiting jobs
+                                     (default 16)
+"""
+
+import itertools
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import utils
+from cache import ExportCache, export_cache
+from session_store import SessionStore
+
+DEFAULT_QUEUE_LENGTH = 16
+# Finished jobs are kept this long for their sessions to pick them up
+JOB_RETENTION_SECONDS = 600
+# Smallest progress step written to the progress file
+PROGRESS_STEP = 0.01
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+class QueueFull(RuntimeError):
+    """
+    Raised when a job is submitted while the queue is full.
+    """
+
+
+class JobCancelled(Exception):
+    """
+    Raised in a worker to abort a cancelled export.
+    """
+
+
+# ---------------------
+# Worker side
+# ---------------------
+
+def _write_progress(directory, fraction):
+    tmp_path = os.path.join(directory, "progress.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(f"{fraction:.4f}")
+    os.replace(tmp_path, os.path.join(directory, "progress"))
+
+
+def run_export_job(directory, upload_path, recipe, options, key, cache_directory,
+                   cache_max_bytes, tiled=None):
+    """
+    Exports an upload into the export cache. Runs in a worker process.
+
+    Parameters:
+    - directory (str): Job directory for the progress and cancel files
+    - upload_path (str): Path of the uploaded file
+    - recipe (dict): Normalized recipe
+    - options (dict): Normalized export options
+    - key (str): Export cache key
+    - cache_directory (str): Export cache directory
+    - cache_max_bytes (int): Export cache size limit
+    - tiled (bool): See utils.export_image()
+
+    Returns:
+    - str: Export cache key
+    """
+    cancel_path = os.path.join(directory, "cancel")
+    last = [-1.0]
+
+    def progress(fraction):
+        if os.path.exists(cancel_path):
+            raise JobCancelled()
+        if fraction - last[0] >= PROGRESS_STEP or fraction >= 1:
+            _write_progress(directory, fraction)
+            last[0] = fraction
+
+    progress(0.0)
+    cache = ExportCache(cache_directory, cache_max_bytes)
+    # Another job (or process) may have produced it in the meantime
+    if not cache.touch(key):
+        # The worker maps its own decode; the session's is not shared
+        store = SessionStore()
+        try:
+            image = utils.open_image(upload_path, store)
+            with cache.writer(key) as f:
+                utils.export_image(image, recipe, f, tiled=tiled, options=options,
+                                   progress=progress)
+        finally:
+            store.close()
+    _write_progress(directory, 1.0)
+    return key
+
+
+# ---------------------
+# Jobs
+# ---------------------
+
+def _remove_upload(job):
+    # The job's link to the upload is not needed once it has finished
+    try:
+        os.remove(job.args[1])
+    except FileNotFoundError:
+        pass
+
+
+class ExportJob:
+    """
+    State of one export job, as seen by the server process.
+    """
+
+    def __init__(self, job_id, key, directory, args):
+        self.id = job_id
+        self.key = key
+        self.directory = directory
+        self.args = args
+        self.state = QUEUED
+        self.error = None
+        self.subscribers = 1
+        self.finished_at = None
+        self.finished = threading.Event()
+
+    def progress(self):
+        """
+        Returns:
+        - float: Finished fraction (0 to 1)
+        """
+        if self.state == DONE:
+            return 1.0
+        try:
+            with open(os.path.join(self.directory, "progress")) as f:
+                return float(f.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0.0
+
+
+class ExportJobManager:
+    """
+    Bounded queue of export jobs in front of a shared process pool.
+    """
+
+    def __init__(self, workers=None, max_queue=None, directory=None, cache=None):
+        cpus = os.cpu_count() or 1
+        self.workers = int(workers or os.environ.get(
+            "IMAGE_CORRECTION_EXPORT_WORKERS", max(1, cpus // 2)
+        ))
+        self.max_queue = int(max_queue or os.environ.get(
+            "IMAGE_CORRECTION_EXPORT_QUEUE", DEFAULT_QUEUE_LENGTH
+        ))
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="image_correction_jobs-")
+            weakref.finalize(self, shutil.rmtree, directory, ignore_errors=True)
+        self.directory = directory
+        self.cache = cache or export_cache
+        self._threads = max(1, cpus // self.workers)
+        self._pool = None
+        self._pending = deque()
+        self._running = 0
+        self._jobs = {}
+        self._active = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+
+    def _executor(self):
+        if self._pool is None:
+            # Spawned, not forked: the server process runs many threads
+            self._pool = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn"),
+                initializer=utils.init_warp_worker, initargs=(self._threads,)
+            )
+        return self._pool
+
+    def submit(self, key, upload_path, recipe, options, tiled=None):
+        """
+        Queues an export, or subscribes to the active job with the same key.
+
+        Parameters:
+        - key (str): Export cache key, see utils.export_key_from_state()
+        - upload_path (str): Path of the uploaded file; the job links (or 
+          copies) it, so the caller may replace it (by renaming a new 
+          file over it, as SessionStore does) or remove it afterwards
+        - recipe (dict): Normalized recipe
+        - options (dict): Normalized export options
+        - tiled (bool): See utils.export_image()
+
+        Returns:
+        - ExportJob
+
+        Raises:
+        - QueueFull: If max_queue jobs are waiting already
+        """
+        with self._lock:
+            self._prune()
+            job = self._active.get(key)
+            if job is not None:
+                job.subscribers += 1
+                return job
+            if len(self._pending) >= self.max_queue:
+                raise QueueFull(f"{len(self._pending)} exports are waiting already")
+
+            job_id = next(self._ids)
+            directory = os.path.join(self.directory, str(job_id))
+            os.makedirs(directory)
+            job_upload_path = os.path.join(directory, "upload")
+            try:
+                os.link(upload_path, job_upload_path)
+            except OSError:
+                # Another file system, or no hard links
+                shutil.copyfile(upload_path, job_upload_path)
+            job = ExportJob(job_id, key, directory, (
+                directory, job_upload_path, recipe, options, key,
+                self.cache.directory, self.cache.max_bytes, tiled,
+            ))
+            self._jobs[job_id] = job
+            self._active[key] = job
+            self._pending.append(job)
+            self._start_next()
+            return job
+
+    def _start_next(self):
+        while self._pending and self._running < self.workers:
+            job = self._pending.popleft()
+            job.state = RUNNING
+            self._running += 1
+            try:
+                future = self._executor().submit(run_export_job, *job.args)
+            except BrokenProcessPool:
+                self._pool = None
+                future = self._executor().submit(run_export_job, *job.args)
+            future.add_done_callback(lambda future, job=job: self._finished(job, future))
+
+    def _finished(self, job, future):
+        with self._lock:
+            self._running -= 1
+            error = future.exception()
+            if error is None:
+                job.state = DONE
+            elif isinstance(error, JobCancelled):
+                job.state = CANCELLED
+            else:
+                job.state = FAILED
+                job.error = f"{type(error).__name__}: {error}"
+                if isinstance(error, BrokenProcessPool):
+                    # A worker died (e.g. out of memory); start a new pool
+                    self._pool = None
+            job.finished_at = time.monotonic()
+            job.finished.set()
+            _remove_upload(job)
+            if self._active.get(job.key) is job:
+                del self._active[job.key]
+            self._start_next()
+
+    def _prune(self):
+        now = time.monotonic()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished_at is not None and now - job.finished_at > JOB_RETENTION_SECONDS:
+                del self._jobs[job_id]
+                shutil.rmtree(job.directory, ignore_errors=True)
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def full(self):
+        """
+        Whether a new job would be refused with QueueFull (a job for a key 
+        that is being exported already would still be accepted).
+        """
+        with self._lock:
+            return len(self._pending) >= self.max_queue
+
+    def wait(self, job_id, timeout=None):
+        """
+        Blocks until a job has finished (or timeout seconds have passed).
+
+        Returns:
+        - dict: Status of the job, see status()
+        """
+        job = self.get(job_id)
+        if job is not None:
+            job.finished.wait(timeout)
+        return self.status(job_id)
+
+    def stats(self):
+        """
+        Returns:
+        - dict: workers, max_queue, running and queued
+        """
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "queued": len(self._pending),
+            }
+
+    def status(self, job_id):
+        """
+        Returns:
+        - dict: state, position (1-based place in the queue, 0 unless
+          queued), progress (0 to 1), key and error; None for unknown jobs
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            position = self._pending.index(job) + 1 if job.state == QUEUED else 0
+            return {
+                "state": job.state,
+                "position": position,
+                "progress": job.progress(),
+                "key": job.key,
+                "error": job.error,
+            }
+
+    def cancel(self, job_id):
+        """
+        Unsubscribes from a job; the job is cancelled when no session waits
+        for it any more. A queued job is dropped, a running one aborts at
+        its next progress report.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.state in FINISHED_STATES:
+                return
+            job.subscribers -= 1
+            if job.subscribers > 0:
+                return
+            del self._active[job.key]
+            if job.state == QUEUED:
+                self._pending.remove(job)
+                job.state = CANCELLED
+                job.finished_at = time.monotonic()
+                job.finished.set()
+                _remove_upload(job)
+            else:
+                open(os.path.join(job.directory, "cancel"), "w").close()
+
+    def shutdown(self):
+        with self._lock:
+            for job in list(self._pending):
+                job.subscribers = 1
+                self.cancel(job.id)
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+class JobHandle:
+    """
+    A session's subscription to a job; cancels it when the session state
+    holding the handle is garbage collected (the user left).
+    """
+
+    def __init__(self, manager, job):
+        self.id = job.id
+        self.key = job.key
+        self._finalizer = weakref.finalize(self, manager.cancel, job.id)
+
+    def cancel(self):
+        self._finalizer()
+
+
+export_jobs = ExportJobManager()
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in instrumentation of the pipeline stages (decode, warp, watermark,
+encode, ...) and caches.
+
+Recording is off unless either
+- the environment variable IMAGE_CORRECTION_PROFILE is set to 1, or
+- a collector list is active for the current context (the app does this
+  when its debug panel is open, see set_collector()).
+When off, stage() returns a shared no-op object and event() returns at
+once, so the instrumentation costs a function call per stage.
+
+Each record holds the stage name, duration, input and output sizes and
+the memory allocated by the stage (peak of traced allocations, i.e.
+NumPy and Python objects; Pillow's pixel buffers are not traced).
+Allocations are traced only while a recorded stage runs: tracemalloc is
+started by the first stage to enter and stopped when the last one exits
+(unless it was tracing already, e.g. in benchmark.py). Traced memory is
+process-wide, so the peaks of stages running concurrently in other
+threads (e.g. other app sessions) include each other's allocations.
+
+Outputs (environment variables):
+    IMAGE_CORRECTION_PROFILE_LOG   append one JSON line per record
+    IMAGE_CORRECTION_METRICS_FILE  rewrite totals in Prometheus text format
+                                   after every top-level stage
+The totals are per process (app, export workers, batch workers, server),
+so each process writes its own metrics file, named after the configured
+one with the process id inserted (metrics.prom becomes
+metrics.<pid>.prom, as the node exporter's textfile collector expects),
+with a pid label on every sample. The file is removed at interpreter
+exit (pool worker processes, which skip the exit handlers, leave theirs
+behind).
+"""
+
+import atexit
+import contextvars
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+ENABLED = os.environ.get("IMAGE_CORRECTION_PROFILE", "0") == "1"
+LOG_PATH = os.environ.get("IMAGE_CORRECTION_PROFILE_LOG")
+METRICS_PATH = os.environ.get("IMAGE_CORRECTION_METRICS_FILE")
+
+_collector = contextvars.ContextVar("profiling_collector", default=None)
+_stack = threading.local()
+_lock = threading.Lock()
+# Stages running in all threads, and whether tracemalloc was started for them
+_active_stages = 0
+_started_tracing = False
+
+# Process-wide totals: stage -> [count, seconds]; (cache, outcome) -> count
+_stage_totals = defaultdict(lambda: [0, 0.0])
+_event_totals = defaultdict(int)
+
+
+def set_collector(records):
+    """
+    Collects the records of the current context (e.g. one script run) into
+    records, and enables recording for it. None stops collecting.
+    """
+    _collector.set(records)
+
+
+def enabled():
+    return ENABLED or _collector.get() is not None
+
+
+def describe(value):
+    """
+    Short size description of an image, array or byte buffer.
+    """
+    if value is None:
+        return None
+    if hasattr(value, "getbands"):
+        return f"{value.width}x{value.height} {value.mode}"
+    if hasattr(value, "shape"):
+        return "x".join(map(str, value.shape)) + f" {value.dtype}"
+    if hasattr(value, "nbytes"):
+        return f"{value.nbytes} bytes"
+    if isinstance(value, (bytes, bytearray)):
+        return f"{len(value)} bytes"
+    return type(value).__name__
+
+
+# ---------------------
+# Stages
+# ---------------------
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def output(self, value):
+        return value
+
+    def note(self, **fields):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, name, source, details):
+        self.record = {"stage": name, "input": describe(source), **details}
+
+    def output(self, value):
+        """
+        Records the size of the stage's result and returns it unchanged.
+        """
+        self.record["output"] = describe(value)
+        return value
+
+    def note(self, **fields):
+        """
+        Adds fields to the record.
+        """
+        self.record.update(fields)
+
+    def __enter__(self):
+        stack = getattr(_stack, "stages", None)
+        if stack is None:
+            stack = _stack.stages = []
+        self.depth = len(stack)
+        stack.append(self)
+
+        _start_tracing()
+        self.traced_start = tracemalloc.get_traced_memory()[0]
+        self.child_peak = 0
+        tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        seconds = time.perf_counter() - self.start
+        peak = max(tracemalloc.get_traced_memory()[1], self.child_peak)
+        _stack.stages.pop()
+        if _stack.stages:
+            parent = _stack.stages[-1]
+            parent.child_peak = max(parent.child_peak, peak)
+        tracemalloc.reset_peak()
+
+        self.record.update({
+            "seconds": seconds,
+            "allocated": max(0, peak - self.traced_start),
+            "depth": self.depth,
+        })
+        if exc_type is not None:
+            self.record["error"] = exc_type.__name__
+        _emit(self.record)
+        with _lock:
+            totals = _stage_totals[self.record["stage"]]
+            totals[0] += 1
+            totals[1] += seconds
+        _stop_tracing()
+        if self.depth == 0:
+            write_metrics()
+        return False
+
+
+def _start_tracing():
+    global _active_stages, _started_tracing
+    with _lock:
+        if _active_stages == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+        _active_stages += 1
+
+
+def _stop_tracing():
+    # Tracing slows down every allocation in the process: it only runs 
+    # while stages are recorded
+    global _active_stages, _started_tracing
+    with _lock:
+        _active_stages -= 1
+        if _active_stages == 0 and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+
+
+def stage(name, source=None, **details):
+    """
+    Context manager timing a pipeline stage.
+
+        with profiling.stage("warp", image) as s:
+            result = s.output(warp(image))
+
+    Parameters:
+    - name (str): Stage name
+    - source: Input (image, array or bytes), for its size
+    - details: Further JSON-serializable fields of the record
+
+    Returns:
+    - Context manager whose output() records the result size and 
+      note() adds fields
+    """
+    if not (ENABLED or _collector.get() is not None):
+        return _NULL_STAGE
+    return _Stage(name, source, details)
+
+
+def event(cache, hit):
+    """
+    Records a cache lookup.
+
+    Parameters:
+    - cache (str): Cache (and stage) name, e.g. "preview:transform"
+    - hit (bool): Whether the lookup was a hit
+    """
+    if not (ENABLED or _collector.get() is not None):
+        return
+    with _lock:
+        _event_totals[(cache, "hit" if hit else "miss")] += 1
+    _emit({"cache": cache, "hit": hit})
+
+
+# ---------------------
+# Outputs
+# ---------------------
+
+def _emit(record):
+    record["time"] = time.time()
+    records = _collector.get()
+    if records is not None:
+        records.append(record)
+    if LOG_PATH:
+        line = json.dumps(record, ensure_ascii=False)
+        with _lock, open(LOG_PATH, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+def totals():
+    """
+    Returns:
+    - dict: {"stages": {name: (count, seconds)},
+      "caches": {(cache, "hit"/"miss"): count}} since process start
+    """
+    with _lock:
+        return {
+            "stages": {name: tuple(values) for name, values in _stage_totals.items()},
+            "caches": dict(_event_totals),
+        }
+
+
+def process_metrics_path():
+    """
+    Returns:
+    - str: This process's metrics file (see the module docstring), or 
+      None if IMAGE_CORRECTION_METRICS_FILE is not set
+    """
+    if not METRICS_PATH:
+        return None
+    root, extension = os.path.splitext(METRICS_PATH)
+    return f"{root}.{os.getpid()}{extension}"
+
+
+def _remove_metrics():
+    path = process_metrics_path()
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+atexit.register(_remove_metrics)
+
+
+def write_metrics(path=None):
+    """
+    Writes the process-wide totals in Prometheus text format (atomically,
+    so a scraper never reads a partial file), by default to this process's 
+    metrics file.
+    """
+    if path is None:
+        path = process_metrics_path()
+    if not path:
+        return
+    current = totals()
+    pid = os.getpid()
+    lines = [
+        "# TYPE image_correction_stage_seconds_total counter",
+        *(f'image_correction_stage_seconds_total{{pid="{pid}",stage="{name}"}} {seconds:.6f}'
+          for name, (_, seconds) in sorted(current["stages"].items())),
+        "# TYPE image_correction_stage_calls_total counter",
+        *(f'image_correction_stage_calls_total{{pid="{pid}",stage="{name}"}} {count}'
+          for name, (count, _) in sorted(current["stages"].items())),
+        "# TYPE image_correction_cache_lookups_total counter",
+        *(f'image_correction_cache_lookups_total{{pid="{pid}",cache="{cache}",'
+          f'result="{outcome}"}} {count}'
+          for (cache, outcome), count in sorted(current["caches"].items())),
+    ]
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
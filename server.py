@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP API of the correction engine, for tools that need corrected images
+without the browser app. Standard library only (http.server).
+
+Endpoints:
+    POST /correct  The request body is the image file (PNG, JPEG, TIFF,
+                   ...), the parameters are query parameters:
+                       recipe            correction recipe as JSON, as
+                                         written by "Download Recipe" (keys
+                                         left out take their defaults)
+                       format, quality, compress_level, drop_opaque_alpha
+                                         export options, see
+                                         utils.normalize_export_options()
+                   The response body is the corrected image.
+    GET /health    Worker and queue state as JSON.
+
+Errors: 400 for invalid parameters or an unreadable image, 411 without a
+Content-Length, 413 for uploads over the size limit, 503 (with
+Retry-After) when the queue is full, 500 when the correction failed.
+
+The upload is streamed to a scratch file (see session_store.py) and hashed
+on the way. The correction runs as an export job (see jobs.py): at most
+`workers` run at once on a process pool, up to `queue` more wait, and
+further requests are refused with 503 instead of piling up. Results go
+through the export cache (see cache.py), so a repeated request is served
+from disk, and the response is streamed from the cached file.
+
+Usage:
+    python server.py [--host 127.0.0.1] [--port 8502] [--workers 4]
+                     [--queue 16]
+
+Configuration (environment variables):
+    IMAGE_CORRECTION_MAX_UPLOAD_BYTES  largest accepted upload in bytes
+                                       (default 1 GiB)
+    Export workers, queue and cache as in jobs.py and cache.py.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import utils
+from jobs import DONE, ExportJobManager, QueueFull
+from session_store import SessionStore
+
+DEFAULT_PORT = 8502
+DEFAULT_MAX_UPLOAD_BYTES = 1024**3
+# Bytes read from the request or written to the response per step
+CHUNK_SIZE = 1024**2
+# Seconds a client refused with 503 is asked to wait
+RETRY_AFTER_SECONDS = 5
+
+OPTION_NAMES = ("format", "quality", "compress_level", "drop_opaque_alpha")
+
+
+class RequestError(Exception):
+    """
+    Raised while handling a request to answer it with an error status.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_parameters(query):
+    """
+    Reads the recipe and export options of a /correct request.
+
+    Parameters:
+    - query (str): URL query string
+
+    Returns:
+    - tuple: (recipe, options), both normalized
+
+    Raises:
+    - ValueError: For malformed or invalid parameters
+    """
+    params = {name: values[-1] for name, values in parse_qs(query).items()}
+    recipe = json.loads(params.get("recipe", "{}"))
+    if not isinstance(recipe, dict):
+        raise ValueError("recipe must be a JSON object")
+
+    options = {name: params[name] for name in OPTION_NAMES if name in params}
+    if "drop_opaque_alpha" in options:
+        options["drop_opaque_alpha"] = options["drop_opaque_alpha"].lower() in ("1", "true", "yes")
+    return utils.normalize_recipe(recipe), utils.normalize_export_options(options)
+
+
+class CorrectionHandler(BaseHTTPRequestHandler):
+    server_version = "ImageCorrection/1.0"
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if urlsplit(self.path).path != "/health":
+            self._send_error(HTTPStatus.NOT_FOUND, "Unknown endpoint")
+            return
+        self._send_body(HTTPStatus.OK, json.dumps(self.server.jobs.stats()).encode(),
+                        "application/json")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        try:
+            if url.path != "/correct":
+                raise RequestError(HTTPStatus.NOT_FOUND, "Unknown endpoint")
+            self._correct(url.query)
+        except RequestError as e:
+            self._send_error(e.status, str(e))
+
+    def _correct(self, query):
+        try:
+            recipe, options = parse_parameters(query)
+        except ValueError as e:
+            raise RequestError(HTTPStatus.BAD_REQUEST, str(e))
+        length = self._content_length()
+        # Refused before the upload is read, if possible
+        if self.server.jobs.full():
+            raise RequestError(HTTPStatus.SERVICE_UNAVAILABLE, "Too many corrections waiting")
+
+        store = SessionStore()
+        try:
+            upload_path, digest = self._read_upload(store, length)
+            # As the export job will open it (large TIFFs are not decoded by 
+            # Pillow, whose decompression bomb check would refuse them)
+            try:
+                utils.probe_image(upload_path)
+            except OSError as e:
+                raise RequestError(HTTPStatus.BAD_REQUEST, f"Unreadable image: {e}")
+
+            key = utils.export_key(digest, recipe, options)
+            hit = self.server.jobs.cache.touch(key)
+            if not hit:
+                try:
+                    job = self.server.jobs.submit(key, upload_path, recipe, options)
+                except QueueFull:
+                    raise RequestError(HTTPStatus.SERVICE_UNAVAILABLE, "Too many corrections waiting")
+                status = self.server.jobs.wait(job.id)
+                if status is None or status["state"] != DONE:
+                    error = status["error"] if status else "job expired"
+                    raise RequestError(HTTPStatus.INTERNAL_SERVER_ERROR,
+                                       f"Correction failed: {error}")
+        finally:
+            store.close()
+
+        f = self.server.jobs.cache.open(key)
+        if f is None:
+            # Evicted right after it was written: the cache is too small
+            raise RequestError(HTTPStatus.SERVICE_UNAVAILABLE, "Result was evicted, retry")
+        with f:
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", utils.EXPORT_FORMATS[options["format"]][1])
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+            self.send_header("X-Export-Cache", "hit" if hit else "miss")
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, CHUNK_SIZE)
+
+    def _content_length(self):
+        if "Content-Length" not in self.headers:
+            raise RequestError(HTTPStatus.LENGTH_REQUIRED, "Content-Length required")
+        try:
+            length = int(self.headers["Content-Length"])
+        except ValueError:
+            raise RequestError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length")
+        if length <= 0:
+            raise RequestError(HTTPStatus.BAD_REQUEST, "Empty upload")
+        if length > self.server.max_upload_bytes:
+            raise RequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                               f"Uploads are limited to {self.server.max_upload_bytes} bytes")
+        return length
+
+    def _read_upload(self, store, length):
+        """
+        Streams the request body into the store, hashing it on the way.
+
+        Returns:
+        - tuple: (path of the upload, digest as by cache.digest_bytes())
+        """
+        digest = hashlib.sha256()
+        path = store.path("upload")
+        with open(path, "wb") as f:
+            remaining = length
+            while remaining:
+                chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise RequestError(HTTPStatus.BAD_REQUEST, "Incomplete upload")
+                digest.update(chunk)
+                f.write(chunk)
+                remaining -= len(chunk)
+        return path, digest.hexdigest()
+
+    def _send_error(self, status, message):
+        # The body of a refused request may not have been read: the
+        # connection cannot be reused
+        self.close_connection = True
+        headers = {"Connection": "close"}
+        if status == HTTPStatus.SERVICE_UNAVAILABLE:
+            headers["Retry-After"] = str(RETRY_AFTER_SECONDS)
+        body = json.dumps({"error": message}).encode()
+        self._send_body(status, body, "application/json", headers)
+
+    def _send_body(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class CorrectionServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server (a thread per connection, mostly waiting for its
+    job) in front of an export job manager.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, jobs=None, max_upload_bytes=None):
+        super().__init__(address, CorrectionHandler)
+        self.jobs = jobs or ExportJobManager()
+        self.max_upload_bytes = int(max_upload_bytes or os.environ.get(
+            "IMAGE_CORRECTION_MAX_UPLOAD_BYTES", DEFAULT_MAX_UPLOAD_BYTES
+        ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the image correction over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help=f"port to listen on (default: {DEFAULT_PORT})")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="concurrent corrections (default: half the CPUs)")
+    parser.add_argument("--queue", type=int, default=None,
+                        help="corrections waiting at most before requests are "
+                             "refused with 503 (default: 16)")
+    args = parser.parse_args(argv)
+
+    jobs = ExportJobManager(workers=args.workers, max_queue=args.queue)
+    server = CorrectionServer((args.host, args.port), jobs)
+    host, port = server.server_address[:2]
+    print(f"Serving image correction on http://{host}:{port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        jobs.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+File-backed storage for the images of one session (upload, full-resolution
+decode, preview, pyramid levels, cut image).
+
+Images are written to a per-session scratch directory and handed back as
+read-only PIL images (or NumPy arrays, for pixel formats Pillow cannot
+hold, e.g. 16-bit RGB) whose pixel memory *is* a memory mapping of the
+file.
+Their pages are loaded on access and, being clean file-backed pages, can be
+dropped by the OS again, so an idle session holds next to no resident
+memory. Cropping a mapped image (as the tiled export does) only touches the
+pages of the crop. Drawing on a mapped image makes Pillow copy it first.
+
+Every version of a slot is written to a file of its own, so that images
+still mapped from an earlier version stay valid. The old file is removed
+when the slot is replaced; where that fails because it is still mapped
+(Windows does not delete or replace mapped files), it is retried on later
+writes and when the store is closed.
+
+The directory is removed when the SessionStore is garbage collected (with
+the Streamlit session state that holds it) or at interpreter exit.
+Directories left behind by crashed processes are swept after
+STALE_SECONDS without a write or touch(); those of stores alive in the
+sweeping process are never swept.
+
+Configuration (environment variables):
+    IMAGE_CORRECTION_SCRATCH_DIR  base directory for session directories
+"""
+
+import itertools
+import os
+import shutil
+import tempfile
+import time
+import weakref
+
+import numpy as np
+from PIL import Image
+
+DEFAULT_SCRATCH_DIR = os.path.join(tempfile.gettempdir(), "image_correction_sessions")
+STALE_SECONDS = 24 * 3600
+# Rows copied per step when an image is written to its file
+COPY_BAND_ROWS = 256
+
+# Modes Pillow can map without copying; RGB is stored padded as RGBX
+# (which is how Pillow holds RGB in memory anyway)
+MAPPED_MODES = {
+    "L": "L", "RGBA": "RGBA", "RGBX": "RGBX", "RGB": "RGBX", 
+    "I;16": "I;16", "I;16L": "I;16", "I;16B": "I;16",
+}
+
+# Directories of the SessionStores alive in this process
+_live_directories = set()
+
+
+def _remove_directory(directory):
+    _live_directories.discard(os.path.abspath(directory))
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def sweep_stale(directory, max_age=STALE_SECONDS):
+    """
+    Removes session directories that have not been written to or touched
+    for max_age seconds, except those of stores alive in this process.
+    """
+    now = time.time()
+    for entry in os.scandir(directory):
+        if os.path.abspath(entry.path) in _live_directories:
+            continue
+        try:
+            if entry.is_dir() and now - entry.stat().st_mtime > max_age:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except FileNotFoundError:
+            pass
+
+
+class SessionStore:
+    """
+    Per-session scratch directory of uploads and memory-mapped images.
+    """
+
+    def __init__(self, base_directory=None):
+        base_directory = base_directory or os.environ.get(
+            "IMAGE_CORRECTION_SCRATCH_DIR", DEFAULT_SCRATCH_DIR
+        )
+        os.makedirs(base_directory, exist_ok=True)
+        sweep_stale(base_directory)
+        self.directory = tempfile.mkdtemp(prefix="session-", dir=base_directory)
+        _live_directories.add(os.path.abspath(self.directory))
+        self._names = itertools.count()
+        # Slot name -> current file; replaced files not removed yet
+        self._paths = {}
+        self._released = []
+        self._finalizer = weakref.finalize(self, _remove_directory, self.directory)
+
+    def touch(self):
+        """
+        Marks the session as in use, for sweep_stale() in other processes
+        (an idle session may not write for longer than STALE_SECONDS).
+        """
+        try:
+            os.utime(self.directory)
+        except FileNotFoundError:
+            pass
+
+    def path(self, name):
+        """
+        Returns:
+        - str: Path of the current file of a slot (of a new file, for a
+          slot that has not been written through the store)
+        """
+        return self._paths.get(name, os.path.join(self.directory, name))
+
+    def _replace(self, name, write):
+        # Written under a new name: mappings of the old file stay valid
+        # instead of being truncated, and no mapped file is replaced
+        path = os.path.join(self.directory, f"{name}.{next(self._names)}")
+        write(path)
+        old_path = self._paths.get(name)
+        self._paths[name] = path
+        if old_path is not None:
+            self._released.append(old_path)
+        self._remove_released()
+        os.utime(self.directory)
+        return path
+
+    def _remove_released(self):
+        # Files still mapped cannot be removed on Windows: kept for a retry
+        remaining = []
+        for path in self._released:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except PermissionError:
+                remaining.append(path)
+        self._released = remaining
+
+    def save_bytes(self, name, data):
+        """
+        Stores encoded data (e.g. the upload) in a file.
+
+        Returns:
+        - str: Path of the file
+        """
+        def write(path):
+            with open(path, "wb") as f:
+                f.write(data)
+        return self._replace(name, write)
+
+    def map_image(self, name, image):
+        """
+        Stores an image in a file and returns it memory-mapped.
+
+        Parameters:
+        - name (str): Slot name; a previous image of that name is replaced
+        - image (PIL.Image): Image to store; modes other than L, RGB, RGBX,
+          RGBA and I;16 are converted to RGBA
+
+        Returns:
+        - PIL.Image: Read-only image backed by the file (mode RGBX for RGB
+          input)
+        """
+        mode = MAPPED_MODES.get(image.mode, "RGBA")
+        width, height = image.size
+        if mode in ("RGBA", "RGBX"):
+            shape, dtype = (height, width, 4), np.uint8
+        else:
+            # I;16 is little-endian
+            shape, dtype = (height, width), "<u2" if mode == "I;16" else np.uint8
+
+        def fill(pixels):
+            # In bands, so that no full-size copy is made in memory
+            for top in range(0, height, COPY_BAND_ROWS):
+                band = image.crop((0, top, width, min(height, top + COPY_BAND_ROWS)))
+                if band.mode != mode and mode != "I;16":
+                    band = band.convert(mode)
+                # 16-bit data is byte-swapped by NumPy: Pillow's convert() 
+                # clips I;16B and I;16L to 8 bits
+                pixels[top:top + band.height] = np.asarray(band)
+
+        pixels = self.map_array(name, shape, dtype, fill)
+        return Image.frombuffer(mode, (width, height), pixels, "raw", mode, 0, 1)
+
+    def map_array(self, name, shape, dtype, fill):
+        """
+        Stores an array in a file and returns it memory-mapped, for pixel 
+        data Pillow cannot map (e.g. 16-bit RGB).
+
+        Parameters:
+        - name (str): Slot name; a previous array of that name is replaced
+        - shape (tuple): Shape of the array
+        - dtype: NumPy dtype of the array
+        - fill (callable): Called with the (writable, zeroed) mapped array 
+          to write the data, preferably in bands
+
+        Returns:
+        - np.ndarray: Read-only array backed by the file
+        """
+        def write(path):
+            pixels = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+            fill(pixels)
+            pixels.flush()
+            del pixels
+
+        path = self._replace(name, write)
+        return np.load(path, mmap_mode="r")
+
+    def remove(self, name):
+        path = self._paths.pop(name, None)
+        if path is not None:
+            self._released.append(path)
+        self._remove_released()
+
+    def close(self):
+        """
+        Removes the directory now (mapped images stay readable until they
+        are released; on Windows, files still mapped are left for 
+        sweep_stale()).
+        """
+        self._finalizer()
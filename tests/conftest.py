@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""
+The modules of the app live at the top level of the repository.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Estimators of auto_correct.py on synthetic scans.
+"""
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+import auto_correct
+
+CORNERS = ((120, 90), (880, 130), (850, 720), (100, 690))
+
+
+def text_page(line_spacing, corners=CORNERS, size=(1000, 800)):
+    """
+    Bright page on a dark background, with lines of dark "words".
+    """
+    image = Image.new("L", size, 40)
+    draw = ImageDraw.Draw(image)
+    draw.polygon(corners, fill=230)
+    rng = np.random.default_rng(0)
+    for top in range(160, 650, line_spacing):
+        left = 180
+        while left < 760:
+            width = int(rng.integers(20, 70))
+            # Lines follow the tilt of the page's top edge
+            y = top + (left - 180) * 0.05
+            draw.rectangle((left, y, left + width, y + 10), fill=30)
+            left += width + 12
+    return image
+
+
+@pytest.mark.parametrize("line_spacing", [22, 40, 60, None])
+def test_detect_quad_on_text_page(line_spacing):
+    image = text_page(line_spacing) if line_spacing else text_page(10**4)
+
+    quad, confidence = auto_correct.detect_quad(image)
+
+    assert quad is not None, f"no quad, confidence {confidence:.3f}"
+    assert confidence >= auto_correct.QUAD_MIN_CONFIDENCE
+    # Within a pixel or two of the true corners at 2.5x the working size
+    assert np.abs(quad - np.array(CORNERS, dtype=float)).max() < 3
+
+
+def test_detect_quad_rejects_flat_image():
+    quad, confidence = auto_correct.detect_quad(Image.new("L", (400, 300), 128))
+
+    assert quad is None and confidence == 0.0
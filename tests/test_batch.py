@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+batch.py: outputs match the in-memory export, and reruns skip only the
+outputs made with the same settings.
+"""
+
+import io
+import json
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import batch
+import utils
+
+RECIPE = {"degrees": 2.5, "tone": {"gamma": 1.2}}
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    input_dir, output_dir = tmp_path / "in", tmp_path / "out"
+    input_dir.mkdir()
+    rng = np.random.default_rng(0)
+    for index in range(3):
+        pixels = rng.integers(0, 256, (60, 80, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(input_dir / f"scan{index}.png")
+    recipe_path = tmp_path / "recipe.json"
+    recipe_path.write_text(json.dumps(RECIPE))
+    return str(recipe_path), str(input_dir), str(output_dir)
+
+
+def statuses(results):
+    return sorted(status for _, status, _ in results)
+
+
+def test_outputs_match_export_image(dirs):
+    recipe_path, input_dir, output_dir = dirs
+
+    results = batch.run_batch(recipe_path, input_dir, output_dir, workers=1)
+
+    assert statuses(results) == ["done"] * 3
+    expected = io.BytesIO()
+    utils.export_image(Image.open(os.path.join(input_dir, "scan0.png")), RECIPE, expected)
+    with open(os.path.join(output_dir, "scan0.png"), "rb") as f:
+        assert f.read() == expected.getvalue()
+
+
+def test_rerun_skips_only_unchanged_settings(dirs):
+    recipe_path, input_dir, output_dir = dirs
+    batch.run_batch(recipe_path, input_dir, output_dir, workers=1)
+
+    assert statuses(batch.run_batch(recipe_path, input_dir, output_dir, workers=1)) \
+        == ["skipped"] * 3
+    # Other export options or flags produce other outputs
+    changed = [
+        {"options": {"compress_level": 1}},
+        {"options": {"drop_opaque_alpha": False}},
+        {"auto_straighten": True},
+    ]
+    for arguments in changed:
+        results = batch.run_batch(recipe_path, input_dir, output_dir, workers=1, **arguments)
+        assert statuses(results) == ["done"] * 3, arguments
+    # An edited recipe as well
+    with open(recipe_path, "w") as f:
+        json.dump(dict(RECIPE, degrees=3), f)
+    assert statuses(batch.run_batch(recipe_path, input_dir, output_dir, workers=1)) \
+        == ["done"] * 3
+
+
+def test_newer_input_is_redone(dirs):
+    recipe_path, input_dir, output_dir = dirs
+    batch.run_batch(recipe_path, input_dir, output_dir, workers=1)
+    output_mtime = os.path.getmtime(os.path.join(output_dir, "scan1.png"))
+    os.utime(os.path.join(input_dir, "scan1.png"), (output_mtime + 10, output_mtime + 10))
+
+    results = dict((name, status) for name, status, _ in 
+                   batch.run_batch(recipe_path, input_dir, output_dir, workers=1))
+
+    assert results == {"scan0.png": "skipped", "scan1.png": "done", "scan2.png": "skipped"}
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Preview and export caches (cache.py).
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from cache import ExportCache, PreviewCache
+
+
+def test_preview_cache_computes_once():
+    cache = PreviewCache(max_bytes=1000)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return np.zeros(10, dtype=np.uint8)
+
+    first = cache.get_or_compute(("render", "digest", 1), compute)
+    second = cache.get_or_compute(("render", "digest", 1), compute)
+
+    assert first is second and len(calls) == 1
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_preview_cache_evicts_least_recently_used():
+    cache = PreviewCache(max_bytes=250)
+    for name in ("a", "b"):
+        cache.get_or_compute((name,), lambda: bytes(100))
+    # A hit makes "a" the most recently used entry
+    cache.get_or_compute(("a",), lambda: bytes(100))
+    cache.get_or_compute(("c",), lambda: bytes(100))
+
+    assert ("a",) in cache and ("c",) in cache and ("b",) not in cache
+    assert cache.stats()["bytes"] == 200 and cache.stats()["evictions"] == 1
+
+
+def test_preview_cache_skips_oversized_values():
+    cache = PreviewCache(max_bytes=50)
+
+    assert cache.get_or_compute(("big",), lambda: bytes(100)) == bytes(100)
+    assert ("big",) not in cache and cache.stats()["bytes"] == 0
+
+
+def test_export_key_depends_on_image_and_params(tmp_path):
+    cache = ExportCache(str(tmp_path))
+
+    key = cache.key("digest", {"degrees": 1.0, "format": "PNG"})
+
+    assert key == cache.key("digest", {"format": "PNG", "degrees": 1.0})
+    assert key != cache.key("other", {"degrees": 1.0, "format": "PNG"})
+    assert key != cache.key("digest", {"degrees": 2.0, "format": "PNG"})
+
+
+def test_export_cache_failed_write_leaves_no_entry(tmp_path):
+    cache = ExportCache(str(tmp_path))
+
+    with pytest.raises(RuntimeError):
+        with cache.writer("key") as f:
+            f.write(b"partial")
+            raise RuntimeError("encoder failed")
+
+    assert cache.get("key") is None and os.listdir(tmp_path) == []
+
+
+def test_export_cache_evicts_least_recently_used(tmp_path):
+    cache = ExportCache(str(tmp_path))
+    for age, key in enumerate(("old", "used", "new")):
+        cache.put(key, bytes(100))
+        os.utime(cache.path(key), (1000 + age, 1000 + age))
+    cache.touch("old")
+
+    cache.max_bytes = 250
+    cache.evict()
+
+    assert cache.get("used") is None
+    assert cache.get("old") == bytes(100) and cache.get("new") == bytes(100)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Tiled export (export_tiled()) against the in-memory export it replaces
+for large images, within the tolerance documented in export_tiled():
+±1 per channel, colour channels of fully transparent pixels ignored.
+"""
+
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import utils
+
+RECIPE = utils.normalize_recipe({
+    "degrees": 6.5,
+    "warp_offsets": {"tl_x": 0.03, "tr_y": 0.02, "br_x": -0.02, "bl_y": -0.01},
+    "cut_to_rect": True,
+    "rect_margins": {"left": 0.05, "right": 0.08, "top": 0.04, "bottom": 0.06},
+    "watermark_enabled": True,
+    "watermark_text": "© Test",
+    "tone": {"brightness": 0.05, "contrast": 1.2, "gamma": 0.9,
+             "levels": {"r": [10, 240], "g": [0, 250], "b": [5, 255]}},
+})
+
+
+def scan(mode, size=(1100, 800)):
+    # Smooth gradients plus noise: interpolation errors show, but stay
+    # within rounding
+    width, height = size
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    bands = [(x * 255 // width), (y * 255 // height), ((x + y) * 127 // (width + height))]
+    pixels = np.dstack(bands + [np.full((height, width), 200)]).astype(np.int32)
+    pixels = np.clip(pixels + rng.integers(-8, 9, pixels.shape), 0, 255).astype(np.uint8)
+    return Image.fromarray(pixels, "RGBA").convert(mode)
+
+
+def export(image, tiled, image_format):
+    data = io.BytesIO()
+    utils.export_image(image, RECIPE, data, tiled=tiled,
+                       options=utils.normalize_export_options({"format": image_format}))
+    decoded = Image.open(io.BytesIO(data.getvalue()))
+    return decoded.mode, np.asarray(decoded)
+
+
+@pytest.mark.parametrize("image_format", ["PNG", "TIFF"])
+@pytest.mark.parametrize("mode", ["L", "LA", "RGB", "RGBA"])
+def test_tiled_matches_in_memory_export(mode, image_format):
+    image = scan(mode)
+
+    tiled_mode, tiled = export(image, True, image_format)
+    memory_mode, memory = export(image, False, image_format)
+
+    assert tiled_mode == memory_mode and tiled.shape == memory.shape
+    difference = np.abs(tiled.astype(np.int32) - memory.astype(np.int32))
+    if tiled_mode in ("LA", "RGBA"):
+        assert np.array_equal(tiled[..., -1], memory[..., -1])
+        difference[memory[..., -1] == 0] = 0
+    assert difference.max() <= 1
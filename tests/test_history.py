@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Undo/redo history and preview snapshots (history.py).
+"""
+
+from PIL import Image
+
+import history
+
+
+class State(dict):
+    # Attribute and item access, like st.session_state
+    __getattr__ = dict.__getitem__
+    __setattr__ = dict.__setitem__
+
+
+def new_state():
+    state = State({key: 0.0 for key in history.HISTORY_KEYS})
+    state.update(cut_to_rect=False, watermark_enabled=False, watermark_text="",
+                 tone_levels_r=(0, 255), tone_levels_g=(0, 255), tone_levels_b=(0, 255),
+                 history=[], history_index=0)
+    return state
+
+
+def test_undo_and_redo_restore_recorded_states():
+    state = new_state()
+    assert history.record(state)
+    state.degrees = 1.0
+    assert history.record(state)
+    state.degrees = 2.0
+    state.watermark_text = "Test"
+    assert history.record(state)
+    assert not history.record(state)
+
+    history.undo(state)
+    assert (state.degrees, state.watermark_text) == (1.0, "")
+    history.undo(state)
+    assert state.degrees == 0.0 and not history.can_undo(state)
+    history.redo(state)
+    history.redo(state)
+    assert (state.degrees, state.watermark_text) == (2.0, "Test")
+    assert not history.can_redo(state)
+
+
+def test_change_after_undo_drops_redo():
+    state = new_state()
+    history.reset(state)
+    for degrees in (1.0, 2.0):
+        state.degrees = degrees
+        history.record(state)
+    history.undo(state)
+
+    state.degrees = 5.0
+    history.record(state)
+
+    assert [entry["degrees"] for entry in state.history] == [0.0, 1.0, 5.0]
+    assert not history.can_redo(state)
+
+
+def test_history_is_bounded():
+    state = new_state()
+    history.reset(state)
+    for degrees in range(1, 11):
+        state.degrees = float(degrees)
+        history.record(state, max_history=4)
+
+    assert [entry["degrees"] for entry in state.history] == [7.0, 8.0, 9.0, 10.0]
+    assert state.history_index == 3
+
+
+def test_snapshot_round_trips():
+    image = Image.new("RGBA", (30, 20), (10, 20, 30, 128))
+
+    decoded = history.decode_snapshot(history.encode_snapshot(image))
+
+    assert decoded.mode == "RGBA" and decoded.tobytes() == image.tobytes()
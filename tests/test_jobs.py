@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Export jobs on a spawned process pool (jobs.py).
+"""
+
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import utils
+from cache import ExportCache
+from jobs import DONE, ExportJobManager
+from session_store import SessionStore
+
+RECIPE = utils.normalize_recipe({"degrees": 4, "watermark_enabled": True, 
+                                 "watermark_text": "Test"})
+OPTIONS = utils.normalize_export_options({"format": "PNG"})
+
+
+@pytest.fixture
+def jobs(tmp_path):
+    manager = ExportJobManager(workers=1, max_queue=4, directory=str(tmp_path / "jobs"),
+                               cache=ExportCache(str(tmp_path / "exports")))
+    yield manager
+    manager.shutdown()
+
+
+def scan(path, seed):
+    rng = np.random.default_rng(seed)
+    image = Image.fromarray(rng.integers(0, 256, (90, 120, 3), dtype=np.uint8))
+    image.save(path)
+    return image
+
+
+def test_job_exports_into_cache(jobs, tmp_path):
+    image = scan(tmp_path / "upload.png", 0)
+    job = jobs.submit("key", str(tmp_path / "upload.png"), RECIPE, OPTIONS)
+
+    status = jobs.wait(job.id, timeout=120)
+
+    assert status["state"] == DONE and status["progress"] == 1.0
+    expected = io.BytesIO()
+    utils.export_image(image, RECIPE, expected, options=OPTIONS)
+    assert jobs.cache.get("key") == expected.getvalue()
+
+
+def test_job_survives_replaced_and_removed_upload(jobs, tmp_path):
+    # A session that submitted a shared job may upload another image, or 
+    # end, before the worker has opened the file
+    store = SessionStore(str(tmp_path / "sessions"))
+    image = scan(tmp_path / "first.png", 1)
+    scan(tmp_path / "second.png", 2)
+    upload_path = store.save_bytes("upload", (tmp_path / "first.png").read_bytes())
+    first = jobs.submit("first", upload_path, RECIPE, OPTIONS)
+    second = jobs.submit("second", upload_path, RECIPE, OPTIONS)
+    store.save_bytes("upload", (tmp_path / "second.png").read_bytes())
+    store.close()
+
+    assert jobs.wait(first.id, timeout=120)["state"] == DONE
+    assert jobs.wait(second.id, timeout=120)["state"] == DONE
+    expected = io.BytesIO()
+    utils.export_image(image, RECIPE, expected, options=OPTIONS)
+    assert jobs.cache.get("second") == expected.getvalue()
+
+
+def test_same_key_shares_job(jobs, tmp_path):
+    scan(tmp_path / "upload.png", 3)
+
+    first = jobs.submit("shared", str(tmp_path / "upload.png"), RECIPE, OPTIONS)
+    second = jobs.submit("shared", str(tmp_path / "upload.png"), RECIPE, OPTIONS)
+
+    assert first is second and first.subscribers == 2
+    assert jobs.wait(first.id, timeout=120)["state"] == DONE
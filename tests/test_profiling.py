@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Stage records and metrics of profiling.py.
+"""
+
+import os
+import tracemalloc
+
+import numpy as np
+
+import profiling
+
+
+def test_collector_records_nested_stages():
+    records = []
+    profiling.set_collector(records)
+    try:
+        with profiling.stage("outer", b"1234"):
+            with profiling.stage("inner") as stage:
+                stage.output(np.ones(10**5))
+            # Traced only while stages run
+            assert tracemalloc.is_tracing()
+        profiling.event("preview:test", True)
+    finally:
+        profiling.set_collector(None)
+
+    assert not tracemalloc.is_tracing()
+    inner, outer, event = records
+    assert (inner["stage"], inner["depth"], inner["output"]) == ("inner", 1, "100000 float64")
+    assert inner["allocated"] >= 8 * 10**5
+    assert (outer["stage"], outer["depth"], outer["input"]) == ("outer", 0, "4 bytes")
+    assert event["cache"] == "preview:test" and event["hit"] is True
+
+
+def test_stage_is_a_no_op_when_off(monkeypatch):
+    monkeypatch.setattr(profiling, "ENABLED", False)
+    assert not profiling.enabled()
+    with profiling.stage("off") as stage:
+        assert stage.output(1) == 1
+    assert not tracemalloc.is_tracing()
+
+
+def test_metrics_file_per_process(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "METRICS_PATH", str(tmp_path / "metrics.prom"))
+    path = profiling.process_metrics_path()
+    assert path == str(tmp_path / f"metrics.{os.getpid()}.prom")
+
+    records = []
+    profiling.set_collector(records)
+    try:
+        with profiling.stage("metrics_test"):
+            pass
+    finally:
+        profiling.set_collector(None)
+
+    with open(path) as f:
+        text = f.read()
+    assert f'image_correction_stage_calls_total{{pid="{os.getpid()}",stage="metrics_test"}} 1' \
+        in text
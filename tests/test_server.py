@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+server.py on localhost: corrections through a real export job pool, and
+the error statuses.
+"""
+
+import http.client
+import io
+import json
+import threading
+import urllib.parse
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import server
+import utils
+from cache import ExportCache
+from jobs import ExportJobManager, QueueFull
+
+RECIPE = {
+    "degrees": 3,
+    "cut_to_rect": True,
+    "rect_margins": {"left": 0.1, "right": 0.1, "top": 0.1, "bottom": 0.1},
+}
+
+
+class FullJobManager(ExportJobManager):
+    # Refuses before the upload is read
+    def full(self):
+        return True
+
+
+class RacingJobManager(ExportJobManager):
+    # The queue fills up between the check and the submission
+    def submit(self, *args, **kwargs):
+        raise QueueFull("queue filled up")
+
+
+class ExpiringJobManager(ExportJobManager):
+    # The job is pruned before its result is looked up
+    def submit(self, key, *args, **kwargs):
+        return type("Job", (), {"id": -1, "key": key})()
+
+
+@pytest.fixture(scope="module")
+def cache(tmp_path_factory):
+    # Not the default cache: the server must use its job manager's
+    return ExportCache(str(tmp_path_factory.mktemp("exports")))
+
+
+def serve(jobs):
+    httpd = server.CorrectionServer(("127.0.0.1", 0), jobs)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+@pytest.fixture(scope="module")
+def address(cache):
+    jobs = ExportJobManager(workers=1, max_queue=2, cache=cache)
+    httpd = serve(jobs)
+    yield httpd.server_address[:2]
+    httpd.shutdown()
+    httpd.server_close()
+    jobs.shutdown()
+
+
+@pytest.fixture
+def serve_with(cache):
+    servers = []
+
+    def start(manager_class):
+        jobs = manager_class(workers=1, max_queue=1, cache=cache)
+        httpd = serve(jobs)
+        servers.append((httpd, jobs))
+        return httpd.server_address[:2]
+    yield start
+    for httpd, jobs in servers:
+        httpd.shutdown()
+        httpd.server_close()
+        jobs.shutdown()
+
+
+@pytest.fixture(scope="module")
+def image():
+    rng = np.random.default_rng(0)
+    return Image.fromarray(rng.integers(0, 256, (120, 160, 3), dtype=np.uint8))
+
+
+@pytest.fixture(scope="module")
+def upload(image):
+    data = io.BytesIO()
+    image.save(data, format="PNG")
+    return data.getvalue()
+
+
+def request(address, method, path, body=None):
+    connection = http.client.HTTPConnection(*address, timeout=120)
+    try:
+        connection.request(method, path, body=body)
+        response = connection.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        connection.close()
+
+
+def correct_path(recipe=RECIPE, **options):
+    return "/correct?" + urllib.parse.urlencode({"recipe": json.dumps(recipe), **options})
+
+
+@pytest.mark.parametrize("image_format", ["PNG", "JPEG"])
+def test_correct_matches_local_export(address, image, upload, image_format):
+    status, headers, body = request(address, "POST", correct_path(format=image_format), upload)
+
+    assert status == 200
+    assert headers["Content-Type"] == utils.EXPORT_FORMATS[image_format][1]
+    expected = io.BytesIO()
+    utils.export_image(image, RECIPE, expected, options={"format": image_format})
+    assert body == expected.getvalue()
+
+    # Served from the export cache the second time
+    status, headers, again = request(address, "POST", correct_path(format=image_format), upload)
+    assert status == 200 and headers["X-Export-Cache"] == "hit" and again == body
+
+
+def test_health(address):
+    status, _, body = request(address, "GET", "/health")
+
+    assert status == 200
+    assert set(json.loads(body)) == {"workers", "max_queue", "running", "queued"}
+
+
+@pytest.mark.parametrize("path", [
+    "/correct?recipe=%7Bnot+json",
+    "/correct?recipe=%5B1%5D",
+    "/correct?format=BMP",
+    "/correct?quality=high&format=JPEG",
+])
+def test_invalid_parameters(address, upload, path):
+    status, _, body = request(address, "POST", path, upload)
+
+    assert status == 400
+    assert "error" in json.loads(body)
+
+
+def test_tiff_over_pillow_pixel_limit(address, image, monkeypatch):
+    # Decoded by tifffile, like the export job does: Pillow's 
+    # decompression bomb check must not refuse it
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    data = io.BytesIO()
+    image.save(data, format="TIFF")
+
+    status, _, body = request(address, "POST", correct_path(format="PNG"), data.getvalue())
+
+    assert status == 200
+    assert body.startswith(b"\x89PNG")
+
+
+def test_unreadable_and_empty_uploads(address):
+    assert request(address, "POST", correct_path(), b"not an image")[0] == 400
+    assert request(address, "POST", correct_path(), b"")[0] == 400
+
+
+def test_unknown_endpoint(address, upload):
+    assert request(address, "POST", "/jobs/1", upload)[0] == 404
+    assert request(address, "GET", "/jobs/1")[0] == 404
+
+
+def test_unknown_job_id(cache):
+    jobs = ExportJobManager(workers=1, max_queue=1, cache=cache)
+
+    assert jobs.get(12345) is None
+    assert jobs.status(12345) is None
+    assert jobs.wait(12345, timeout=0) is None
+
+
+def test_expired_job(serve_with, upload):
+    address = serve_with(ExpiringJobManager)
+
+    status, _, body = request(address, "POST", correct_path({"degrees": 7}), upload)
+
+    assert status == 500
+    assert "job expired" in json.loads(body)["error"]
+
+
+@pytest.mark.parametrize("manager_class", [FullJobManager, RacingJobManager])
+def test_full_queue(serve_with, upload, manager_class):
+    address = serve_with(manager_class)
+
+    status, headers, _ = request(address, "POST", correct_path({"degrees": 11}), upload)
+
+    assert status == 503
+    assert headers["Retry-After"] == str(server.RETRY_AFTER_SECONDS)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped session images (session_store.py).
+"""
+
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import session_store
+from session_store import SessionStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SessionStore(str(tmp_path))
+    yield store
+    store.close()
+
+
+def test_replaced_image_stays_readable(store):
+    first = store.map_image("preview", Image.new("RGB", (40, 30), (10, 20, 30)))
+    first_path = store.path("preview")
+    second = store.map_image("preview", Image.new("RGB", (40, 30), (200, 100, 0)))
+
+    assert store.path("preview") != first_path
+    assert not os.path.exists(first_path)
+    assert first.getpixel((5, 5))[:3] == (10, 20, 30)
+    assert second.getpixel((5, 5))[:3] == (200, 100, 0)
+
+
+def test_mapped_file_is_removed_once_released(store, monkeypatch):
+    # As on Windows: a mapped file can be neither removed nor replaced
+    mapped = set()
+    remove = os.remove
+
+    def remove_unless_mapped(path):
+        if path in mapped:
+            raise PermissionError(path)
+        remove(path)
+
+    monkeypatch.setattr(session_store.os, "remove", remove_unless_mapped)
+    store.map_image("cut", Image.new("L", (8, 8), 1))
+    mapped.add(store.path("cut"))
+    first_path = store.path("cut")
+    assert store.map_image("cut", Image.new("L", (8, 8), 2)).getpixel((0, 0)) == 2
+    assert os.path.exists(first_path)
+
+    mapped.clear()
+    store.save_bytes("upload", b"data")
+    assert not os.path.exists(first_path)
+
+
+def test_16_bit_image_round_trips(store):
+    pixels = np.arange(64, dtype="<u2").reshape(8, 8) * 1000
+    image = store.map_image("orig", Image.frombytes("I;16", (8, 8), pixels.tobytes()))
+
+    assert image.mode == "I;16"
+    assert np.array_equal(np.asarray(image), pixels)
+
+
+def test_sweep_keeps_live_and_touched_sessions(tmp_path):
+    live = SessionStore(str(tmp_path))
+    touched = SessionStore(str(tmp_path))
+    dead = SessionStore(str(tmp_path))
+    dead_directory = dead.directory
+    # As if left behind by another process
+    dead._finalizer.detach()
+    session_store._live_directories.discard(os.path.abspath(dead_directory))
+    touched._finalizer.detach()
+    session_store._live_directories.discard(os.path.abspath(touched.directory))
+    old = os.path.getmtime(live.directory) - 2 * session_store.STALE_SECONDS
+    for directory in (live.directory, touched.directory, dead_directory):
+        os.utime(directory, (old, old))
+    touched.touch()
+
+    session_store.sweep_stale(str(tmp_path))
+
+    assert os.path.isdir(live.directory) and os.path.isdir(touched.directory)
+    assert not os.path.exists(dead_directory)
+    live.close()
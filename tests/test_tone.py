@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Tone adjustments (normalize_tone(), tone_lut(), tone_from_state()).
+"""
+
+import numpy as np
+import pytest
+
+import utils
+
+
+def test_neutral_tone_has_no_lut():
+    assert utils.normalize_tone(None) == utils.DEFAULT_TONE
+    assert utils.tone_lut({}) is None
+
+
+@pytest.mark.parametrize("tone", [
+    {"brightness": 1.5}, {"contrast": -0.1}, {"gamma": 0}, 
+    {"levels": {"r": [200, 100]}}, {"levels": {"g": [0, 256]}},
+])
+def test_invalid_tone_is_rejected(tone):
+    with pytest.raises(ValueError):
+        utils.normalize_tone(tone)
+
+
+def test_levels_stretch_per_channel_and_keep_alpha():
+    lut = utils.tone_lut({"levels": {"r": [50, 150]}}, channels=4)
+
+    assert lut.shape == (4, 256) and lut.dtype == np.uint8
+    assert (lut[0, 50], lut[0, 100], lut[0, 150], lut[0, 200]) == (0, 128, 255, 255)
+    assert np.array_equal(lut[1], np.arange(256))
+    assert np.array_equal(lut[3], np.arange(256))
+
+
+def test_brightness_contrast_and_gamma():
+    brighter = utils.tone_lut({"brightness": 0.1}, channels=1)[0]
+    flatter = utils.tone_lut({"contrast": 0.5}, channels=1)[0]
+    lighter = utils.tone_lut({"gamma": 2.0}, channels=1)[0]
+
+    assert brighter[0] == 26 and brighter[250] == 255
+    assert (flatter[0], flatter[255]) == (64, 191)
+    assert lighter[64] > 64 and (lighter[0], lighter[255]) == (0, 255)
+
+
+def test_16_bit_lut_scales_levels():
+    # 51 of 255 is 13107 of 65535
+    lut = utils.tone_lut({"levels": {channel: [0, 51] for channel in "rgb"}}, 
+                         channels=1, dtype=np.uint16)
+
+    assert lut.shape == (1, 65536) and lut.dtype == np.uint16
+    assert lut[0, 13106] == 65530 and lut[0, 13107] == 65535
+
+
+def test_tone_from_state_separates_meeting_levels():
+    tone = utils.tone_from_state({"tone_levels_r": (255, 255), "tone_levels_g": (80, 80),
+                                  "tone_contrast": 1.5})
+
+    assert tone["levels"]["r"] == [254, 255] and tone["levels"]["g"] == [80, 81]
+    assert tone["levels"]["b"] == [0, 255] and tone["contrast"] == 1.5
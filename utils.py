@@ -5,55 +5,183 @@ Created on Sat Feb 21 13:18:11 2026
 @author: Wolfgang Reuter
 """
 
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 import os
 import io 
+import functools
+import itertools
+import json
+import math
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np 
-from skimage.transform import  ProjectiveTransform, warp
+from skimage.transform import  ProjectiveTransform
 import streamlit as st
+import tifffile
 
-@st.cache_data
-def resize_image(image_bytes, max_size):
-    image = Image.open(io.BytesIO(image_bytes)).convert("RGBA")
-    resized_img, resized, scale_factor = resize_if_needed(image, max_size)
-    return resized_img, resized, scale_factor 
+import profiling
+from cache import export_cache, preview_cache
+from session_store import MAPPED_MODES
 
-@st.cache_data
-def transform_image(image, degrees, warp_offsets):
-    img = rotate(image, degrees).convert("RGBA")
-    img_array = np.array(img)
-    h, w = img_array.shape[:2]
+# Side length of the output tiles resampled by export_tiled()
+EXPORT_TILE_SIZE = 512
+# Full-resolution exports above this many output pixels are tiled
+TILED_EXPORT_MIN_PIXELS = 16_000_000
+# Longer side of the coarsest preview pyramid level
+PYRAMID_MIN_SIZE = 250
+# Threads and rows per work item used by warp_array()
+WARP_THREADS = os.cpu_count() or 1
+WARP_CHUNK_ROWS = 64
 
-    src = np.array([[0, 0], [w, 0], [w, h], [0, h]])
+_warp_pools = {}
 
-    dst = np.array([
-        [warp_offsets["tl_x"] * w, warp_offsets["tl_y"] * h],
-        [w + warp_offsets["tr_x"] * w, warp_offsets["tr_y"] * h],
-        [w + warp_offsets["br_x"] * w, h + warp_offsets["br_y"] * h],
-        [warp_offsets["bl_x"] * w, h + warp_offsets["bl_y"] * h]
-    ])
+# Resolved relative to this file, so that batch.py works from any directory
+FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts", "DejaVuSans.ttf")
 
-    transform = ProjectiveTransform()
-    transform.estimate(dst, src)
+# Version of the recipe format written by save_recipe()
+RECIPE_VERSION = 1
+WARP_KEYS = ("tl_x", "tl_y", "tr_x", "tr_y", "bl_x", "bl_y", "br_x", "br_y")
+RECT_SIDES = ("left", "right", "top", "bottom")
+LEVEL_CHANNELS = ("r", "g", "b")
+# Tone adjustments that leave the image unchanged
+DEFAULT_TONE = {
+    "brightness": 0.0,
+    "contrast": 1.0,
+    "gamma": 1.0,
+    "levels": {channel: [0, 255] for channel in LEVEL_CHANNELS},
+}
+
+# Output formats: file extension and MIME type
+EXPORT_FORMATS = {
+    "PNG": (".png", "image/png"),
+    "JPEG": (".jpg", "image/jpeg"),
+    "WEBP": (".webp", "image/webp"),
+    "TIFF": (".tif", "image/tiff"),
+}
+# Formats that keep 16 bits per channel
+LOSSLESS_FORMATS = ("PNG", "TIFF")
+DEFAULT_EXPORT_OPTIONS = {
+    "format": "PNG",
+    "quality": 90,          # JPEG and WebP, 1-100
+    "compress_level": 6,    # PNG and TIFF (deflate), 0-9
+    "drop_opaque_alpha": True,
+}
+
+# Pillow modes used as they are: (channels, dtype). Two and four channels 
+# include alpha; RGBX is how mapped RGB images are stored (X is dropped)
+NATIVE_MODES = {
+    "L": (1, np.uint8),
+    "LA": (2, np.uint8),
+    "RGB": (3, np.uint8),
+    "RGBX": (3, np.uint8),
+    "RGBA": (4, np.uint8),
+    "I;16": (1, np.uint16),
+    "I;16L": (1, np.uint16),
+    "I;16B": (1, np.uint16),
+}
+
+# ---------------------
+# Preview stages, cached in preview_cache by upload digest and parameters.
+# Without a key (image_key / digest None) they are computed uncached.
+# Cached results are shared: copy them before modifying in place.
+# ---------------------
+
+def _cached(key, compute):
+    if key is None:
+        return compute()
+    return preview_cache.get_or_compute(key, compute)
+
+
+def resize_image(image_bytes, max_size, digest=None):
+    """
+    Decodes an upload at preview size.
+
+    Parameters:
+    - image_bytes (bytes): Encoded image
+    - max_size (int): Maximum width and height of the preview
+    - digest (str): Upload digest (cache key)
+
+    Returns:
+    - tuple: (8-bit preview in the upload's channels, see 
+      decode_preview(), whether it was resized, scale factor)
+    """
+    def compute():
+        with profiling.stage("decode", image_bytes) as stage:
+            image, resized, scale_factor = decode_preview(image_bytes, max_size)
+            return stage.output(image), resized, scale_factor
+
+    key = None if digest is None else ("resize", digest, max_size)
+    resized_img, resized, scale_factor = _cached(key, compute)
+    return resized_img, resized, scale_factor 
+
+
+def transform_image(image, degrees, warp_offsets, image_key=None, tone=None):
+    """
+    Parameters:
+    - image (PIL.Image): Preview image
+    - degrees (float): Rotation angle
+    - warp_offsets (dict): Corner offsets, see perspective_matrix()
+    - image_key (hashable): Identifies the content of image, e.g. 
+      (upload digest, image size) for a pyramid level
+    - tone (dict): Tone adjustments, see tone_lut()
+    """
+    tone = normalize_tone(tone)
+    key = None if image_key is None else (
+        "transform", image_key, degrees, tuple(sorted(warp_offsets.items())),
+        json.dumps(tone, sort_keys=True)
+    )
+    return _cached(key, lambda: correct_image(image, degrees, warp_offsets, tone=tone))
 
-    warped = warp(
-        img_array,
-        transform,
-        output_shape=(h, w),
-        preserve_range=True
+
+def apply_watermark_permanent(warped_image, watermark_text, image_key=None):
+    if not watermark_text:
+        return warped_image
+    key = None if image_key is None else ("watermark", image_key, watermark_text)
+    return _cached(
+        key, lambda: add_watermark_to_image(warped_image.copy(), watermark_text)
     )
 
-    warped = warped.astype(np.uint8)
-    result = Image.fromarray(warped, mode="RGBA")
 
-    return result
+def build_pyramid(image, min_size=PYRAMID_MIN_SIZE):
+    """
+    Builds successively halved copies of a (preview) image.
 
+    Parameters:
+    - image (PIL.Image): Finest level
+    - min_size (int): Halving stops at the first level whose longer side 
+      is at most this
+
+    Returns:
+    - list: PIL images, finest first
+    """
+    levels = [image]
+    while max(levels[-1].size) > min_size and min(levels[-1].size) >= 2:
+        levels.append(levels[-1].reduce(2))
+    return levels
+
+
+def pyramid_level(pyramid, display_width):
+    """
+    Index of the coarsest pyramid level that is still at least 
+    display_width wide (the finest level if none is).
+    """
+    for index in range(len(pyramid) - 1, 0, -1):
+        if pyramid[index].width >= display_width:
+            return index
+    return 0
+
+
+def pyramid_level_for_size(pyramid, max_size):
+    """
+    Finest pyramid level whose longer side is at most max_size (the 
+    coarsest level if none is), e.g. for analysis at a working resolution.
+    """
+    for level in pyramid:
+        if max(level.size) <= max_size:
+            return level
+    return pyramid[-1]
 
-@st.cache_data
-def apply_watermark_permanent(warped_image, watermark_text):
-    if watermark_text:
-        return add_watermark_to_image(warped_image.copy(), watermark_text)
-    return warped_image
 
 def resize_if_needed(image, max_size):
     original_width, original_height = image.size
@@ -89,112 +217,1665 @@ def rotate(image: Image.Image, degrees: float):
     return image.rotate(degrees, expand=True)
 
 
-def add_watermark_to_image(image, watermark_text):
-    image = image.convert("RGBA")
-    
-    # Try to load a TTF font, fallback to default if not found
-    font_path = os.path.join("fonts", "DejaVuSans.ttf")
-    diagonal = (image.size[0]**2 + image.size[1]**2)**0.5
-    font_size = int(diagonal / 12)
-    font = ImageFont.truetype(font_path, font_size)
-    
-    watermark_layer = Image.new("RGBA", image.size, (255, 255, 255, 0))
-    draw = ImageDraw.Draw(watermark_layer)
-    
-    # Use textbbox instead of textsize
-    bbox = draw.textbbox((0, 0), watermark_text, font=font)
-    text_width = bbox[2] - bbox[0]
-    text_height = bbox[3] - bbox[1]
-    
-    x = (image.width - text_width) / 2
-    y = (image.height - text_height) / 2
-    
-    # Draw diagonal watermark
-    temp_layer = Image.new("RGBA", image.size, (255, 255, 255, 0))
-    temp_draw = ImageDraw.Draw(temp_layer)
-    temp_draw.text((x, y), watermark_text, fill=(255, 255, 255, 50), font=font)
-    temp_layer = temp_layer.rotate(45, resample=Image.BICUBIC, center=(image.width/2, image.height/2))
-    
-    combined = Image.alpha_composite(image, temp_layer)
-    return combined
+def rotation_matrix(size, degrees):
+    """
+    Builds the inverse map of ``Image.rotate(degrees, expand=True)``.
 
-def prepare_orig_image():
-    # Make a copy of the original full-res image
-    orig_img = st.session_state.orig_image.copy()
+    The arithmetic mirrors Pillow's own (including the rounding of the 
+    sine and cosine and the size of the expanded canvas), so resampling 
+    with this matrix gives the same geometry as calling rotate().
 
-    # ---------------------
-    # Apply rotation
-    # ---------------------
-    if st.session_state.degrees != 0:
-        orig_img = rotate(orig_img, st.session_state.degrees).convert("RGBA")
+    Parameters:
+    - size (tuple): (width, height) of the input image
+    - degrees (float): Rotation angle, counter-clockwise
 
-    # ---------------------
-    # Apply trapezoidal warp
-    # ---------------------
-    img_array = np.array(orig_img)
-    h, w = img_array.shape[:2]
-    scale_w = w / st.session_state.image.width
-    scale_h = h / st.session_state.image.height
+    Returns:
+    - np.ndarray: 3x3 matrix mapping pixel indices of the rotated canvas 
+      to pixel indices of the input image
+    - tuple: (width, height) of the rotated canvas
+    """
+    w, h = size
+    angle = degrees % 360.0
+    if angle == 0:
+        return np.eye(3), (w, h)
+    # Pillow transposes for right angles (no interpolation, no half-pixel 
+    # shift when width and height differ by an odd number)
+    if angle == 90:
+        return np.array([[0, -1, w - 1], [1, 0, 0], [0, 0, 1]], dtype=float), (h, w)
+    if angle == 180:
+        return np.array([[-1, 0, w - 1], [0, -1, h - 1], [0, 0, 1]], dtype=float), (w, h)
+    if angle == 270:
+        return np.array([[0, 1, 0], [-1, 0, h - 1], [0, 0, 1]], dtype=float), (h, w)
+
+    angle = -math.radians(angle)
+    a = round(math.cos(angle), 15)
+    b = round(math.sin(angle), 15)
+    d = round(-math.sin(angle), 15)
+    e = round(math.cos(angle), 15)
+
+    cx, cy = w / 2, h / 2
+    c = a * -cx + b * -cy + cx
+    f = d * -cx + e * -cy + cy
+
+    xx = [a * x + b * y + c for x, y in ((0, 0), (w, 0), (w, h), (0, h))]
+    yy = [d * x + e * y + f for x, y in ((0, 0), (w, 0), (w, h), (0, h))]
+    nw = math.ceil(max(xx)) - math.floor(min(xx))
+    nh = math.ceil(max(yy)) - math.floor(min(yy))
+
+    tx, ty = -(nw - w) / 2.0, -(nh - h) / 2.0
+    c, f = a * tx + b * ty + c, d * tx + e * ty + f
+
+    # Pillow samples at pixel centres (index + 0.5), skimage at the indices
+    affine = np.array([[a, b, c], [d, e, f], [0, 0, 1]])
+    to_centre = np.array([[1, 0, 0.5], [0, 1, 0.5], [0, 0, 1]])
+    from_centre = np.array([[1, 0, -0.5], [0, 1, -0.5], [0, 0, 1]])
+    return from_centre @ affine @ to_centre, (nw, nh)
+
+
+def perspective_matrix(size, warp_offsets):
+    """
+    Builds the inverse map of the four-corner (trapezoidal) warp.
+
+    Parameters:
+    - size (tuple): (width, height) of the image to be warped
+    - warp_offsets (dict): Corner offsets (tl_x, tl_y, tr_x, ...) as 
+      fractions of width and height
+
+    Returns:
+    - np.ndarray: 3x3 matrix mapping output pixel indices to input pixel 
+      indices
+    """
+    w, h = size
 
     src = np.array([[0, 0], [w, 0], [w, h], [0, h]])
     dst = np.array([
-        [
-            st.session_state.warp_tl_x_offset * st.session_state.image.width * scale_w,
-            st.session_state.warp_tl_y_offset * st.session_state.image.height * scale_h,
-        ],
-        [
-            w + st.session_state.warp_tr_x_offset * st.session_state.image.width * scale_w,
-            st.session_state.warp_tr_y_offset * st.session_state.image.height * scale_h,
-        ],
-        [
-            w + st.session_state.warp_br_x_offset * st.session_state.image.width * scale_w,
-            h + st.session_state.warp_br_y_offset * st.session_state.image.height * scale_h,
-        ],
-        [
-            st.session_state.warp_bl_x_offset * st.session_state.image.width * scale_w,
-            h + st.session_state.warp_bl_y_offset * st.session_state.image.height * scale_h,
-        ],
+        [warp_offsets["tl_x"] * w, warp_offsets["tl_y"] * h],
+        [w + warp_offsets["tr_x"] * w, warp_offsets["tr_y"] * h],
+        [w + warp_offsets["br_x"] * w, h + warp_offsets["br_y"] * h],
+        [warp_offsets["bl_x"] * w, h + warp_offsets["bl_y"] * h]
     ])
 
     transform = ProjectiveTransform()
     transform.estimate(dst, src)
-    warped = warp(img_array, transform, output_shape=(h, w))
-    orig_img = Image.fromarray((warped * 255).astype(np.uint8))
+    return transform.params
+
+
+def correction_matrix(size, degrees, warp_offsets):
+    """
+    Composes rotation and trapezoidal warp into a single homography.
+
+    Parameters:
+    - size (tuple): (width, height) of the input image
+    - degrees (float): Rotation angle
+    - warp_offsets (dict): Corner offsets as fractions of width and height
+
+    Returns:
+    - np.ndarray: 3x3 matrix mapping output pixel indices to input pixel 
+      indices
+    - tuple: (width, height) of the output image
+    """
+    rot, out_size = rotation_matrix(size, degrees)
+    return rot @ perspective_matrix(out_size, warp_offsets), out_size
+
+
+def _interpolation_taps(coords, order, size):
+    """
+    Source indices and weights along one axis for warp_array().
+
+    Taps outside [0, size) get weight 0 (constant mode with cval=0) and a 
+    clipped index, so that they can be gathered safely.
+    """
+    if order == 0:
+        # Round half away from zero, like skimage
+        base = np.sign(coords) * np.floor(np.abs(coords) + 0.5)
+        taps = [(0, np.ones(coords.shape, dtype=np.float32))]
+    elif order == 1:
+        base = np.floor(coords)
+        t = (coords - base).astype(np.float32)
+        taps = [(0, 1 - t), (1, t)]
+    elif order == 3:
+        base = np.floor(coords)
+        t = (coords - base).astype(np.float32)
+        # Catmull-Rom weights, as used by skimage's bicubic interpolation
+        t2, t3 = t * t, t * t * t
+        taps = [
+            (-1, -0.5 * t3 + t2 - 0.5 * t),
+            (0, 1.5 * t3 - 2.5 * t2 + 1),
+            (1, -1.5 * t3 + 2 * t2 + 0.5 * t),
+            (2, 0.5 * t3 - 0.5 * t2),
+        ]
+    else:
+        raise ValueError(f"Unsupported interpolation order: {order}")
+
+    # Far-away coordinates only need to stay out of range
+    base = np.clip(base, -4, size + 4).astype(np.int32)
+    result = []
+    for shift, weight in taps:
+        index = base + shift
+        weight *= (index >= 0) & (index < size)
+        np.clip(index, 0, size - 1, out=index)
+        result.append((index, weight))
+    return result
+
+
+def _warp_rows(source, matrix, out, row_start, row_stop, order, lut, offset, mask):
+    h, w = source.shape[:2]
+    channels = source.shape[2] if source.ndim == 3 else 1
+    x0, y0 = offset
+    xs = np.arange(x0, x0 + out.shape[1], dtype=np.float64)
+    ys = np.arange(y0 + row_start, y0 + row_stop, dtype=np.float64)[:, None]
+
+    sx = matrix[0, 0] * xs + matrix[0, 1] * ys + matrix[0, 2]
+    sy = matrix[1, 0] * xs + matrix[1, 1] * ys + matrix[1, 2]
+    if matrix[2, 0] or matrix[2, 1] or matrix[2, 2] != 1:
+        z = matrix[2, 0] * xs + matrix[2, 1] * ys + matrix[2, 2]
+        sx /= z
+        sy /= z
+
+    # Gather whole pixels at once by viewing each one as a single item
+    pixels = source.reshape(h * w * channels).view(
+        np.dtype((np.void, channels * source.itemsize))
+    )
+    index_type = np.int32 if h * w < 2**31 else np.intp
+    acc = np.zeros((row_stop - row_start, out.shape[1], channels), dtype=np.float32)
+    if mask is not None:
+        # What an opaque alpha channel of the source would resample to
+        opaque = np.float32(np.iinfo(mask.dtype).max)
+        coverage = np.zeros(acc.shape[:2], dtype=np.float32)
+    x_taps = _interpolation_taps(sx, order, w)
+    for y_index, y_weight in _interpolation_taps(sy, order, h):
+        row_offset = y_index.astype(index_type) * w
+        for x_index, x_weight in x_taps:
+            values = np.take(pixels, row_offset + x_index).view(source.dtype)
+            weight = y_weight * x_weight
+            acc += weight[..., None] * values.reshape(acc.shape)
+            if mask is not None:
+                coverage += weight * opaque
+
+    if np.issubdtype(out.dtype, np.integer):
+        info = np.iinfo(out.dtype)
+        np.rint(acc, out=acc)
+        np.clip(acc, info.min, info.max, out=acc)
+    if lut is not None:
+        acc = _lookup(acc, lut)
+    out[row_start:row_stop] = acc.reshape(out[row_start:row_stop].shape)
+    if mask is not None:
+        np.rint(coverage, out=coverage)
+        np.clip(coverage, 0, opaque, out=coverage)
+        mask[row_start:row_stop] = coverage
+
+
+def _lookup(values, lut):
+    # Row i of the flattened table belongs to channel i
+    indices = values.astype(np.intp).reshape(values.shape[:2] + (-1,))
+    indices += np.arange(indices.shape[2]) * lut.shape[1]
+    return np.take(lut.ravel(), indices)
+
+
+def _lattice_map(matrix, tolerance=1e-9):
+    """
+    Recognizes warps that map every output pixel exactly onto a source 
+    pixel: identity, shifts by whole pixels, flips and rotations by 
+    multiples of 90 degrees (any combination).
+
+    Returns:
+    - tuple: (swap, (ex, fx), (ey, fy)) such that output pixel (x, y) is 
+      source pixel (ex * x + fx, ey * y + fy) after swapping the source's 
+      axes if swap is set; None for other warps
+    """
+    m = matrix / matrix[2, 2]
+    if abs(m[2, 0]) > tolerance or abs(m[2, 1]) > tolerance:
+        return None
+    linear = np.rint(m[:2, :2])
+    shift = np.rint(m[:2, 2])
+    if (np.abs(m[:2, :2] - linear).max() > tolerance 
+            or np.abs(m[:2, 2] - shift).max() > 1e3 * tolerance):
+        return None
+    if linear[0, 1] == 0 and linear[1, 0] == 0 and abs(linear[0, 0]) == abs(linear[1, 1]) == 1:
+        return False, (int(linear[0, 0]), int(shift[0])), (int(linear[1, 1]), int(shift[1]))
+    if linear[0, 0] == 0 and linear[1, 1] == 0 and abs(linear[0, 1]) == abs(linear[1, 0]) == 1:
+        # Source column from the output row and vice versa
+        return True, (int(linear[1, 0]), int(shift[1])), (int(linear[0, 1]), int(shift[0]))
+    return None
+
+
+def _lattice_span(scale, shift, start, count, size):
+    """
+    Output and source slices along one axis of a lattice map: output 
+    indices i in [0, count) whose source index scale * (start + i) + shift 
+    lies in [0, size).
+    """
+    if scale == 1:
+        low, high = -start - shift, size - start - shift
+    else:
+        low, high = shift - size + 1 - start, shift - start + 1
+    low, high = max(0, low), min(count, high)
+    if high <= low:
+        return None
+    first = scale * (start + low) + shift
+    last = first + scale * (high - low)
+    return slice(low, high), slice(first, last if last >= 0 else None, scale)
+
+
+def _copy_lattice(source, lattice, out, offset, mask):
+    # Slicing instead of resampling: lossless, and no coordinates computed
+    swap, (ex, fx), (ey, fy) = lattice
+    if swap:
+        source = source.swapaxes(0, 1)
+    columns = _lattice_span(ex, fx, offset[0], out.shape[1], source.shape[1])
+    rows = _lattice_span(ey, fy, offset[1], out.shape[0], source.shape[0])
+    if columns is None or rows is None:
+        out[...] = 0
+        if mask is not None:
+            mask[...] = 0
+        return
+    if rows[0] != slice(0, out.shape[0]) or columns[0] != slice(0, out.shape[1]):
+        out[...] = 0
+        if mask is not None:
+            mask[...] = 0
+    out[rows[0], columns[0]] = source[rows[1], columns[1]]
+    if mask is not None:
+        mask[rows[0], columns[0]] = np.iinfo(mask.dtype).max
+
+
+def init_warp_worker(threads):
+    """
+    Process pool initializer: several processes share the CPUs, so each 
+    warps with fewer threads (see WARP_THREADS).
+    """
+    global WARP_THREADS
+    WARP_THREADS = threads
+
+
+def warp_array(source, matrix, output_shape, order=1, out=None, threads=None, lut=None,
+               offset=(0, 0), mask=None):
+    """
+    Resamples an image array through a 3x3 inverse map.
+
+    Agrees with skimage's ``warp(..., mode="constant", cval=0, 
+    preserve_range=True)`` up to rounding, but the data stays in its own dtype (uint8, 
+    uint16 or float32) instead of being promoted to float64, integer 
+    results are rounded rather than truncated, and the output rows are 
+    spread over a shared thread pool. Maps that land every output pixel 
+    on a source pixel (identity, whole-pixel shifts, flips, multiples of 
+    90 degrees) are done by slicing, with the same result.
+
+    Parameters:
+    - source (np.ndarray): (rows, cols) or (rows, cols, channels) array
+    - matrix (np.ndarray): 3x3 matrix mapping output (x, y) pixel indices 
+      to source pixel indices
+    - output_shape (tuple): (rows, cols) of the output
+    - order (int): 0 nearest neighbour, 1 bilinear, 3 bicubic
+    - out (np.ndarray): Optional array (or view) to write the result to
+    - threads (int): Number of worker threads, WARP_THREADS by default
+    - lut (np.ndarray): Optional lookup table of shape (channels, 256 or 
+      65536) and the output's dtype, applied to each resampled chunk 
+      while it is still in cache, e.g. from tone_lut(); integer data only
+    - offset (tuple): (x, y) output pixel index of the result's top left 
+      pixel, to render only a region of the output; the region's pixels 
+      are identical to those of the full output
+    - mask (np.ndarray): Optional (rows, cols) integer array (or view, 
+      e.g. the alpha channel of an array that out is a view of) to write 
+      the coverage to: the share of each output pixel that comes from 
+      inside the source, 0 to the dtype's maximum. This is exactly the 
+      alpha channel that an opaque alpha channel of the source would 
+      resample to, without resampling one.
+
+    Returns:
+    - np.ndarray: The resampled array
+    """
+    source = np.ascontiguousarray(source)
+    if out is None:
+        out = np.empty(tuple(output_shape) + source.shape[2:], dtype=source.dtype)
+    if lut is not None and (lut.dtype != out.dtype or lut.shape[1] != np.iinfo(out.dtype).max + 1):
+        raise ValueError(f"Lookup table does not fit {out.dtype} data")
+    matrix = np.asarray(matrix, dtype=np.float64)
+
+    # Identity, whole-pixel shifts and right angles need no interpolation
+    lattice = _lattice_map(matrix)
+    if lattice is not None:
+        _copy_lattice(source, lattice, out, offset, mask)
+        if lut is not None:
+            for start in range(0, out.shape[0], WARP_CHUNK_ROWS):
+                chunk = out[start:start + WARP_CHUNK_ROWS]
+                chunk[...] = _lookup(chunk, lut).reshape(chunk.shape)
+        return out
+
+    rows = out.shape[0]
+    chunks = [
+        (start, min(rows, start + WARP_CHUNK_ROWS))
+        for start in range(0, rows, WARP_CHUNK_ROWS)
+    ]
+
+    threads = WARP_THREADS if threads is None else threads
+    if threads <= 1 or len(chunks) == 1:
+        for start, stop in chunks:
+            _warp_rows(source, matrix, out, start, stop, order, lut, offset, mask)
+        return out
+
+    if threads not in _warp_pools:
+        _warp_pools[threads] = ThreadPoolExecutor(threads, thread_name_prefix="warp")
+    futures = [
+        _warp_pools[threads].submit(
+            _warp_rows, source, matrix, out, start, stop, order, lut, offset, mask
+        )
+        for start, stop in chunks
+    ]
+    for future in futures:
+        future.result()
+    return out
+
+
+def correct_image(image, degrees, warp_offsets, order=1, tone=None, crop=None):
+    """
+    Rotates (with expanded canvas), warps and tone-adjusts an image in a 
+    single resampling pass.
+
+    With crop, only the output pixels inside the box are resampled; the 
+    result equals the full output cropped with Image.crop(box).
+
+    Parameters:
+    - image (PIL.Image or np.ndarray): 8-bit input image, see pixel_array()
+    - degrees (float): Rotation angle
+    - warp_offsets (dict): Corner offsets as fractions of width and height
+    - order (int): Interpolation order, see warp_array()
+    - tone (dict): Tone adjustments, see tone_lut()
+    - crop (tuple): Optional (left, top, right, bottom) box in output 
+      coordinates, rounded the same way as Image.crop()
+
+    Returns:
+    - PIL.Image: Corrected image in the channels of the input (L, LA, RGB 
+      or RGBA); gray or colour input without alpha gets one only if parts 
+      of the result lie outside the source (see export_channels())
+    """
+    channels, dtype = pixel_format(image)
+    if dtype != np.uint8:
+        raise ValueError("correct_image() takes 8-bit images; use export_tiled() for 16 bits")
+    with profiling.stage("warp", image, degrees=degrees, order=order) as stage:
+        matrix, (w, h) = correction_matrix(image_size(image), degrees, warp_offsets)
+        left, top, right, bottom = 0, 0, w, h
+        if crop is not None:
+            left, top, right, bottom = (int(round(v)) for v in crop)
+        shape = (max(0, bottom - top), max(0, right - left))
+        out_channels = export_channels(image, matrix, (left, top, right, bottom), order)
+
+        source = pixel_array(image)
+        warped = np.empty(shape + (out_channels,), dtype=np.uint8)
+        # The alpha channel added for the areas outside the source is 
+        # the coverage of the warp
+        warp_array(source, matrix, shape, order=order, out=warped[..., :channels],
+                   lut=tone_lut(tone, channels), offset=(left, top),
+                   mask=warped[..., channels] if out_channels > channels else None)
+        # Parts of the box outside the output are transparent, as with 
+        # Image.crop()
+        if left < 0 or top < 0 or right > w or bottom > h:
+            outside = np.ones(warped.shape[:2], dtype=bool)
+            outside[max(0, -top):h - top, max(0, -left):w - left] = False
+            warped[outside] = 0
+        return stage.output(image_from_pixels(warped))
+
+
+# ---------------------
+# Tone
+# ---------------------
+
+def normalize_tone(tone=None):
+    """
+    Validates tone adjustments and fills in defaults.
+
+    Parameters:
+    - tone (dict): brightness (-1 to 1, added as a fraction of the full 
+      range), contrast (factor around mid-grey, >= 0), gamma (> 0, larger 
+      values brighten the mid-tones) and levels ({channel: [black, 
+      white]} input points per channel r, g, b); missing keys take their 
+      defaults
+
+    Returns:
+    - dict: Normalized tone adjustments
+    """
+    tone = tone or {}
+    levels = tone.get("levels") or {}
+    normalized = {
+        "brightness": round(float(tone.get("brightness", 0.0)), 10),
+        "contrast": round(float(tone.get("contrast", 1.0)), 10),
+        "gamma": round(float(tone.get("gamma", 1.0)), 10),
+        "levels": {
+            channel: [int(value) for value in levels.get(channel, (0, 255))]
+            for channel in LEVEL_CHANNELS
+        },
+    }
+    if not -1 <= normalized["brightness"] <= 1:
+        raise ValueError(f"Brightness must be between -1 and 1: {normalized['brightness']}")
+    if normalized["contrast"] < 0:
+        raise ValueError(f"Contrast must not be negative: {normalized['contrast']}")
+    if normalized["gamma"] <= 0:
+        raise ValueError(f"Gamma must be positive: {normalized['gamma']}")
+    for channel, (black, white) in normalized["levels"].items():
+        if not 0 <= black < white <= 255:
+            raise ValueError(f"Invalid levels for channel {channel}: {black}, {white}")
+    return normalized
+
+
+def tone_lut(tone, channels=4, dtype=np.uint8):
+    """
+    Lookup table for tone adjustments: levels, then gamma, contrast and 
+    brightness, computed once in float and applied to integer pixels.
+
+    Levels are given on the 8-bit scale and scaled for 16-bit data; gray 
+    images use the mean of the r, g and b levels.
+
+    Parameters:
+    - tone (dict): Tone adjustments, see normalize_tone()
+    - channels (int): 1 (gray), 2 (gray and alpha), 3 (RGB) or 4 (RGBA)
+    - dtype: np.uint8 or np.uint16
+
+    Returns:
+    - np.ndarray: Array of dtype and shape (channels, 256 or 65536), 
+      alpha unchanged, or None if the adjustments leave the image 
+      unchanged
+    """
+    tone = normalize_tone(tone)
+    if tone == DEFAULT_TONE:
+        return None
+    maximum = np.iinfo(dtype).max
+    x = np.arange(maximum + 1, dtype=np.float64)
+    if channels <= 2:
+        levels = [np.mean([tone["levels"][channel] for channel in LEVEL_CHANNELS], axis=0)]
+    else:
+        levels = [tone["levels"][channel] for channel in LEVEL_CHANNELS]
+    # Alpha, if any, stays unchanged
+    lut = np.repeat(x.astype(dtype)[None], channels, axis=0)
+    for index, (black, white) in enumerate(levels):
+        black, white = black * maximum / 255, white * maximum / 255
+        values = np.clip((x - black) / (white - black), 0, 1)
+        values = values ** (1 / tone["gamma"])
+        values = (values - 0.5) * tone["contrast"] + 0.5 + tone["brightness"]
+        lut[index] = np.clip(np.rint(values * maximum), 0, maximum)
+    return lut
+
+
+def tone_from_state(state):
+    """
+    Collects the tone adjustments from the session state. Missing keys 
+    take the neutral defaults; levels whose black and white points meet 
+    (the range sliders allow it) are moved apart instead of rejected.
+    """
+    levels = {}
+    for channel in LEVEL_CHANNELS:
+        black, white = state.get(f"tone_levels_{channel}", DEFAULT_TONE["levels"][channel])
+        black = min(int(black), 254)
+        levels[channel] = [black, max(int(white), black + 1)]
+    return normalize_tone({
+        "brightness": state.get("tone_brightness", DEFAULT_TONE["brightness"]),
+        "contrast": state.get("tone_contrast", DEFAULT_TONE["contrast"]),
+        "gamma": state.get("tone_gamma", DEFAULT_TONE["gamma"]),
+        "levels": levels,
+    })
+
+
+@functools.lru_cache(maxsize=8)
+def load_font(font_size):
+    return ImageFont.truetype(FONT_PATH, font_size)
+
+
+def add_watermark_to_image(image, watermark_text):
+    with profiling.stage("watermark", image):
+        # A copy in the image's own channels: the image may be a cached 
+        # render
+        image = image.convert({1: "L", 2: "LA", 3: "RGB", 4: "RGBA"}[pixel_format(image)[0]])
+        stamp, position = watermark_stamp(image.size, watermark_text)
+        composite_stamp(image, stamp, position)
+        return image
+
+
+def watermark_stamp(size, watermark_text):
+    """
+    Renders the diagonal watermark for an image of the given size into a 
+    layer that only covers the text, instead of the whole image.
+
+    A stamp that fits into the image only depends on the text, the font 
+    size and the parity of the image size, so it is rendered once for a 
+    canonical size and shared between images. Text wider or taller than 
+    the image is clipped at the image borders before rotating (like on a 
+    full-size layer), so those stamps are cached per image size.
+
+    Parameters:
+    - size (tuple): (width, height) of the image to be watermarked
+    - watermark_text (str): Watermark text
+
+    Returns:
+    - PIL.Image: RGBA stamp (shared, must not be modified)
+    - tuple: (x, y) position of the stamp's top left corner in the image
+    """
+    width, height = size
+    diagonal = (width**2 + height**2)**0.5
+    font_size = int(diagonal / 12)
+
+    bbox = _text_box(watermark_text, font_size)
+    x = (width - (bbox[2] - bbox[0])) / 2
+    y = (height - (bbox[3] - bbox[1])) / 2
+    # Text within a few pixels of the borders is affected by them
+    if (min(x, x + bbox[0]) < 4 or x + bbox[2] > width - 4 
+            or min(y, y + bbox[1]) < 4 or y + bbox[3] > height - 4):
+        return _cached_stamp(watermark_text, font_size, width, height)
+
+    # Small size with the same parity that still holds the text: the 
+    # stamp is the same, shifted by a whole number of pixels
+    extent = 2 * max(abs(v) for v in bbox) + 16
+    canonical_w = extent + (extent - width) % 2
+    canonical_h = extent + (extent - height) % 2
+    stamp, (stamp_x, stamp_y) = _cached_stamp(
+        watermark_text, font_size, canonical_w, canonical_h
+    )
+    return stamp, (stamp_x + (width - canonical_w) // 2, 
+                   stamp_y + (height - canonical_h) // 2)
+
+
+@functools.lru_cache(maxsize=64)
+def _text_box(watermark_text, font_size):
+    return ImageDraw.Draw(Image.new("RGBA", (1, 1))).textbbox(
+        (0, 0), watermark_text, font=load_font(font_size)
+    )
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_stamp(watermark_text, font_size, width, height):
+    bbox = _text_box(watermark_text, font_size)
+    x = (width - (bbox[2] - bbox[0])) / 2
+    y = (height - (bbox[3] - bbox[1])) / 2
+
+    # Text layer: the ink box clipped to the image. It starts at or before 
+    # (x, y), or at 0 for negative positions, so that Pillow splits the 
+    # position into pixel and sub-pixel parts as on a full-size layer
+    text_left = max(0, math.floor(min(x, x + bbox[0])) - 1)
+    text_top = max(0, math.floor(min(y, y + bbox[1])) - 1)
+    text_right = min(width, math.ceil(x + bbox[2]) + 1)
+    text_bottom = min(height, math.ceil(y + bbox[3]) + 1)
+    text_layer = Image.new(
+        "RGBA", 
+        (max(1, text_right - text_left), max(1, text_bottom - text_top)), 
+        (255, 255, 255, 0)
+    )
+    ImageDraw.Draw(text_layer).text(
+        (x - text_left, y - text_top), watermark_text, 
+        fill=(255, 255, 255, 50), font=load_font(font_size)
+    )
+
+    # The stamp holds the text layer and its rotated footprint, plus a 
+    # margin for the bicubic filter
+    cx, cy = width / 2, height / 2
+    corners = [
+        (text_left, text_top), (text_right, text_top),
+        (text_right, text_bottom), (text_left, text_bottom),
+    ]
+    cos45 = sin45 = math.sqrt(0.5)
+    corners += [
+        (cx + (px - cx) * cos45 + sign * (py - cy) * sin45,
+         cy - sign * (px - cx) * sin45 + (py - cy) * cos45)
+        for px, py in corners[:4] for sign in (1, -1)
+    ]
+    margin = 4
+    left = math.floor(min(px for px, _ in corners)) - margin
+    top = math.floor(min(py for _, py in corners)) - margin
+    right = math.ceil(max(px for px, _ in corners)) + margin
+    bottom = math.ceil(max(py for _, py in corners)) + margin
+
+    stamp = Image.new("RGBA", (right - left, bottom - top), (255, 255, 255, 0))
+    stamp.paste(text_layer, (text_left - left, text_top - top))
+    center = (cx - left, cy - top)
+
+    inside = (max(0, -left), max(0, -top), 
+              min(stamp.width, width - left), min(stamp.height, height - top))
+    if (text_left < 2 or text_top < 2 
+            or text_right > width - 2 or text_bottom > height - 2):
+        # Near the borders, Pillow's bicubic filter repeats the border 
+        # pixels of the full-size layer, and samples from outside of it 
+        # are transparent
+        ix0, iy0, ix1, iy1 = inside
+        pixels = np.array(stamp)
+        pixels[iy0:iy1, :ix0] = pixels[iy0:iy1, ix0:ix0 + 1]
+        pixels[iy0:iy1, ix1:] = pixels[iy0:iy1, ix1 - 1:ix1]
+        pixels[:iy0] = pixels[iy0:iy0 + 1]
+        pixels[iy1:] = pixels[iy1 - 1:iy1]
+        stamp = Image.fromarray(pixels, mode="RGBA")
+
+        mask = Image.new("L", stamp.size, 0)
+        mask.paste(255, inside)
+        mask = mask.rotate(45, resample=Image.NEAREST, center=center)
+        stamp = stamp.rotate(45, resample=Image.BICUBIC, center=center)
+        stamp.putalpha(ImageChops.multiply(stamp.getchannel("A"), mask))
+    else:
+        stamp = stamp.rotate(45, resample=Image.BICUBIC, center=center)
+
+    return stamp, (left, top)
+
+
+def composite_stamp(image, stamp, position):
+    """
+    Alpha-composites a stamp onto the part of an image it overlaps; the 
+    rest of the image is not touched.
+
+    Parameters:
+    - image (PIL.Image or np.ndarray): L, LA, RGB or RGBA image, or uint8 
+      or uint16 array with 1 to 4 channels (see pixel_array()), modified 
+      in place
+    - stamp (PIL.Image): RGBA stamp
+    - position (tuple): (x, y) of the stamp's top left corner, relative to 
+      the image's top left corner
+    """
+    if isinstance(image, Image.Image):
+        w, h = image.size
+    else:
+        h, w = image.shape[:2]
+    left, top = max(0, position[0]), max(0, position[1])
+    right = min(w, position[0] + stamp.width)
+    bottom = min(h, position[1] + stamp.height)
+    if right <= left or bottom <= top:
+        return
+
+    stamp_region = stamp.crop((
+        left - position[0], top - position[1],
+        right - position[0], bottom - position[1],
+    ))
+    if isinstance(image, Image.Image):
+        box = (left, top, right, bottom)
+        if image.mode in ("RGB", "RGBA"):
+            region = Image.alpha_composite(image.crop(box).convert("RGBA"), stamp_region)
+            image.paste(region.convert(image.mode), box)
+        else:
+            region = np.array(image.crop(box))
+            _composite_pixels(region, stamp_region)
+            image.paste(Image.fromarray(region, mode=image.mode), box)
+    elif image.dtype == np.uint8 and image.shape[2] in (3, 4):
+        channels = image.shape[2]
+        region = Image.fromarray(image[top:bottom, left:right]).convert("RGBA")
+        region = np.asarray(Image.alpha_composite(region, stamp_region))
+        image[top:bottom, left:right] = region[..., :channels]
+    else:
+        _composite_pixels(image[top:bottom, left:right], stamp_region)
+
+
+def _composite_pixels(pixels, stamp):
+    """
+    Image.alpha_composite() of an RGBA stamp onto gray or colour pixels 
+    of any bit depth, in place (as float; a gray stamp is the mean of its 
+    colours).
+    """
+    if pixels.ndim == 2:
+        pixels = pixels[..., None]
+    maximum = np.iinfo(pixels.dtype).max
+    channels = pixels.shape[2]
+    colours = channels - 1 if channels in (2, 4) else channels
+
+    stamp = np.asarray(stamp, dtype=np.float32) / 255
+    stamp_alpha = stamp[..., 3:]
+    stamp_colour = stamp[..., :3] if colours == 3 else stamp[..., :3].mean(axis=2, keepdims=True)
+    values = pixels.astype(np.float32) / maximum
+    alpha = values[..., colours:] if channels in (2, 4) else 1
+    out_alpha = stamp_alpha + alpha * (1 - stamp_alpha)
+    colour = stamp_colour * stamp_alpha + values[..., :colours] * alpha * (1 - stamp_alpha)
+    colour /= np.maximum(out_alpha, 1e-12)
+    pixels[..., :colours] = np.rint(np.clip(colour, 0, 1) * maximum)
+    if channels in (2, 4):
+        pixels[..., colours:] = np.rint(out_alpha * maximum)
+
+
+def write_png(fp, size, bands, compress_level=6, alpha=True):
+    """
+    Streams a gray or colour PNG with 8 or 16 bits per channel to a file 
+    object, one band of rows at a time.
+
+    Each band is filtered and compressed as it arrives, so the encoder 
+    never needs the whole image in memory.
+
+    Parameters:
+    - fp (file object): Binary output stream
+    - size (tuple): (width, height) of the image
+    - bands (iterable): uint8 or uint16 arrays of shape (rows, width, 
+      channels) with 1 (gray), 2 (gray and alpha), 3 (RGB) or 4 (RGBA) 
+      channels, top to bottom, together covering all rows of the image
+    - compress_level (int): zlib level, 0-9
+    - alpha (bool): Write the alpha channel (of bands with 2 or 4 
+      channels); if False, it is discarded
+    """
+    def write_chunk(tag, data):
+        fp.write(struct.pack(">I", len(data)))
+        fp.write(tag)
+        fp.write(data)
+        fp.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(tag))))
+
+    bands = iter(bands)
+    first = next(bands)
+    channels = first.shape[2]
+    if not alpha and channels in (2, 4):
+        channels -= 1
+    # PNG stores 16-bit samples big-endian
+    depth, sample_type = (16, ">u2") if first.dtype == np.uint16 else (8, np.uint8)
+    color_type = {1: 0, 2: 4, 3: 2, 4: 6}[channels]
+
+    width, height = size
+    fp.write(b"\x89PNG\r\n\x1a\n")
+    write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, depth, color_type, 0, 0, 0))
+
+    compressor = zlib.compressobj(compress_level)
+    previous = np.zeros(width * channels * depth // 8, dtype=np.uint8)
+    for band in itertools.chain([first], bands):
+        rows = band[..., :channels].astype(sample_type).view(np.uint8)
+        rows = rows.reshape(band.shape[0], -1)
+        # "Up" filter (type 2): difference to the row above, modulo 256
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = 2
+        filtered[0, 1:] = rows[0] - previous
+        filtered[1:, 1:] = rows[1:] - rows[:-1]
+        previous = rows[-1].copy()
+
+        data = compressor.compress(filtered.tobytes())
+        if data:
+            write_chunk(b"IDAT", data)
+
+    write_chunk(b"IDAT", compressor.flush())
+    write_chunk(b"IEND", b"")
+
+
+def normalize_export_options(options=None):
+    """
+    Validates export options and fills in defaults.
+
+    Parameters:
+    - options (dict): Any of the keys of DEFAULT_EXPORT_OPTIONS
+
+    Returns:
+    - dict: format and drop_opaque_alpha, plus compress_level for PNG and 
+      TIFF or quality for JPEG and WebP (settings that do not affect the 
+      output are left out, so they do not split the export cache)
+    """
+    options = {**DEFAULT_EXPORT_OPTIONS, **(options or {})}
+    image_format = str(options["format"]).upper()
+    if image_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {options['format']}")
+
+    normalized = {
+        "format": image_format,
+        "drop_opaque_alpha": bool(options["drop_opaque_alpha"]),
+    }
+    if image_format in LOSSLESS_FORMATS:
+        level = int(options["compress_level"])
+        if not 0 <= level <= 9:
+            raise ValueError(f"{image_format} compress_level must be 0-9, got {level}")
+        normalized["compress_level"] = level
+    else:
+        quality = int(options["quality"])
+        if not 1 <= quality <= 100:
+            raise ValueError(f"Quality must be 1-100, got {quality}")
+        normalized["quality"] = quality
+    return normalized
+
+
+def export_options_from_state(state):
+    """
+    Collects the export options from the session state.
+    """
+    return normalize_export_options({
+        "format": state.export_format,
+        "quality": state.export_quality,
+        "compress_level": state.export_compress_level,
+        "drop_opaque_alpha": state.export_drop_opaque_alpha,
+    })
+
+
+def _save_kwargs(options):
+    if options["format"] == "PNG":
+        return {"compress_level": options["compress_level"]}
+    return {"quality": options["quality"]}
+
+
+def flatten_alpha(pixels):
+    """
+    Composites RGBA or gray and alpha pixels onto white (for formats 
+    without alpha).
+
+    Parameters:
+    - pixels (np.ndarray): uint8 or uint16 array of shape (..., 4) or 
+      (..., 2)
+
+    Returns:
+    - np.ndarray: Array of the same dtype and shape (..., 3) or (..., 1)
+    """
+    maximum = int(np.iinfo(pixels.dtype).max)
+    alpha = pixels[..., -1:].astype(np.uint64 if maximum > 255 else np.uint16)
+    colours = pixels[..., :-1] * alpha + maximum * (maximum - alpha)
+    return ((colours + maximum // 2) // maximum).astype(pixels.dtype)
+
+
+def write_tiff(fp, size, bands, dtype, channels, compress_level=6, tile_size=EXPORT_TILE_SIZE):
+    """
+    Streams a tiled, deflate-compressed TIFF with 8 or 16 bits per channel
+    to a file object, one band of rows at a time.
+
+    Parameters:
+    - fp (file object or path): Output
+    - size (tuple): (width, height) of the image
+    - bands (iterable): Arrays of shape (tile_size rows, width, channels) 
+      (the last band may be shorter), top to bottom
+    - dtype: np.uint8 or np.uint16
+    - channels (int): 1 (gray), 2 (gray and alpha), 3 (RGB) or 4 (RGBA); 
+      extra channels of the bands are discarded
+    - compress_level (int): zlib level, 0-9 (0 writes uncompressed)
+    - tile_size (int): Side length of the TIFF tiles, a multiple of 16
+    """
+    width, height = size
+
+    def tiles():
+        for band in bands:
+            for left in range(0, width, tile_size):
+                yield band[:, left:left + tile_size, :channels]
+
+    tifffile.imwrite(
+        fp, tiles(), shape=(height, width, channels), dtype=dtype, 
+        tile=(tile_size, tile_size),
+        photometric="minisblack" if channels <= 2 else "rgb",
+        extrasamples=["unassalpha"] if channels in (2, 4) else None,
+        compression="zlib" if compress_level else None,
+        compressionargs={"level": compress_level} if compress_level else None,
+    )
+
+
+def encode_image(image, fp, options=None):
+    """
+    Encodes an image with the given export options.
+
+    JPEG has no alpha channel: images with transparency are composited 
+    onto white. With drop_opaque_alpha, a fully opaque alpha channel is 
+    dropped for the other formats as well. Gray images stay gray.
+
+    Parameters:
+    - image (PIL.Image): Image to encode
+    - fp (file object or path): Output
+    - options (dict): Export options, see normalize_export_options()
+    """
+    options = normalize_export_options(options)
+    with profiling.stage("encode", image, format=options["format"]) as stage:
+        start = fp.tell() if hasattr(fp, "tell") else None
+        if image.mode == "RGBX":
+            # Memory-mapped RGB, see session_store.py
+            image = image.convert("RGB")
+        if "A" in image.getbands():
+            opaque = image.getchannel("A").getextrema()[0] == 255
+            if opaque and (options["drop_opaque_alpha"] or options["format"] == "JPEG"):
+                image = image.convert("L" if image.mode == "LA" else "RGB")
+            elif options["format"] == "JPEG":
+                image = image_from_pixels(flatten_alpha(pixel_array(image)))
+        if options["format"] == "TIFF":
+            pixels = pixel_array(image)
+            tile_size = EXPORT_TILE_SIZE
+            write_tiff(
+                fp, image.size, 
+                (pixels[top:top + tile_size] for top in range(0, image.height, tile_size)),
+                pixels.dtype, pixels.shape[2], compress_level=options["compress_level"]
+            )
+        else:
+            image.save(fp, format=options["format"], **_save_kwargs(options))
+        if start is not None:
+            stage.note(output=f"{fp.tell() - start} bytes {image.mode}")
+
+
+def _covers_opaque_source(image, matrix, box, order):
+    """
+    Whether every output pixel in box (left, top, right, bottom) is 
+    interpolated from opaque source pixels only, i.e. the corrected crop 
+    is fully opaque without rendering it.
+    """
+    return _is_opaque(image) and _covers_source(image_size(image), matrix, box, order)
+
+
+def _covers_source(size, matrix, box, order):
+    """
+    Whether every output pixel in box (left, top, right, bottom) is 
+    interpolated from pixels inside a source of size (width, height) 
+    only, i.e. the corrected crop has no areas outside the source.
+    """
+    left, top, right, bottom = box
+    corners = np.array([
+        [left, top, 1], [right - 1, top, 1],
+        [right - 1, bottom - 1, 1], [left, bottom - 1, 1],
+    ], dtype=float) @ matrix.T
+    corners = corners[:, :2] / corners[:, 2:]
+    # Bicubic taps reach one pixel further than bilinear ones
+    margin = 1 if order == 3 else 0
+    low = margin - 1e-6
+    width, height = size
+    return bool(
+        (corners >= low).all()
+        and (corners[:, 0] <= width - 1 - low).all()
+        and (corners[:, 1] <= height - 1 - low).all()
+    )
+
+
+def export_channels(image, matrix, box, order=1):
+    """
+    Channels of the corrected image: those of the source (see 
+    pixel_format()), plus an alpha channel for gray or colour sources 
+    without one if parts of the box lie outside the source. Areas inside 
+    the source are never transparent, so the alpha channel is added only 
+    when the warp creates such areas (e.g. the corners of a rotation); 
+    formats without alpha composite them onto white (see flatten_alpha()).
+
+    Parameters:
+    - image (PIL.Image or np.ndarray): Source image
+    - matrix (np.ndarray): Map from output to source pixels, see 
+      correction_matrix()
+    - box (tuple): (left, top, right, bottom) region of the output
+    - order (int): Interpolation order, see warp_array()
+
+    Returns:
+    - int: 1 (gray), 2 (gray and alpha), 3 (RGB) or 4 (RGBA)
+    """
+    channels, _ = pixel_format(image)
+    if channels in (2, 4) or _covers_source(image_size(image), matrix, box, order):
+        return channels
+    return channels + 1
+
+
+def export_tiled(image, degrees, warp_offsets, fp, crop=None, 
+                 watermark_text=None, tile_size=EXPORT_TILE_SIZE, order=1,
+                 options=None, progress=None, tone=None):
+    """
+    Corrects an image tile by tile and streams the result as PNG or TIFF.
+
+    Every output tile is mapped back through the inverse transform, only 
+    the source window it touches is read and resampled, and each finished 
+    band of rows goes straight to the PNG or TIFF encoder. Peak memory 
+    depends on tile_size, not on the size of the image. The image keeps 
+    its channels (gray or colour) and bit depth (8 or 16) in PNG and 
+    TIFF, plus an alpha channel only if the result has areas outside the 
+    source (see export_channels()). JPEG 
+    and WebP cannot be encoded band by band with Pillow; for them the 
+    bands are collected into the final 8-bit output (1 to 4 bytes per 
+    pixel), but no larger intermediate is ever allocated.
+
+    Tolerance: the result matches correct_image() followed by crop and 
+    add_watermark_to_image() within ±1 per channel (floating point 
+    rounding of the shifted tile transforms). Fully transparent pixels 
+    outside the watermark may keep their colour channels, where a 
+    full-frame alpha_composite would set them to zero.
+
+    Parameters:
+    - image (PIL.Image or np.ndarray): Full-resolution input image, see 
+      pixel_array()
+    - degrees (float): Rotation angle
+    - warp_offsets (dict): Corner offsets as fractions of width and height
+    - fp (file object): Binary output stream
+    - crop (tuple): Optional (left, top, right, bottom) box in output 
+      coordinates, rounded the same way as Image.crop()
+    - watermark_text (str): Optional watermark text
+    - tile_size (int): Side length of the output tiles (a multiple of 16 
+      for TIFF)
+    - order (int): Interpolation order, see warp_array()
+    - options (dict): Export options, see normalize_export_options()
+    - progress (callable): Called with the finished fraction of rows after 
+      each band; may raise to abort the export
+    - tone (dict): Tone adjustments, see tone_lut(); applied per tile as 
+      part of the resampling
+    """
+    options = normalize_export_options(options)
+    width, height = image_size(image)
+    channels, dtype = pixel_format(image)
+    lut = tone_lut(tone, channels, dtype)
+    matrix, (w, h) = correction_matrix((width, height), degrees, warp_offsets)
+    if crop is None:
+        crop = (0, 0, w, h)
+    left, top, right, bottom = (int(round(v)) for v in crop)
+    out_w, out_h = right - left, bottom - top
+
+    out_channels = export_channels(image, matrix, (left, top, right, bottom), order)
+    has_alpha = out_channels in (2, 4)
+    opaque = _covers_opaque_source(image, matrix, (left, top, right, bottom), order)
+    if options["format"] == "JPEG":
+        alpha = False
+    else:
+        alpha = has_alpha and not (opaque and options["drop_opaque_alpha"])
+
+    stamp = None
+    if watermark_text:
+        stamp, stamp_position = watermark_stamp((out_w, out_h), watermark_text)
+
+    def bands():
+        for y0 in range(top, bottom, tile_size):
+            y1 = min(bottom, y0 + tile_size)
+            band = np.zeros((y1 - y0, out_w, out_channels), dtype=dtype)
+
+            for x0 in range(left, right, tile_size):
+                x1 = min(right, x0 + tile_size)
+
+                # Source window touched by this tile (+ interpolation margin)
+                corners = np.array([
+                    [x0, y0, 1], [x1 - 1, y0, 1],
+                    [x1 - 1, y1 - 1, 1], [x0, y1 - 1, 1],
+                ], dtype=float) @ matrix.T
+                corners = corners[:, :2] / corners[:, 2:]
+                sx0 = max(0, math.floor(corners[:, 0].min()) - 2)
+                sy0 = max(0, math.floor(corners[:, 1].min()) - 2)
+                sx1 = min(width, math.ceil(corners[:, 0].max()) + 3)
+                sy1 = min(height, math.ceil(corners[:, 1].max()) + 3)
+                if sx1 <= sx0 or sy1 <= sy0:
+                    continue
+
+                source = pixel_array(image, (sx0, sy0, sx1, sy1))
+                tile_matrix = (
+                    np.array([[1, 0, -sx0], [0, 1, -sy0], [0, 0, 1]])
+                    @ matrix
+                    @ np.array([[1, 0, x0], [0, 1, y0], [0, 0, 1]])
+                )
+                tile = band[:, x0 - left:x1 - left]
+                warp_array(
+                    source, tile_matrix, (y1 - y0, x1 - x0), order=order,
+                    out=tile[..., :channels], lut=lut,
+                    mask=tile[..., channels] if out_channels > channels else None
+                )
+
+            if stamp is not None:
+                composite_stamp(
+                    band, stamp, 
+                    (stamp_position[0], stamp_position[1] - (y0 - top))
+                )
+            yield band
+            if progress is not None:
+                progress((y1 - top) / out_h)
+
+    if options["format"] == "PNG":
+        write_png(fp, (out_w, out_h), bands(), 
+                  compress_level=options["compress_level"], alpha=alpha)
+        return
+    final_channels = out_channels - 1 if has_alpha and not alpha else out_channels
+    if options["format"] == "TIFF":
+        write_tiff(fp, (out_w, out_h), bands(), dtype, final_channels, 
+                   compress_level=options["compress_level"], tile_size=tile_size)
+        return
+
+    pixels = np.empty((out_h, out_w, final_channels), dtype=np.uint8)
+    row = 0
+    for band in bands():
+        if alpha or opaque or not has_alpha:
+            pixels[row:row + len(band)] = to_uint8(band[..., :final_channels])
+        else:
+            pixels[row:row + len(band)] = to_uint8(flatten_alpha(band))
+        row += len(band)
+    image_from_pixels(pixels).save(fp, format=options["format"], **_save_kwargs(options))
+
+
+def normalize_recipe(recipe):
+    """
+    Validates a recipe and brings it into canonical form: all keys 
+    present, numbers as floats rounded to 10 decimals (so that repeated 
+    button steps like 0.1 + 0.2 compare equal), booleans as booleans.
+
+    Parameters:
+    - recipe (dict): Recipe as produced by recipe_from_state() or read 
+      from JSON; missing keys take their defaults
+
+    Returns:
+    - dict: Normalized recipe
+    """
+    version = recipe.get("version", RECIPE_VERSION)
+    if version != RECIPE_VERSION:
+        raise ValueError(f"Unsupported recipe version: {version}")
+
+    warp_offsets = recipe.get("warp_offsets", {})
+    rect_margins = recipe.get("rect_margins", {})
+    return {
+        "version": RECIPE_VERSION,
+        "degrees": round(float(recipe.get("degrees", 0)), 10),
+        "warp_offsets": {
+            key: round(float(warp_offsets.get(key, 0)), 10) for key in WARP_KEYS
+        },
+        "cut_to_rect": bool(recipe.get("cut_to_rect", False)),
+        "rect_margins": {
+            side: round(float(rect_margins.get(side, 0)), 10) for side in RECT_SIDES
+        },
+        "watermark_enabled": bool(recipe.get("watermark_enabled", False)),
+        "watermark_text": str(recipe.get("watermark_text", "")),
+        "tone": normalize_tone(recipe.get("tone")),
+    }
+
+
+def recipe_from_state(state):
+    """
+    Collects the correction parameters of a session into a recipe.
+
+    Rectangle margins are stored as fractions of the preview size, so the 
+    recipe applies to images of any resolution.
+
+    Parameters:
+    - state (st.session_state or dict): Session state with the parameters
+
+    Returns:
+    - dict: Normalized, JSON-serializable recipe
+    """
+    preview_w, preview_h = state["image"].size
+    return normalize_recipe({
+        "degrees": state["degrees"],
+        "warp_offsets": {key: state[f"warp_{key}_offset"] for key in WARP_KEYS},
+        "cut_to_rect": state["cut_to_rect"],
+        "rect_margins": {
+            "left": state["rect_left_width_margin"] / preview_w,
+            "right": state["rect_right_width_margin"] / preview_w,
+            "top": state["rect_top_height_margin"] / preview_h,
+            "bottom": state["rect_bottom_height_margin"] / preview_h,
+        },
+        "watermark_enabled": state["watermark_enabled"],
+        "watermark_text": state["watermark_text"],
+        "tone": tone_from_state(state),
+    })
+
+
+def save_recipe(recipe, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(normalize_recipe(recipe), f, indent=2, ensure_ascii=False)
+
+
+def load_recipe(path):
+    with open(path, encoding="utf-8") as f:
+        return normalize_recipe(json.load(f))
+
+
+def export_image(image, recipe, fp, tiled=None, order=1, options=None, progress=None):
+    """
+    Applies a recipe to a (full-resolution) image and encodes it.
+
+    Parameters:
+    - image (PIL.Image or np.ndarray): Input image, see pixel_array()
+    - recipe (dict): Correction recipe
+    - fp (file object or path): Output for the encoded image
+    - tiled (bool): Use export_tiled(); by default only for outputs 
+      larger than TILED_EXPORT_MIN_PIXELS and for 16-bit images (which 
+      the in-memory path, working on PIL images, cannot hold)
+    - order (int): Interpolation order, see warp_array()
+    - options (dict): Export options, see normalize_export_options()
+    - progress (callable): Called with the finished fraction (0 to 1) 
+      after each step; may raise to abort the export
+    """
+    recipe = normalize_recipe(recipe)
+    degrees = recipe["degrees"]
+    warp_offsets = recipe["warp_offsets"]
 
     # ---------------------
-    # Cut to rectangle if requested
+    # Rotation, trapezoidal warp and tone (single resampling pass)
     # ---------------------
-    if st.session_state.cut_to_rect:
-        left = st.session_state.rect_left_width_margin * scale_w
-        top = st.session_state.rect_top_height_margin * scale_h
-        right = orig_img.width - st.session_state.rect_right_width_margin * scale_w
-        bottom = orig_img.height - st.session_state.rect_bottom_height_margin * scale_h
+    _, (w, h) = correction_matrix(image_size(image), degrees, warp_offsets)
 
-        left = max(0, left)
-        top = max(0, top)
-        right = min(orig_img.width, right)
-        bottom = min(orig_img.height, bottom)
+    # ---------------------
+    # Cut to rectangle if requested
+    # ---------------------
+    crop = None
+    if recipe["cut_to_rect"]:
+        margins = recipe["rect_margins"]
+        left = max(0, margins["left"] * w)
+        top = max(0, margins["top"] * h)
+        right = min(w, w - margins["right"] * w)
+        bottom = min(h, h - margins["bottom"] * h)
 
         if right > left and bottom > top:
-            orig_img = orig_img.crop((left, top, right, bottom))
+            crop = (left, top, right, bottom)
 
     # ---------------------
-    # Apply watermark if enabled
+    # Watermark if enabled
     # ---------------------
-    
-    if st.session_state.watermark_enabled:
-        orig_img = add_watermark_to_image(orig_img, st.session_state.watermark_text)
-    
-    img_bytes = io.BytesIO()
-    orig_img.save(img_bytes, format="PNG")
-    img_bytes.seek(0)
-    st.session_state.original_image_bytes = img_bytes
+    watermark_text = None
+    if recipe["watermark_enabled"]:
+        watermark_text = recipe["watermark_text"]
+
+    if pixel_format(image)[1] != np.uint8:
+        tiled = True
+    elif tiled is None:
+        tiled = w * h > TILED_EXPORT_MIN_PIXELS
+
+    if tiled:
+        if isinstance(fp, (str, os.PathLike)):
+            with open(fp, "wb") as f:
+                return export_image(image, recipe, f, tiled=True, order=order,
+                                    options=options, progress=progress)
+        # Warp, tone, watermark and encode are interleaved per band of tiles
+        with profiling.stage("export_tiled", image):
+            export_tiled(image, degrees, warp_offsets, fp, crop=crop, 
+                         watermark_text=watermark_text, order=order, options=options,
+                         progress=progress, tone=recipe["tone"])
+        return
+
+    # Rough weights of the steps, for progress reporting
+    report = progress or (lambda fraction: None)
+    report(0.0)
+    # Only the kept region is resampled
+    image = correct_image(image, degrees, warp_offsets, order=order, tone=recipe["tone"],
+                          crop=crop)
+    report(0.5)
+    if watermark_text is not None:
+        image = add_watermark_to_image(image, watermark_text)
+    report(0.6)
+    encode_image(image, fp, options)
+    report(1.0)
+
+
+# ---------------------
+# Native pixel data and file input
+# ---------------------
+
+def image_size(image):
+    """
+    Returns:
+    - tuple: (width, height) of a PIL image or pixel array
+    """
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    return image.size
+
+
+def pixel_format(image):
+    """
+    Channels and dtype of an image's native pixel data, see pixel_array().
+
+    Returns:
+    - tuple: (channels, dtype)
+    """
+    if isinstance(image, np.ndarray):
+        return (image.shape[2] if image.ndim == 3 else 1), image.dtype.type
+    if image.mode in NATIVE_MODES:
+        return NATIVE_MODES[image.mode]
+    if image.mode == "I":
+        return 1, np.uint16
+    return (4 if image.has_transparency_data else 3), np.uint8
+
+
+def pixel_array(image, box=None):
+    """
+    Pixels of an image in their native channels and bit depth: 1 (gray), 
+    2 (gray and alpha), 3 (RGB) or 4 (RGBA) channels of uint8 or uint16. 
+    Other Pillow modes are converted to RGB or RGBA, 32-bit integer 
+    images are clipped to 16 bits.
+
+    Parameters:
+    - image (PIL.Image or np.ndarray): Image, or array of shape (rows, 
+      cols) or (rows, cols, channels)
+    - box (tuple): Optional (left, top, right, bottom) region
+
+    Returns:
+    - np.ndarray: Array of shape (rows, cols, channels); a view for arrays
+    """
+    if isinstance(image, np.ndarray):
+        if box is not None:
+            left, top, right, bottom = box
+            image = image[top:bottom, left:right]
+        return image if image.ndim == 3 else image[..., None]
+
+    if box is not None:
+        image = image.crop(box)
+    channels, dtype = pixel_format(image)
+    if image.mode == "I":
+        return np.clip(np.asarray(image), 0, 65535).astype(np.uint16)[..., None]
+    if image.mode not in NATIVE_MODES:
+        image = image.convert("RGBA" if channels == 4 else "RGB")
+    pixels = np.asarray(image)
+    if image.mode == "RGBX":
+        pixels = pixels[..., :3]
+    if pixels.ndim == 2:
+        pixels = pixels[..., None]
+    # Big-endian 16-bit data to native byte order
+    return pixels.astype(dtype, copy=False)
+
+
+def _is_opaque(image):
+    """
+    Whether an image has no alpha channel or a fully opaque one.
+    """
+    channels, dtype = pixel_format(image)
+    if isinstance(image, Image.Image):
+        if not image.has_transparency_data:
+            return True
+        if image.mode not in ("RGBA", "LA"):
+            return False
+        return image.getchannel("A").getextrema()[0] == 255
+    if channels not in (2, 4):
+        return True
+    # In bands, so that a mapped array is not read into memory at once
+    opaque = np.iinfo(dtype).max
+    return all(
+        image[top:top + 1024, :, -1].min() == opaque 
+        for top in range(0, image.shape[0], 1024)
+    )
+
+
+def to_uint8(pixels):
+    """
+    Scales 16-bit pixels to 8 bits (rounded); uint8 pixels are returned 
+    as they are.
+    """
+    if pixels.dtype == np.uint8:
+        return pixels
+    return ((pixels.astype(np.uint32) * 255 + 32767) // 65535).astype(np.uint8)
+
+
+def image_from_pixels(pixels):
+    """
+    PIL image of an 8-bit pixel array with 1 to 4 channels (mode L, LA, 
+    RGB or RGBA).
+    """
+    mode = {1: "L", 2: "LA", 3: "RGB", 4: "RGBA"}[pixels.shape[2]]
+    return Image.fromarray(pixels[..., 0] if mode == "L" else pixels, mode=mode)
+
+
+def is_tiff(source):
+    """
+    Whether encoded data (bytes) or a file (path) is a TIFF.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        header = bytes(source[:4])
+    else:
+        with open(source, "rb") as f:
+            header = f.read(4)
+    return header in (b"II*\x00", b"MM\x00*")
+
+
+def _tiff_page(tiff):
+    """
+    The first page of a TIFF if its pixels can be read segment by segment 
+    into native arrays: 8 or 16-bit gray or RGB (optionally with alpha) 
+    in a compression tifffile decodes; None otherwise (e.g. palette, 
+    CMYK, or LZW without the imagecodecs package), for Pillow to decode.
+    """
+    page = tiff.pages[0]
+    if page.dtype not in (np.uint8, np.uint16) or page.is_subsampled:
+        return None
+    photometric = page.photometric
+    if photometric not in (tifffile.PHOTOMETRIC.MINISBLACK, tifffile.PHOTOMETRIC.RGB):
+        return None
+    if page.samplesperpixel > 4:
+        return None
+    try:
+        tifffile.TIFF.DECOMPRESSORS[page.compression]
+    except (KeyError, ValueError):
+        return None
+    return page
+
+
+def _tiff_segments(page):
+    """
+    Decodes the strips or tiles of a TIFF page one at a time.
+
+    Yields:
+    - tuple: (top, left, first channel, pixels of shape (rows, cols, 
+      channels)), clipped to the image
+    """
+    height, width = page.imagelength, page.imagewidth
+    separate = page.planarconfig == tifffile.PLANARCONFIG.SEPARATE
+    for segment, indices, _ in page.segments():
+        if segment is None:
+            continue
+        sample, _, top, left, _ = indices
+        yield top, left, sample if separate else 0, segment[0, :height - top, :width - left]
+
+
+def read_tiff(source, store=None, name="orig"):
+    """
+    Decodes a TIFF at full resolution in its native channels and bit 
+    depth, strip by strip (or tile by tile), into a memory-mapped file of 
+    the session store, so that only one segment is in memory at a time.
+
+    Parameters:
+    - source (str or file object): TIFF file
+    - store (SessionStore): Store for the mapped array; without one the 
+      array is held in memory
+    - name (str): Slot name in the store
+
+    Returns:
+    - np.ndarray: Array of shape (rows, cols, channels), or a PIL image 
+      for TIFFs tifffile cannot decode natively (see _tiff_page())
+    """
+    with tifffile.TiffFile(source) as tiff:
+        page = _tiff_page(tiff)
+        if page is None:
+            if hasattr(source, "seek"):
+                source.seek(0)
+            image = Image.open(source)
+            image.load()
+            return image if store is None else store.map_image(name, image)
+
+        shape = (page.imagelength, page.imagewidth, page.samplesperpixel)
+
+        def fill(pixels):
+            for top, left, channel, segment in _tiff_segments(page):
+                pixels[top:top + segment.shape[0], left:left + segment.shape[1], 
+                       channel:channel + segment.shape[2]] = segment
+
+        if store is not None:
+            return store.map_array(name, shape, page.dtype, fill)
+        pixels = np.zeros(shape, dtype=page.dtype)
+        fill(pixels)
+        return pixels
+
+
+def _cell_starts(offset, count, factor):
+    # Starts of the runs of indices offset + i that fall into one cell
+    first = (-offset) % factor
+    return np.array(([0] if first else []) + list(range(first, count, factor)))
+
+
+def _tiff_preview(source, max_size):
+    """
+    Decodes a TIFF at reduced size: each segment is box-filtered into a 
+    small grid as it is decoded, so memory does not depend on the size 
+    of the image.
+
+    Returns:
+    - tuple: (8-bit preview, whether it was resized, scale factor), or 
+      None for TIFFs tifffile cannot decode natively
+    """
+    with tifffile.TiffFile(source) as tiff:
+        page = _tiff_page(tiff)
+        if page is None:
+            return None
+        height, width = page.imagelength, page.imagewidth
+        scale_factor = min(max_size / width, max_size / height)
+        factor = max(1, int(1 / scale_factor)) if scale_factor < 1 else 1
+
+        cells_y, cells_x = -(-height // factor), -(-width // factor)
+        sums = np.zeros((cells_y, cells_x, page.samplesperpixel), dtype=np.float64)
+        for top, left, channel, segment in _tiff_segments(page):
+            rows = np.add.reduceat(
+                segment, _cell_starts(top, segment.shape[0], factor), axis=0, dtype=np.float64
+            )
+            cells = np.add.reduceat(rows, _cell_starts(left, segment.shape[1], factor), axis=1)
+            y, x = top // factor, left // factor
+            sums[y:y + cells.shape[0], x:x + cells.shape[1], 
+                 channel:channel + cells.shape[2]] += cells
+
+    counts_y = np.minimum(factor, height - np.arange(cells_y) * factor)
+    counts_x = np.minimum(factor, width - np.arange(cells_x) * factor)
+    # In place: the grid is the largest allocation here
+    means = sums
+    means /= counts_y[:, None, None] * counts_x[None, :, None]
+    if page.dtype == np.uint16:
+        means /= 257
+    np.rint(means, out=means)
+    image = image_from_pixels(np.clip(means, 0, 255).astype(np.uint8))
+    if scale_factor >= 1:
+        return image, False, 1.0
+    size = (int(width * scale_factor), int(height * scale_factor))
+    return image.resize(size), True, scale_factor
+
+
+def decode_preview(source, max_size):
+    """
+    Decodes an image at preview size, in 8 bits per channel and the 
+    image's own channels: L, LA, RGB or RGBA (other modes become RGB, or 
+    RGBA if they have transparency).
+
+    Parameters:
+    - source (bytes or str): Encoded image or path
+    - max_size (int): Maximum width and height of the preview
+
+    Returns:
+    - tuple: (preview, whether it was resized, scale factor)
+    """
+    fp = io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source
+    if is_tiff(source):
+        preview = _tiff_preview(fp, max_size)
+        if preview is not None:
+            return preview
+        if hasattr(fp, "seek"):
+            fp.seek(0)
+
+    image = Image.open(fp)
+    width, height = image.size
+    scale_factor = min(max_size / width, max_size / height)
+    if scale_factor >= 1:
+        return _preview_native(image), False, 1.0
+
+    size = (int(width * scale_factor), int(height * scale_factor))
+    # JPEGs are decoded directly at 1/2, 1/4 or 1/8 scale (never below 
+    # size); a no-op for other formats
+    image.draft(None, size)
+    return _preview_native(image).resize(size), True, scale_factor
+
+
+def _preview_native(image):
+    # 16-bit data is scaled, not clipped, to 8 bits
+    if pixel_format(image)[1] == np.uint16:
+        return image_from_pixels(to_uint8(pixel_array(image)))
+    if image.mode in ("L", "LA", "RGB", "RGBA"):
+        image.load()
+        return image
+    return image_from_pixels(pixel_array(image))
+
+
+def probe_image(path):
+    """
+    Checks that open_image() can read an image file, from its header only.
+    TIFFs that tifffile decodes are not subject to Pillow's decompression 
+    bomb limit, as in open_image().
+
+    Parameters:
+    - path (str): Image file
+
+    Returns:
+    - tuple: (width, height)
+
+    Raises:
+    - OSError: If the file is not an image open_image() can read
+    """
+    if is_tiff(path):
+        try:
+            with tifffile.TiffFile(path) as tiff:
+                page = _tiff_page(tiff)
+                if page is not None:
+                    return page.imagewidth, page.imagelength
+        except (tifffile.TiffFileError, ValueError) as e:
+            raise OSError(f"Invalid TIFF: {e}") from e
+    try:
+        with Image.open(path) as image:
+            return image.size
+    except Image.DecompressionBombError as e:
+        raise OSError(str(e)) from e
+
+
+def open_image(path, store=None):
+    """
+    Opens an image file at full resolution in its native channels and bit 
+    depth.
+
+    Parameters:
+    - path (str): Image file (PNG, JPEG, TIFF, ...)
+    - store (SessionStore): Store to memory-map the pixels through (see 
+      session_store.py); without one they are held in memory
+
+    Returns:
+    - PIL.Image or np.ndarray: The image; an array (see pixel_array()) 
+      for TIFFs and for modes Pillow cannot map
+    """
+    if is_tiff(path):
+        return read_tiff(path, store)
+    image = Image.open(path)
+    image.load()
+    if store is None:
+        return image
+    if image.mode in MAPPED_MODES:
+        return store.map_image("orig", image)
+    channels, dtype = pixel_format(image)
+
+    def fill(pixels):
+        for top in range(0, image.height, 256):
+            box = (0, top, image.width, min(image.height, top + 256))
+            pixels[top:top + 256] = pixel_array(image, box)
+
+    return store.map_array("orig", (image.height, image.width, channels), dtype, fill)
+
+
+def export_key_from_state(state, options=None):
+    """
+    Export cache key of the session's upload with its current recipe.
+
+    Parameters:
+    - state (st.session_state or dict): Session state with image_digest and
+      the parameters
+    - options (dict): Export options, see normalize_export_options()
+
+    Returns:
+    - tuple: (key, recipe, options), recipe and options normalized
+    """
+    recipe = recipe_from_state(state)
+    options = normalize_export_options(options)
+    return export_key(state["image_digest"], recipe, options), recipe, options
+
+
+def export_key(image_digest, recipe, options):
+    """
+    Export cache key of an upload with a recipe and export options.
+
+    Parameters:
+    - image_digest (str): Hash of the uploaded bytes, see digest_bytes()
+    - recipe (dict): Normalized recipe
+    - options (dict): Normalized export options
+
+    Returns:
+    - str: Export cache key
+    """
+    return export_cache.key(image_digest, {"recipe": recipe, "export": options})
+
+
+def prepare_orig_image(tiled=None, options=None):
+    """
+    Applies all alterations to the full-resolution image and encodes it 
+    straight into the on-disk export cache (see cache.py), keyed by 
+    upload digest, recipe and export options. The cache key is stored in 
+    st.session_state.original_image_key; read the file with 
+    export_cache.get() when it is downloaded.
+
+    Runs in the calling thread and decodes the upload at full resolution 
+    (memory-mapped through st.session_state.session_store, if there is 
+    one), as an export job does; the app queues exports as background 
+    jobs instead (see jobs.py).
+
+    Parameters:
+    - tiled (bool): See export_image()
+    - options (dict): Export options, see normalize_export_options()
+
+    Returns:
+    - str: Export cache key
+    """
+    # Repeated exports of the same upload and parameters are a cache hit
+    key, recipe, options = export_key_from_state(st.session_state, options)
+    with profiling.stage("prepare_orig_image", format=options["format"]):
+        cached = export_cache.touch(key)
+        profiling.event("export", cached)
+        if not cached:
+            with profiling.stage("decode_full", st.session_state.upload_path) as stage:
+                image = stage.output(open_image(st.session_state.upload_path, 
+                                                st.session_state.get("session_store")))
+            with export_cache.writer(key) as f:
+                export_image(image, recipe, f, tiled=tiled, options=options)
+    st.session_state.original_image_key = key
 
     st.success("Original image (altered) is ready for download!")
     
-    return orig_img, img_bytes
-    
-    
+    return key
 
 
 how_to_use_text = """
@@ -202,7 +1883,7 @@ This app allows you to correct images if they are turned, warped - or have
 rims that you want to remove. 
 
 1. Upload an image from you file system (Browse files). If the width or height exceeds 1000 pixels, the image is resized for performance reasons. But don't worry, all you alterations will be transfered to your original image, if you wish. Just press "Prepare Original Image (Altered)" once you are finished. This might take a few seconds. Wait until the notice "Original image (altered) is ready for download!" comes up and then press "Download Original Image (Altered)".
-2. Once an image is uploaded, a control panel will appear on the left side of the screen. Use the buttons there to rotate or warp the image. Every alteration can be undone.  
+2. Once an image is uploaded, a control panel will appear on the left side of the screen. Use the buttons there to rotate or warp the image, or type the values into the fields below them. Every alteration can be undone with "↶ Undo" above the image (and restored with "↷ Redo"). "Zoom" shows the image smaller, which also makes it faster to update.  
 3. Press "Show rectangle" to have a better reference frame for you alterations. You can also cut the image to the size of the rectangle at the end by pressing the button "Cut to Rectangle".
 3. Add a watermark if desired by pressing "Add Watermark". You can choose your own text. 
 5. Download your corrected image at the end. 